@@ -0,0 +1,73 @@
+import datetime
+
+from django.db import transaction
+
+from uwsgi_it_api.models import Container, ContainerAccounting, \
+    LatestContainerMetric, UsageLedger, allocation_usage, counters_usage, \
+    ACCOUNTED_COUNTERS
+
+
+def account_usage(now=None):
+    """
+    add the resources used since the previous run to the monthly ledgers.
+    Only the accounting state and the latest metrics of each container
+    are read (three queries, then a conditional UPDATE of each state), the
+    raw metrics are never scanned, and each touched ledger row is updated
+    once.
+    Containers without a state (created before the accounting was enabled)
+    are accounted from the first run, their past usage is unknown.
+    Returns the number of updated ledger rows
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    # the states are read after the containers, so the ones created in the
+    # meantime (with their own state) are not seen here
+    containers = list(Container.objects.values_list('pk', 'customer',
+                                                    'memory', 'storage'))
+    states = dict((s.container_id, s) for s in
+                  ContainerAccounting.objects.all())
+    latest = {}
+    for pk, metric, value in LatestContainerMetric.objects.filter(
+            metric__in=['container.quota'] + [c[0] for c in ACCOUNTED_COUNTERS]
+    ).values_list('container', 'metric', 'value'):
+        latest.setdefault(pk, {})[metric] = value
+
+    ledger = {}
+
+    def add(customer_id, year, month, amounts):
+        if not amounts:
+            return
+        total = ledger.setdefault((customer_id, year, month), {})
+        for field, amount in amounts.items():
+            total[field] = total.get(field, 0) + amount
+
+    new_states = []
+    with transaction.atomic():
+        for pk, customer_id, memory, storage in containers:
+            metrics = latest.get(pk, {})
+            state = states.get(pk)
+            if state is None:
+                # the counters are accounted from their current values
+                state = ContainerAccounting(container_id=pk, until=now)
+                for attr, value in counters_usage(state, metrics)[0].items():
+                    setattr(state, attr, value)
+                new_states.append(state)
+                continue
+            if state.until >= now:
+                continue
+            usage = allocation_usage(memory, storage,
+                                     metrics.get('container.quota'),
+                                     state.until, now)
+            values, amounts = counters_usage(state, metrics)
+            # a resize (or deletion) accounted the container in the meantime
+            if not ContainerAccounting.objects.filter(
+                    pk=state.pk, until=state.until).update(until=now,
+                                                           **values):
+                continue
+            for (year, month), allocation in usage.items():
+                add(customer_id, year, month, allocation)
+            add(customer_id, now.year, now.month, amounts)
+        ContainerAccounting.objects.bulk_create(new_states)
+        for (customer_id, year, month), amounts in ledger.items():
+            UsageLedger.add(customer_id, year, month, **amounts)
+    return len(ledger)
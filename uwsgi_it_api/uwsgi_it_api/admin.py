@@ -3,6 +3,16 @@ from django.forms import ModelForm,HiddenInput
 
 # Register your models here.
 from uwsgi_it_api.models import *
+from uwsgi_it_api.placement import place_container, placement_candidates, Fleet, plan_rebalance, describe_plan
+from django.http import HttpResponse
+
+def plan_server_rebalance(modeladmin, request, queryset):
+    fleet = Fleet(queryset)
+    memory, storage = fleet.biggest_container()
+    lines = ["rebalancing plan for a %dMB memory %dMB storage hole" % (memory, storage)]
+    lines += describe_plan(plan_rebalance(fleet, memory, storage))
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain')
+plan_server_rebalance.short_description = 'Plan rebalancing of the selected servers'
 
 class ServerAdmin(admin.ModelAdmin):
     def memory_status(self):
@@ -11,6 +21,8 @@ class ServerAdmin(admin.ModelAdmin):
         return "available:%d used:%d free:%d" % (self.storage, self.used_storage, self.free_storage)
     list_display = ('__unicode__', memory_status, storage_status, 'weight', 'owner', 'ctime', 'mtime')
     list_filter = ('datacenter',)
+    readonly_fields = ('allocated_memory', 'allocated_storage')
+    actions = [plan_server_rebalance]
     
 
 class ContainerAccounted(admin.SimpleListFilter):
@@ -34,6 +46,16 @@ class ContainerAdminForm(ModelForm):
         else:
             self.fields['tags'].widget = HiddenInput()
             self.fields['custom_distro'].widget = HiddenInput()
+            # leave it empty to let the scheduler choose a shared server
+            self.fields['server'].required = False
+            self.fields['server'].help_text = 'leave empty for automatic placement'
+
+    def clean(self):
+        cleaned_data = super(ContainerAdminForm, self).clean()
+        if not self.instance.pk and not cleaned_data.get('server'):
+            if not placement_candidates(cleaned_data.get('memory') or 0, cleaned_data.get('storage') or 0):
+                raise ValidationError('no shared server available for the requested resources')
+        return cleaned_data
 
 def regenerate_secret_uuid(modeladmin, request, queryset):
     for item in queryset.all():
@@ -52,7 +74,12 @@ class ContainerAdmin(admin.ModelAdmin):
     list_filter = ('server', 'distro', ContainerAccounted)
     search_fields = ('name', 'customer__user__username', 'tags__name', 'admin_note', 'admin_order')
     actions = [regenerate_secret_uuid]
-    
+
+    def save_model(self, request, obj, form, change):
+        if not change and not obj.server_id:
+            place_container(obj, owner=None)
+        else:
+            obj.save()
 
     form = ContainerAdminForm
 
@@ -146,13 +173,35 @@ class ServerMetadataAdmin(admin.ModelAdmin):
     list_filter = ('server', 'metadata')
 
 class AlarmAdmin(admin.ModelAdmin):
-    list_display = ('container', 'vassal', 'level', 'unix', 'msg')
+    list_display = ('container', 'vassal', 'level', 'unix', 'count', 'msg')
     list_filter = ('level',)
     search_fields = ('msg', '_class', 'vassal', 'color') 
 
+class AlertRuleAdmin(admin.ModelAdmin):
+    list_display = ('container', 'name', 'metric', 'field', 'relative_to', 'op', 'threshold', 'clear_threshold', 'duration', 'cooldown')
+    list_filter = ('metric',)
+
+class UsageLedgerAdmin(admin.ModelAdmin):
+    list_display = ('customer', 'year', 'month', 'memory_hours', 'storage_hours', 'quota_hours', 'cpu_seconds', 'net_rx', 'net_tx', 'mtime')
+    list_filter = ('year', 'month')
+
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('view', 'method', 'path', 'status', 'trigger', 'mode', 'duration', 'ctime')
+    list_filter = ('view', 'trigger', 'mode')
+    exclude = ('data',)
+
 class CustomDistroAdmin(admin.ModelAdmin):
     list_display = ('container', 'name', 'path')
 
+class DomainCheckAdmin(admin.ModelAdmin):
+    list_display = ('name', 'customer', 'status', 'checked', 'ctime')
+    list_filter = ('status',)
+    search_fields = ('name',)
+
+class DomainContainerAdmin(admin.ModelAdmin):
+    list_display = ('domain', 'container', 'first_seen', 'last_seen')
+    search_fields = ('domain__name',)
+
 class PortmapAdmin(admin.ModelAdmin):
     def _container__server(self):
         return self.container.server
@@ -166,6 +215,8 @@ admin.site.register(Distro)
 admin.site.register(Customer, CustomerAdmin)
 admin.site.register(Container, ContainerAdmin)
 admin.site.register(Domain, DomainAdmin)
+admin.site.register(DomainCheck, DomainCheckAdmin)
+admin.site.register(DomainContainer, DomainContainerAdmin)
 admin.site.register(Legion, LegionAdmin)
 admin.site.register(ContainerLink)
 admin.site.register(Datacenter)
@@ -195,6 +246,9 @@ admin.site.register(News, NewsAdmin)
 admin.site.register(Loopbox, LoopboxAdmin)
 
 admin.site.register(Alarm, AlarmAdmin)
+admin.site.register(AlertRule, AlertRuleAdmin)
+admin.site.register(UsageLedger, UsageLedgerAdmin)
+admin.site.register(RequestProfile, RequestProfileAdmin)
 
 admin.site.register(CustomDistro, CustomDistroAdmin)
 
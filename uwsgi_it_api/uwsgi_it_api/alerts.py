@@ -0,0 +1,123 @@
+import datetime
+
+from django.core.cache import get_cache
+
+from uwsgi_it_api.models import Alarm, AlertRule, alert_rules_key
+from uwsgi_it_api.config import UWSGI_IT_ALERTS_CACHE, \
+    UWSGI_IT_ALERTS_COOLDOWN, UWSGI_IT_ALERTS_QUOTA_HYSTERESIS
+from uwsgi_it_api.stats import record_cache
+
+RULE_FIELDS = ('id', 'name', 'metric', 'field', 'relative_to', 'op',
+               'threshold', 'clear_threshold', 'duration', 'cooldown')
+
+
+def container_rules(container, cache):
+    """
+    the rules (as dicts) of a container: the user defined ones (cached
+    until they change) and the implicit quota_threshold one
+    """
+    key = alert_rules_key(container.pk)
+    rules = cache.get(key)
+    record_cache(rules is not None)
+    if rules is None:
+        rules = [dict(zip(RULE_FIELDS, r)) for r in
+                 AlertRule.objects.filter(container=container).values_list(
+                     *RULE_FIELDS)]
+        cache.set(key, rules, 86400)
+    if container.quota_threshold:
+        rules = rules + [{
+            'id': 'quota', 'name': 'quota', 'metric': 'container.quota',
+            'field': 'value', 'relative_to': 'storage', 'op': '>',
+            'threshold': container.quota_threshold,
+            'clear_threshold': container.quota_threshold -
+            UWSGI_IT_ALERTS_QUOTA_HYSTERESIS,
+            'duration': 0, 'cooldown': UWSGI_IT_ALERTS_COOLDOWN}]
+    return rules
+
+
+def measure(rule, container, value, rate):
+    """
+    the value checked by the rule (None if not available)
+    """
+    if rule['field'] == 'rate':
+        value = rate
+    if value is None:
+        return None
+    if rule['relative_to'] == 'memory':
+        return value * 100.0 / max(container.memory_limit_in_bytes, 1)
+    if rule['relative_to'] == 'storage':
+        return value * 100.0 / max(container.quota, 1)
+    if rule['relative_to'] == 'cpu':
+        # cpuacct.usage is in nanoseconds
+        return value / 10000000.0
+    return value
+
+
+def breached(rule, value, threshold):
+    if rule['op'] == '<':
+        return value < threshold
+    return value > threshold
+
+
+def evaluate_alerts(container, metric, unix, value, rate):
+    """
+    evaluate the rules of the container on a new sample of a metric.
+    The state of each rule (pending since, firing, last alarm) is kept in
+    the cache, so no history is read: without rules for the metric the
+    cost is a cache get, otherwise a get_many plus a set_many on changes.
+    Returns the list of raised alarms
+    """
+    cache = get_cache(UWSGI_IT_ALERTS_CACHE)
+    rules = [r for r in container_rules(container, cache)
+             if r['metric'] == metric]
+    if not rules:
+        return []
+    keys = dict((r['id'], 'alert_state_%d_%s' % (container.pk, r['id']))
+                for r in rules)
+    states = cache.get_many(keys.values())
+    changed = {}
+    alarms = []
+    for rule in rules:
+        current = measure(rule, container, value, rate)
+        if current is None:
+            continue
+        key = keys[rule['id']]
+        state = states.get(key, {'firing': False, 'since': None, 'fired': 0})
+        new_state = dict(state)
+        if state['firing']:
+            clear_threshold = rule['clear_threshold']
+            if clear_threshold is None:
+                clear_threshold = rule['threshold']
+            # hysteresis, the alarm is re-armed only beyond clear_threshold
+            if not breached(rule, current, clear_threshold):
+                new_state['firing'] = False
+                new_state['since'] = None
+        elif breached(rule, current, rule['threshold']):
+            since = state['since'] or unix
+            new_state['since'] = since
+            if unix - since >= rule['duration'] and \
+                    unix - state['fired'] >= rule['cooldown']:
+                new_state['firing'] = True
+                new_state['fired'] = unix
+                alarms.append(raise_alert(container, rule, unix, current))
+        else:
+            new_state['since'] = None
+        if new_state != state:
+            changed[key] = new_state
+    if changed:
+        cache.set_many(changed, 86400 * 7)
+    return alarms
+
+
+def raise_alert(container, rule, unix, current):
+    unit = ''
+    if rule['relative_to']:
+        unit = '%'
+    msg = "%s %s %s%s is %s the %s%s threshold" % (
+        rule['name'] or 'alert', rule['metric'], round(current, 2), unit,
+        {'>': 'over', '<': 'under'}[rule['op']], rule['threshold'], unit)
+    alarm = Alarm(container=container, level=0, msg=msg,
+                  unix=datetime.datetime.fromtimestamp(unix),
+                  _class='alert.%s' % rule['id'], color='#ff0000')
+    alarm.save()
+    return alarm
@@ -0,0 +1,230 @@
+import datetime
+import json
+import operator
+import time
+import warnings
+
+from multiprocessing import Pool, cpu_count
+
+from django.db.models import Q
+
+from uwsgi_it_api.models import Alarm, Container, CPUContainerMetric, \
+    MemoryContainerMetric, MemoryRSSContainerMetric, \
+    MemoryCacheContainerMetric, IOReadContainerMetric, \
+    IOWriteContainerMetric, NetworkRXContainerMetric, \
+    NetworkTXContainerMetric, QuotaContainerMetric
+from uwsgi_it_api.config import UWSGI_IT_ANOMALY_MIN_SPREAD, \
+    UWSGI_IT_ANOMALY_EWMA_ALPHA, UWSGI_IT_ANOMALY_DAYS, \
+    UWSGI_IT_ANOMALY_STEP, UWSGI_IT_ANOMALY_WINDOW, \
+    UWSGI_IT_ANOMALY_THRESHOLD
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# (model, counter), counters are scored on their per-second rate
+METRICS = (
+    (CPUContainerMetric, True),
+    (MemoryContainerMetric, False),
+    (MemoryRSSContainerMetric, False),
+    (MemoryCacheContainerMetric, False),
+    (IOReadContainerMetric, True),
+    (IOWriteContainerMetric, True),
+    (NetworkRXContainerMetric, True),
+    (NetworkTXContainerMetric, True),
+    (QuotaContainerMetric, False),
+)
+
+
+def days_filter(start, end):
+    """
+    the metrics rows are per day, match the ones between start and end
+    """
+    day = datetime.date.fromtimestamp(start)
+    last = datetime.date.fromtimestamp(end)
+    q = []
+    while day <= last:
+        q.append(Q(year=day.year, month=day.month, day=day.day))
+        day += datetime.timedelta(days=1)
+    return reduce(operator.or_, q)
+
+
+def load_metric(model, start, end):
+    """
+    the raw json blobs of each container as a list of
+    (container_id, [blob, ...]), parsing is left to the workers
+    """
+    rows = {}
+    for pk, blob in model.objects.filter(days_filter(start, end)).values_list(
+            'container', 'json'):
+        rows.setdefault(pk, []).append(blob)
+    return sorted(rows.items())
+
+
+def series_matrix(rows, counter, start, step, buckets):
+    """
+    a (containers x buckets) matrix with the mean of the samples (or of
+    their rate for counters) in each step, NaN where there are no samples
+    """
+    matrix = numpy.empty((len(rows), buckets))
+    matrix.fill(numpy.nan)
+    for i, (pk, blobs) in enumerate(rows):
+        samples = []
+        for blob in blobs:
+            samples.extend(json.loads(blob or '[]'))
+        if len(samples) < 2:
+            continue
+        a = numpy.array(samples, dtype=float)
+        a = a[a[:, 0].argsort()]
+        t, v = a[:, 0], a[:, 1]
+        if counter:
+            dt, dv = numpy.diff(t), numpy.diff(v)
+            # skip duplicated samples and counter resets
+            ok = (dt > 0) & (dv >= 0)
+            t, v = t[1:][ok], dv[ok] / dt[ok]
+        idx = ((t - start) // step).astype(int)
+        ok = (idx >= 0) & (idx < buckets)
+        sums = numpy.bincount(idx[ok], weights=v[ok], minlength=buckets)
+        counts = numpy.bincount(idx[ok], minlength=buckets)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            matrix[i] = sums / counts
+    return matrix
+
+
+def ewma_baseline(history, alpha):
+    """
+    exponentially weighted mean and standard deviation of each row,
+    the loop is over the buckets, each step updates all of the rows
+    """
+    mean = numpy.empty(history.shape[0])
+    mean.fill(numpy.nan)
+    var = numpy.zeros(history.shape[0])
+    for column in history.T:
+        seen = ~numpy.isnan(column)
+        first = seen & numpy.isnan(mean)
+        mean[first] = column[first]
+        update = seen & ~first
+        diff = column[update] - mean[update]
+        mean[update] += alpha * diff
+        var[update] = (1 - alpha) * (var[update] + alpha * diff * diff)
+    return mean, numpy.sqrt(var)
+
+
+def mad_baseline(history):
+    """
+    median and (normal scaled) median absolute deviation of each row
+    """
+    median = numpy.nanmedian(history, axis=1)
+    mad = numpy.nanmedian(numpy.abs(history - median[:, None]), axis=1)
+    return median, mad * 1.4826
+
+
+def score_matrix(matrix, window, method='mad', min_points=None):
+    """
+    score the mean of the last window buckets of each row against the
+    baseline of the previous ones (in spreads), NaN when the history is
+    too short
+    """
+    history, recent = matrix[:, :-window], matrix[:, -window:]
+    if min_points is None:
+        min_points = window * 4
+    with warnings.catch_warnings():
+        # all-NaN rows are expected (containers without samples)
+        warnings.simplefilter('ignore', RuntimeWarning)
+        current = numpy.nanmean(recent, axis=1)
+        if method == 'ewma':
+            baseline, spread = ewma_baseline(history,
+                                             UWSGI_IT_ANOMALY_EWMA_ALPHA)
+        else:
+            baseline, spread = mad_baseline(history)
+        # flat series would make any change an anomaly
+        spread = numpy.maximum(spread, numpy.abs(baseline) *
+                               UWSGI_IT_ANOMALY_MIN_SPREAD)
+        spread = numpy.maximum(spread, 1e-9)
+        score = (current - baseline) / spread
+    score[numpy.sum(~numpy.isnan(history), axis=1) < min_points] = numpy.nan
+    return score, baseline, current
+
+
+def score_metric(job):
+    """
+    run in the pool workers (no db access), returns the anomalies of a
+    chunk of the containers of a metric
+    """
+    name, counter, rows, start, step, buckets, window, method, threshold = job
+    matrix = series_matrix(rows, counter, start, step, buckets)
+    score, baseline, current = score_matrix(matrix, window, method)
+    anomalies = []
+    with numpy.errstate(invalid='ignore'):
+        flagged = numpy.nonzero(numpy.abs(score) >= threshold)[0]
+    for i in flagged:
+        anomalies.append({'container': rows[i][0], 'metric': name,
+                          'score': float(score[i]),
+                          'baseline': float(baseline[i]),
+                          'current': float(current[i])})
+    return anomalies
+
+
+def chunks(rows, n):
+    size = max(1, (len(rows) + n - 1) // n)
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
+
+
+def detect_anomalies(days=UWSGI_IT_ANOMALY_DAYS, step=UWSGI_IT_ANOMALY_STEP,
+                     window=UWSGI_IT_ANOMALY_WINDOW, method='mad',
+                     threshold=UWSGI_IT_ANOMALY_THRESHOLD, processes=None,
+                     now=None):
+    """
+    score the last window steps of all of the container metrics against
+    the baseline of the previous days. The rows are loaded here (a query
+    per metric) while parsing and scoring are spread over a process pool.
+    Returns the anomalies sorted by score (absolute value)
+    """
+    if numpy is None:
+        raise ImportError('anomaly detection requires numpy')
+    if now is None:
+        now = int(time.time())
+    end = now - now % step + step
+    buckets = days * 86400 // step
+    start = end - buckets * step
+    if processes is None:
+        processes = cpu_count()
+    jobs = []
+    for model, counter in METRICS:
+        rows = load_metric(model, start, end)
+        for chunk in chunks(rows, processes):
+            jobs.append((model.name, counter, chunk, start, step, buckets,
+                         window, method, threshold))
+    if processes == 1:
+        results = map(score_metric, jobs)
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(score_metric, jobs)
+        finally:
+            pool.terminate()
+    anomalies = [a for result in results for a in result]
+    return sorted(anomalies, key=lambda a: -abs(a['score']))
+
+
+def describe_anomaly(anomaly):
+    return "%s is %s its baseline: %.2f (baseline %.2f, score %.1f)" % (
+        anomaly['metric'], 'over' if anomaly['score'] > 0 else 'under',
+        anomaly['current'], anomaly['baseline'], anomaly['score'])
+
+
+def raise_anomalies(anomalies, now=None):
+    """
+    store an alarm for each anomaly
+    """
+    if now is None:
+        now = int(time.time())
+    containers = Container.objects.in_bulk(
+        set([a['container'] for a in anomalies]))
+    for anomaly in anomalies:
+        alarm = Alarm(container=containers[anomaly['container']], level=0,
+                      unix=datetime.datetime.fromtimestamp(now),
+                      _class='anomaly.%s' % anomaly['metric'],
+                      msg=describe_anomaly(anomaly), color='#ff8000')
+        alarm.save()
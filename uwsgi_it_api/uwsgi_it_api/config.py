@@ -1,2 +1,84 @@
 UWSGI_IT_BASE_UID = 30000
 UWSGI_IT_METRICS_CACHE = 'metrics'
+# metrics of past days never change, clients can keep them for max-age seconds.
+# Responses are per-customer, so they are 'private' by default, set it to 'public'
+# if you want shared proxies to store them too
+UWSGI_IT_METRICS_CACHE_CONTROL = 'private'
+UWSGI_IT_METRICS_MAX_AGE = 31536000
+UWSGI_IT_ALARMS_CACHE = 'default'
+# seconds between two checks of the alarms sequence in /alarms/stream
+UWSGI_IT_ALARMS_STREAM_POLL = 2
+UWSGI_IT_ALARMS_STREAM_HEARTBEAT = 30
+# streams are closed after this amount of seconds (clients will reconnect with Last-Event-ID)
+UWSGI_IT_ALARMS_STREAM_TIMEOUT = 3600
+# each stream holds a worker (thread or process) for up to UWSGI_IT_ALARMS_STREAM_TIMEOUT seconds,
+# max number of streams of each customer (0 disables the limit). Many tails should use /alarms/poll
+UWSGI_IT_ALARMS_STREAM_MAX = 2
+# max number of alarms a container can raise every UWSGI_IT_ALARMS_RATE_PERIOD seconds (0 disables the limit)
+UWSGI_IT_ALARMS_RATE = 30
+UWSGI_IT_ALARMS_RATE_PERIOD = 60
+# apply the limit to each alarm class instead of the whole container
+UWSGI_IT_ALARMS_RATE_PER_CLASS = False
+UWSGI_IT_AUTH_CACHE = 'default'
+# seconds a verified username/password couple is trusted without hashing it again (0 disables the cache)
+UWSGI_IT_AUTH_CACHE_TIMEOUT = 300
+# call django login() (creating a session) for each authenticated api request
+UWSGI_IT_API_SESSIONS = False
+# smaller json bodies are not worth compressing
+UWSGI_IT_JSON_COMPRESS_MIN = 1024
+# streamed json responses are sent in chunks of (at least) this size
+UWSGI_IT_JSON_CHUNK = 16384
+# compiled firewall rulesets of the servers (explicitly invalidated on rules, links and placement changes)
+UWSGI_IT_FIREWALL_CACHE = 'default'
+UWSGI_IT_FIREWALL_CACHE_TIMEOUT = 86400
+# dns ownership checks of new domains (run in background by the check_domains command)
+UWSGI_IT_DNS_CACHE = 'default'
+# seconds positive and negative results are cached
+UWSGI_IT_DNS_CACHE_POSITIVE = 3600
+UWSGI_IT_DNS_CACHE_NEGATIVE = 60
+UWSGI_IT_DNS_TIMEOUT = 3
+# resolvers used for the initial NS queries (empty for the system ones), and their port
+UWSGI_IT_DNS_NAMESERVERS = []
+UWSGI_IT_DNS_PORT = 53
+# concurrent queries for each check and concurrent checks in check_domains
+UWSGI_IT_DNS_WORKERS = 8
+# default window (seconds) of the containers<->domains lookups
+UWSGI_IT_DOMAINS_SEEN_WINDOW = 86400
+# per-customer domain name -> id maps used by the metrics ingestion
+UWSGI_IT_DOMAINS_CACHE = 'default'
+UWSGI_IT_DOMAINS_CACHE_TIMEOUT = 3600
+# seconds the map is trusted in process memory without checking the shared cache
+UWSGI_IT_DOMAINS_LOCAL_TTL = 10
+# alert rules evaluated on the ingested container metrics
+UWSGI_IT_ALERTS_CACHE = 'default'
+# default seconds between two alarms of the same rule
+UWSGI_IT_ALERTS_COOLDOWN = 3600
+# the quota_threshold alarm is cleared when the usage goes under threshold-hysteresis percent
+UWSGI_IT_ALERTS_QUOTA_HYSTERESIS = 5
+# anomaly detection (detect_anomalies command): days of history, seconds per bucket
+UWSGI_IT_ANOMALY_DAYS = 7
+UWSGI_IT_ANOMALY_STEP = 300
+# buckets scored against the baseline of the previous ones
+UWSGI_IT_ANOMALY_WINDOW = 3
+# minimum score (in spreads from the baseline) of an anomaly
+UWSGI_IT_ANOMALY_THRESHOLD = 6.0
+# the spread is at least this fraction of the baseline
+UWSGI_IT_ANOMALY_MIN_SPREAD = 0.05
+UWSGI_IT_ANOMALY_EWMA_ALPHA = 0.1
+# request stats (uwsgi_it_api.stats.StatsMiddleware), each process publishes its counters every UWSGI_IT_STATS_FLUSH seconds
+UWSGI_IT_STATS_CACHE = 'default'
+UWSGI_IT_STATS_FLUSH = 10
+UWSGI_IT_STATS_TIMEOUT = 86400
+# latency histogram buckets (seconds)
+UWSGI_IT_STATS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# on-demand profiling (uwsgi_it_api.profiling.ProfileMiddleware), privileged clients send the X-uWSGI-it-Profile header
+# certificate DNs allowed to profile (in addition to the PrivilegedClient addresses)
+UWSGI_IT_PROFILE_DNS = []
+# view name -> N, profile one in N requests of the view
+UWSGI_IT_PROFILE_SAMPLE = {}
+# sampler interval (seconds of cpu time)
+UWSGI_IT_PROFILE_INTERVAL = 0.001
+# lines of the pstats report
+UWSGI_IT_PROFILE_LINES = 60
+# stored profiles
+UWSGI_IT_PROFILE_KEEP = 100
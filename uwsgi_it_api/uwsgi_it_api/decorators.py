@@ -1,8 +1,23 @@
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import HttpResponse
 from django.contrib.auth import authenticate, login
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import get_cache
+from django.conf import settings
+from uwsgi_it_api.config import UWSGI_IT_AUTH_CACHE, UWSGI_IT_AUTH_CACHE_TIMEOUT, UWSGI_IT_API_SESSIONS
+from uwsgi_it_api.models import api_token_version, api_token_user
+from uwsgi_it_api.utils import spit_json
+from uwsgi_it_api.stats import record_auth, record_cache
 from functools import wraps, partial
 import base64
+import hashlib
+import hmac
 import json
+import time
+
+API_TOKEN_SALT = 'uwsgi_it_api.token'
+# 'read' allows GET on every api, 'metrics' and 'alarms' only the related apis
+API_TOKEN_SCOPES = ('all', 'read', 'metrics', 'alarms')
 
 
 def need_certificate(func):
@@ -11,28 +26,106 @@ def need_certificate(func):
         if request.META.has_key('HTTPS_DN'):
             return func(request, *args, **kwargs)
         else:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}), content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
 
     return _decorator
 
+def cached_authenticate(username, password):
+    """
+    authenticate() runs the password hasher (PBKDF2) on every call, so verified
+    credentials are cached (keyed by an hmac of them) for UWSGI_IT_AUTH_CACHE_TIMEOUT seconds.
+    The password hash of the user is stored too, so a password change
+    or a deactivation immediately invalidates the entry
+    """
+    if not UWSGI_IT_AUTH_CACHE_TIMEOUT:
+        return authenticate(username=username, password=password)
+    digest = hmac.new(settings.SECRET_KEY, '%s\0%s' % (username, password), hashlib.sha256).hexdigest()
+    key = 'auth_%s' % digest
+    try:
+        cache = get_cache(UWSGI_IT_AUTH_CACHE)
+        cached = cache.get(key)
+    except:
+        return authenticate(username=username, password=password)
+    record_cache(cached is not None)
+    if cached:
+        pk, password_hash, backend = cached
+        try:
+            user = User.objects.get(pk=pk)
+            if user.is_active and user.password == password_hash:
+                user.backend = backend
+                return user
+        except User.DoesNotExist:
+            pass
+        cache.delete(key)
+    user = authenticate(username=username, password=password)
+    if user and user.is_active:
+        cache.set(key, (user.pk, user.password, user.backend), UWSGI_IT_AUTH_CACHE_TIMEOUT)
+    return user
+
+def make_api_token(customer, scope, container=None, expires=None):
+    """
+    api tokens are hmac-signed (with SECRET_KEY) payloads, no need to store them
+    """
+    payload = {'u': customer.user_id, 'v': customer.token_version, 's': scope}
+    if container:
+        payload['c'] = container.uid
+    if expires:
+        payload['e'] = int(time.time()) + expires
+    return signing.dumps(payload, salt=API_TOKEN_SALT, compress=True)
+
+def verify_api_token(token):
+    try:
+        payload = signing.loads(token, salt=API_TOKEN_SALT)
+    except signing.BadSignature:
+        return None
+    if 'e' in payload and payload['e'] < time.time():
+        return None
+    if payload['v'] != api_token_version(payload['u']):
+        return None
+    return payload
+
+def api_token_allows(payload, request, token_scope, token_container, container_uid):
+    scope = payload['s']
+    if scope != 'all' and scope != token_scope:
+        if scope != 'read' or request.method not in ('GET', 'HEAD'):
+            return False
+    # tokens bound to a container can be used only for its apis
+    if 'c' in payload:
+        return token_container and str(payload['c']) == str(container_uid)
+    return True
+
 def api_auth(request, fallback=None, *args, **kwargs):
     if request.META.has_key('HTTP_AUTHORIZATION'):
             auth = request.META['HTTP_AUTHORIZATION'].split()
             if len(auth) == 2:
                 if auth[0].lower() == "basic":
                     uname, passwd = base64.b64decode(auth[1]).split(':')
-                    return authenticate(username=uname, password=passwd)
+                    return cached_authenticate(uname, passwd)
+                if auth[0].lower() == "bearer":
+                    payload = verify_api_token(auth[1])
+                    if not payload:
+                        return None
+                    user = api_token_user(payload['u'])
+                    if user is None:
+                        return None
+                    request.api_token = payload
+                    return user
     elif request.META.has_key('HTTP_X_UWSGI_IT_USERNAME') and request.META.has_key('HTTP_X_UWSGI_IT_PASSWORD'):
             uname = request.META['HTTP_X_UWSGI_IT_USERNAME'].decode('hex')
             passwd = request.META['HTTP_X_UWSGI_IT_PASSWORD'].decode('hex')
-            return authenticate(username=uname, password=passwd)
+            return cached_authenticate(uname, passwd)
     elif fallback:
         return fallback(request, *args, **kwargs)
     return None
 
-def need_basicauth(func=None, realm='uwsgi.it api', fallback=None):
+def need_basicauth(func=None, realm='uwsgi.it api', fallback=None, token_scope=None, token_container=False):
+    """
+    token_scope is the api token scope (other than 'all') accepted by the view,
+    token_container means the first argument of the view is a container uid
+    (so tokens bound to that container are accepted)
+    """
     if func is None:
-        return partial(need_basicauth, fallback=fallback)
+        return partial(need_basicauth, fallback=fallback, token_scope=token_scope, token_container=token_container)
     @wraps(func)
     def _decorator(request, *args, **kwargs):
         # first check for crossdomain
@@ -40,18 +133,28 @@ def need_basicauth(func=None, realm='uwsgi.it api', fallback=None):
             response = HttpResponse()
             response['Access-Control-Allow-Origin'] = '*'
             response['Access-Control-Allow-Methods'] = 'GET,POST,DELETE,OPTIONS'
-            response['Access-Control-Allow-Headers'] = 'X-uwsgi-it-username,X-uwsgi-it-password'
+            response['Access-Control-Allow-Headers'] = 'X-uwsgi-it-username,X-uwsgi-it-password,Authorization'
             return response
+        start = time.time()
         user = api_auth(request, fallback, *args, **kwargs)
+        record_auth(time.time() - start)
         if user and user.is_active:
-            login(request, user)
+            payload = getattr(request, 'api_token', None)
+            if payload:
+                container_uid = kwargs.get('id', args[0] if args else None)
+                if not api_token_allows(payload, request, token_scope, token_container, container_uid):
+                    response = spit_json(request, {'error': 'Forbidden'}, status=403)
+                    response['Access-Control-Allow-Origin'] = '*'
+                    return response
+            elif UWSGI_IT_API_SESSIONS:
+                login(request, user)
+            # stateless by default, api clients never reuse the session cookie
             request.user = user
             response = func(request, *args, **kwargs)
             response['Access-Control-Allow-Origin'] = '*'
             return response
 
-        response = HttpResponse(json.dumps({'error': 'Unauthorized'}), content_type="application/json")
-        response.status_code = 401
+        response = spit_json(request, {'error': 'Unauthorized'}, status=401)
         response['Access-Control-Allow-Origin'] = '*'
         response['WWW-Authenticate'] = 'Basic realm="%s"' % realm
         return response
@@ -0,0 +1,127 @@
+import hashlib
+import ipaddress
+
+from django.core.cache import get_cache
+
+from uwsgi_it_api.models import Container, ContainerLink, Rule, \
+    container_ip, firewall_cache_key
+from uwsgi_it_api.config import UWSGI_IT_BASE_UID, UWSGI_IT_FIREWALL_CACHE, \
+    UWSGI_IT_FIREWALL_CACHE_TIMEOUT
+from uwsgi_it_api.stats import record_cache
+
+# appended to the links of each container (before its custom rules)
+DEFAULT_RULES = [('in', '10.0.0.0/8', '0.0.0.0', 'deny', ''),
+                 ('out', '0.0.0.0', '10.0.0.0/8', 'deny', '')]
+
+
+def network(value):
+    """
+    only explicit CIDRs are collapsed
+    """
+    if '/' not in value:
+        return None
+    try:
+        return ipaddress.ip_network(unicode(value), strict=False)
+    except ValueError:
+        return None
+
+
+def collapse_rules(rules, field):
+    """
+    merge the consecutive rules (direction, src, dst, action, target) only
+    differing in the network at position 'field' (1 for src, 2 for dst)
+    """
+    compiled = []
+    run = []
+    networks = []
+
+    def flush():
+        if not run:
+            return
+        if len(run) == 1:
+            compiled.append(run[0])
+        else:
+            for n in ipaddress.collapse_addresses(networks):
+                rule = list(run[0])
+                rule[field] = str(n)
+                compiled.append(tuple(rule))
+        del run[:]
+        del networks[:]
+
+    for rule in rules:
+        n = network(rule[field])
+        key = rule[:field] + rule[field + 1:]
+        if n is None or (run and run[0][:field] + run[0][field + 1:] != key):
+            flush()
+        if n is None:
+            compiled.append(rule)
+            continue
+        run.append(rule)
+        networks.append(n)
+    flush()
+    return compiled
+
+
+def compile_ruleset(server_id):
+    """
+    compile the firewall rules of all the containers of a server with three
+    queries: links become allow (or gateway, when the linked container is
+    on another server) rules, followed by the default deny rules and the
+    Rule objects (by priority). Adjacent CIDRs are collapsed.
+    Returns a dict with the rule lines (tuntap-device-rule syntax) of each
+    container uid and a version (the hash of the whole ruleset)
+    """
+    links = {}
+    rules = {}
+    pks = Container.objects.filter(server=server_id).order_by(
+        'pk').values_list('pk', flat=True)
+    for pk in pks:
+        links[pk] = []
+        rules[pk] = []
+    for pk, to, to_server, address in ContainerLink.objects.filter(
+            container__server=server_id).values_list(
+            'container', 'to', 'to__server', 'to__server__address'):
+        links[pk].append(('in', "%s/32" % container_ip(to),
+                          "%s/32" % container_ip(pk), 'allow', ''))
+        if to_server == server_id:
+            links[pk].append(('out', "%s/32" % container_ip(pk),
+                              "%s/32" % container_ip(to), 'allow', ''))
+        else:
+            links[pk].append(('out', "%s/32" % container_ip(pk),
+                              "%s/32" % container_ip(to), 'gateway',
+                              "%s:999" % address))
+    for rule in Rule.objects.filter(container__server=server_id).order_by(
+            '-priority', 'pk').values_list(
+            'container', 'direction', 'src', 'dst', 'action', 'target'):
+        rules[rule[0]].append(tuple([v or '' for v in rule[1:]]))
+
+    containers = {}
+    for pk in pks:
+        # links order does not matter, sort them to make CIDRs adjacent
+        compiled = sorted(links[pk], key=lambda r: (
+            r[0], r[3], r[4], network(r[2]), network(r[1])))
+        compiled = collapse_rules(collapse_rules(compiled, 1), 2)
+        compiled += DEFAULT_RULES
+        compiled += collapse_rules(collapse_rules(rules[pk], 1), 2)
+        containers[UWSGI_IT_BASE_UID + pk] = [
+            ' '.join(rule).rstrip() for rule in compiled]
+
+    h = hashlib.sha1()
+    for uid in sorted(containers):
+        h.update("%d\n%s\n" % (uid, '\n'.join(containers[uid])))
+    return {'version': h.hexdigest(), 'containers': containers}
+
+
+def server_ruleset(server_id):
+    """
+    the compiled ruleset of a server, it is cached until rules, links or
+    container placement change (see models.invalidate_firewall)
+    """
+    cache = get_cache(UWSGI_IT_FIREWALL_CACHE)
+    key = firewall_cache_key(server_id)
+    ruleset = cache.get(key)
+    record_cache(ruleset is not None)
+    if ruleset is None:
+        ruleset = compile_ruleset(server_id)
+        cache.set(key, ruleset, UWSGI_IT_FIREWALL_CACHE_TIMEOUT)
+    return ruleset
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from uwsgi_it_api.accounting import account_usage
+import time
+
+class Command(BaseCommand):
+    help = 'add the resources used by the containers since the previous run to the customers monthly ledgers'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', type='int', dest='loop', default=0,
+                    help='keep running, accounting every N seconds'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            rows = account_usage()
+            self.stdout.write("%d ledger rows updated" % rows)
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
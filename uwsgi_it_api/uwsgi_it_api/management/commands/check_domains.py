@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+from uwsgi_it_api.models import DomainCheck
+from uwsgi_it_api.utils import dns_check_cached
+from uwsgi_it_api.config import UWSGI_IT_DNS_WORKERS
+import datetime
+import time
+
+class Command(BaseCommand):
+    help = 'run the pending dns checks of new domains (concurrently) and create the verified ones'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', type='int', dest='loop', default=0,
+                    help='keep running, looking for new checks every N seconds'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            self.run_checks()
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+
+    def run_checks(self):
+        checks = list(DomainCheck.objects.filter(status='pending').select_related('customer'))
+        if not checks:
+            return
+        # only the dns queries run in the threads, the db is updated here
+        pool = ThreadPool(min(UWSGI_IT_DNS_WORKERS, len(checks)))
+        try:
+            results = pool.map(lambda check: dns_check_cached(check.name, check.customer.uuid), checks)
+        finally:
+            pool.terminate()
+        for check, verified in zip(checks, results):
+            check.checked = datetime.datetime.now()
+            if not verified:
+                check.status = 'failed'
+            else:
+                try:
+                    check.domain = check.customer.domain_set.create(name=check.name)
+                    check.status = 'verified'
+                except:
+                    check.status = 'conflict'
+            check.save()
+            self.stdout.write("%s: %s" % (check.name, check.status))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from uwsgi_it_api.anomaly import detect_anomalies, describe_anomaly, raise_anomalies
+from uwsgi_it_api.config import UWSGI_IT_BASE_UID, UWSGI_IT_ANOMALY_DAYS, UWSGI_IT_ANOMALY_STEP, \
+    UWSGI_IT_ANOMALY_WINDOW, UWSGI_IT_ANOMALY_THRESHOLD
+
+class Command(BaseCommand):
+    help = 'score the recent container metrics against their own baseline and report (or raise alarms for) the anomalies'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=UWSGI_IT_ANOMALY_DAYS,
+                    help='days of history used for the baseline'),
+        make_option('--step', type='int', dest='step', default=UWSGI_IT_ANOMALY_STEP,
+                    help='seconds per bucket'),
+        make_option('--window', type='int', dest='window', default=UWSGI_IT_ANOMALY_WINDOW,
+                    help='number of recent buckets to score'),
+        make_option('--method', dest='method', default='mad', choices=('mad', 'ewma'),
+                    help='baseline: median/MAD (default) or EWMA'),
+        make_option('--threshold', type='float', dest='threshold', default=UWSGI_IT_ANOMALY_THRESHOLD,
+                    help='minimum score (in spreads from the baseline)'),
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help='size of the process pool, defaults to the number of cpus'),
+        make_option('--alarms', action='store_true', dest='alarms', default=False,
+                    help='raise an alarm for each anomaly'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            anomalies = detect_anomalies(options['days'], options['step'], options['window'],
+                                         options['method'], options['threshold'], options['processes'])
+        except ImportError as e:
+            raise CommandError(str(e))
+        for anomaly in anomalies:
+            self.stdout.write("%d: %s" % (UWSGI_IT_BASE_UID + anomaly['container'], describe_anomaly(anomaly)))
+        if options['alarms']:
+            raise_anomalies(anomalies)
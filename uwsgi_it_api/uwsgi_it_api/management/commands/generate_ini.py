@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.template.loader import render_to_string
 from uwsgi_it_api.models import Container
+from uwsgi_it_api.firewall import server_ruleset
 from uwsgi_it_api.config import UWSGI_IT_BASE_UID
 
 class Command(BaseCommand):
@@ -11,4 +12,5 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         pk = args[0]
         container = Container.objects.get(pk=(int(pk)-UWSGI_IT_BASE_UID))
-        self.stdout.write(render_to_string('vassal.ini', {'container': container}))
+        firewall = server_ruleset(container.server_id)['containers'].get(container.uid, [])
+        self.stdout.write(render_to_string('vassal.ini', {'container': container, 'firewall': firewall}))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from uwsgi_it_api.models import Server
+from uwsgi_it_api.placement import Fleet, plan_rebalance, describe_plan
+
+class Command(BaseCommand):
+    help = 'plan the minimal container moves required to free a memory/storage hole on a server (nothing is moved)'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--memory', type='int', dest='memory', default=None,
+                    help='memory (MB) to free, defaults to the biggest container'),
+        make_option('--storage', type='int', dest='storage', default=None,
+                    help='storage (MB) to free, defaults to the biggest container'),
+        make_option('--datacenter', dest='datacenter', default=None,
+                    help='only consider servers of this datacenter'),
+        make_option('--owner', dest='owner', default=None,
+                    help='plan for the dedicated servers of this customer (by username) instead of the shared ones'),
+    )
+
+    def handle(self, *args, **options):
+        servers = Server.objects.filter(owner=None)
+        if options['owner']:
+            servers = Server.objects.filter(owner__user__username=options['owner'])
+        if options['datacenter']:
+            servers = servers.filter(datacenter__name=options['datacenter'])
+        fleet = Fleet(servers)
+        if not fleet.pks:
+            raise CommandError('no server found')
+        memory, storage = fleet.biggest_container()
+        if options['memory'] is not None:
+            memory = options['memory']
+        if options['storage'] is not None:
+            storage = options['storage']
+        self.stdout.write("largest hole: %dMB memory %dMB storage" % fleet.largest_hole())
+        self.stdout.write("requested hole: %dMB memory %dMB storage" % (memory, storage))
+        for line in describe_plan(plan_rebalance(fleet, memory, storage)):
+            self.stdout.write(line)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from uwsgi_it_api.models import DomainContainer, HitsDomainMetric, NetworkRXDomainMetric, NetworkTXDomainMetric
+import datetime
+
+class Command(BaseCommand):
+    help = 'rebuild the domains<->containers associations from the stored domain metrics (days granularity)'
+
+    def handle(self, *args, **options):
+        seen = {}
+        for metric in (HitsDomainMetric, NetworkRXDomainMetric, NetworkTXDomainMetric):
+            for domain, container, year, month, day in metric.objects.values_list('domain', 'container', 'year', 'month', 'day'):
+                try:
+                    d = datetime.datetime(year, month, day)
+                except:
+                    continue
+                first, last = seen.get((domain, container), (d, d))
+                seen[(domain, container)] = (min(first, d), max(last, d + datetime.timedelta(1, -1)))
+        with transaction.atomic():
+            DomainContainer.objects.all().delete()
+            DomainContainer.objects.bulk_create([DomainContainer(domain_id=domain, container_id=container, first_seen=first, last_seen=last)
+                                                 for (domain, container), (first, last) in seen.items()])
+        self.stdout.write("%d associations" % len(seen))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import models
+from optparse import make_option
+from uwsgi_it_api.models import Server, Container
+
+class Command(BaseCommand):
+    help = 'recompute the allocated memory/storage counters of the servers from their containers'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='only report the servers with wrong counters'),
+    )
+
+    def handle(self, *args, **options):
+        allocations = {}
+        for a in Container.objects.values('server').annotate(memory=models.Sum('memory'), storage=models.Sum('storage')):
+            allocations[a['server']] = (a['memory'], a['storage'])
+        for server in Server.objects.all():
+            memory, storage = allocations.get(server.pk, (0, 0))
+            if server.allocated_memory == memory and server.allocated_storage == storage:
+                continue
+            self.stdout.write("%s: memory %d -> %d storage %d -> %d" % (server.name, server.allocated_memory, memory, server.allocated_storage, storage))
+            if not options['dry_run']:
+                Server.objects.filter(pk=server.pk).update(allocated_memory=memory, allocated_storage=storage)
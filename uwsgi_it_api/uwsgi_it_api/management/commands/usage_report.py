@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from uwsgi_it_api.models import UsageLedger
+import datetime
+
+class Command(BaseCommand):
+    help = 'print the monthly resources usage of each customer (as accounted by account_usage)'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--year', type='int', dest='year', default=None,
+                    help='defaults to the current one'),
+        make_option('--month', type='int', dest='month', default=None,
+                    help='defaults to the current one'),
+    )
+
+    def handle(self, *args, **options):
+        today = datetime.date.today()
+        year = options['year'] or today.year
+        month = options['month'] or today.month
+        self.stdout.write("customer memory(MBh) storage(MBh) quota(MBh) cpu(s) net_rx net_tx")
+        for row in UsageLedger.objects.filter(year=year, month=month).select_related(
+                'customer__user').order_by('customer__user__username'):
+            self.stdout.write("%s %.0f %.0f %.0f %.0f %d %d" % (
+                row.customer.user.username, row.memory_hours, row.storage_hours,
+                row.quota_hours, row.cpu_seconds, row.net_rx, row.net_tx))
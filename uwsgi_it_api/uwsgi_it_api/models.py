@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
 import calendar
 import ipaddress
@@ -6,11 +6,20 @@ import uuid
 from django.core.exceptions import ValidationError
 import string
 from Crypto.PublicKey import RSA
-from uwsgi_it_api.config import UWSGI_IT_BASE_UID
+from uwsgi_it_api.config import UWSGI_IT_BASE_UID, UWSGI_IT_ALARMS_CACHE, \
+    UWSGI_IT_AUTH_CACHE, UWSGI_IT_FIREWALL_CACHE, UWSGI_IT_DOMAINS_CACHE, \
+    UWSGI_IT_DOMAINS_CACHE_TIMEOUT, UWSGI_IT_DOMAINS_LOCAL_TTL, \
+    UWSGI_IT_ALERTS_CACHE, UWSGI_IT_ALERTS_COOLDOWN, \
+    UWSGI_IT_ALARMS_RATE_PER_CLASS
 import random
 import datetime
 import os.path
-from django.db.models.signals import post_delete
+import hashlib
+import time
+from django.db.models.signals import post_delete, post_save, post_init, \
+    pre_delete
+from django.core.cache import get_cache
+from uwsgi_it_api.stats import record_cache
 
 
 # Create your models here.
@@ -37,6 +46,9 @@ class Customer(models.Model):
 
     admin_note = models.TextField(blank=True, null=True)
 
+    # incrementing it revokes all of the api tokens of the customer
+    token_version = models.PositiveIntegerField(default=0)
+
     @property
     def rsa_key_lines(self):
         return self.rsa_key.split('\n')
@@ -56,6 +68,48 @@ class Customer(models.Model):
         ordering = ['user__username']
 
 
+def api_token_version(user_id):
+    """
+    returns the current api tokens version of the customer owning user_id
+    (cached, so tokens can be verified without hitting the database)
+    """
+    cache = get_cache(UWSGI_IT_AUTH_CACHE)
+    key = 'api_token_version_%d' % user_id
+    version = cache.get(key)
+    if version is None:
+        try:
+            version = Customer.objects.values_list(
+                'token_version', flat=True).get(user=user_id)
+        except Customer.DoesNotExist:
+            return None
+        cache.set(key, version, 86400)
+    return version
+
+
+def api_token_user(user_id):
+    """
+    the active user of an api token. Not cached (a single pk lookup, as for
+    the cached credentials) as a cache invalidated by signals would miss
+    bulk updates of the users
+    """
+    try:
+        user = User.objects.get(pk=user_id)
+    except User.DoesNotExist:
+        return None
+    if not user.is_active:
+        return None
+    return user
+
+
+def customer_post_save_handler(sender, instance, **kwargs):
+    get_cache(UWSGI_IT_AUTH_CACHE).set(
+        'api_token_version_%d' % instance.user_id, instance.token_version,
+        86400)
+
+
+post_save.connect(customer_post_save_handler, Customer)
+
+
 class CustomerAttribute(models.Model):
     customer = models.ForeignKey(Customer)
     namespace = models.CharField(max_length=255)
@@ -118,19 +172,46 @@ class Server(models.Model):
 
     systemd = models.BooleanField('systemd', default=False)
 
+    # sum of the containers memory and storage, maintained by Container.save()
+    # and the Container post_delete handler (use reconcile_servers to fix them)
+    allocated_memory = models.PositiveIntegerField(default=0)
+    allocated_storage = models.PositiveIntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        # never overwrite the allocation counters with (maybe) stale values
+        if self.pk is not None and not kwargs.get('force_insert') and \
+                kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.local_fields
+                                       if f.name not in ('id', 'allocated_memory', 'allocated_storage')]
+        super(Server, self).save(*args, **kwargs)
+
+    @staticmethod
+    def reserve(pk, memory, storage):
+        """
+        atomically add (or remove, if negative) memory and storage to the
+        allocated counters of the server, only if they fit.
+        Returns False if there is not enough space
+        """
+        return Server.objects.filter(
+            pk=pk,
+            allocated_memory__lte=models.F('memory') - memory,
+            allocated_storage__lte=models.F('storage') - storage).update(
+            allocated_memory=models.F('allocated_memory') + memory,
+            allocated_storage=models.F('allocated_storage') + storage) == 1
+
+    @staticmethod
+    def release(pk, memory, storage):
+        Server.objects.filter(pk=pk).update(
+            allocated_memory=models.F('allocated_memory') - memory,
+            allocated_storage=models.F('allocated_storage') - storage)
+
     @property
     def used_memory(self):
-        n = self.container_set.all().aggregate(models.Sum('memory'))[
-            'memory__sum']
-        if not n: return 0
-        return n
+        return self.allocated_memory
 
     @property
     def used_storage(self):
-        n = self.container_set.all().aggregate(models.Sum('storage'))[
-            'storage__sum']
-        if not n: return 0
-        return n
+        return self.allocated_storage
 
     @property
     def free_memory(self):
@@ -311,6 +392,24 @@ class Rule(models.Model):
         ordering = ['-priority']
 
 
+def container_ip(pk):
+    # skip the first two addresses (10.0.0.1 for the gateway, 10.0.0.2 for the api)
+    addr = pk + 2
+    addr0 = 0x0a000000;
+    return ipaddress.IPv4Address(addr0 | (addr & 0x00ffffff))
+
+
+def container_hostname(name):
+    h = ''
+    allowed = string.ascii_letters + string.digits + '-'
+    for char in name:
+        if char in allowed:
+            h += char
+        else:
+            h += '-'
+    return h
+
+
 class Container(models.Model):
     name = models.CharField(max_length=255)
     ssh_keys_raw = models.TextField("SSH keys", blank=True, null=True)
@@ -359,6 +458,9 @@ class Container(models.Model):
 
     alarm_freq = models.PositiveIntegerField(default=60)
 
+    # seconds, 0 disables aggregation of alarms with the same fingerprint
+    alarm_aggregation = models.PositiveIntegerField(default=0)
+
     custom_distros_storage = models.BooleanField(default=False)
     custom_distro = models.ForeignKey(CustomDistro, null=True, blank=True,
                                       related_name='+')
@@ -386,18 +488,12 @@ class Container(models.Model):
             if self.server is None: return
         except:
             return
-        current_storage = \
-            self.server.container_set.all().aggregate(models.Sum('storage'))[
-                'storage__sum']
-        current_memory = \
-            self.server.container_set.all().aggregate(models.Sum('memory'))[
-                'memory__sum']
-        if not current_storage: current_storage = 0
-        if not current_memory: current_memory = 0
-        if self.pk:
-            orig = Container.objects.get(pk=self.pk)
-            current_storage -= orig.storage
-            current_memory -= orig.memory
+        current_storage = self.server.allocated_storage
+        current_memory = self.server.allocated_memory
+        orig = self.loaded_values()
+        if orig is not None and orig['server_id'] == self.server_id:
+            current_storage -= orig['storage']
+            current_memory -= orig['memory']
         if current_storage + self.storage > self.server.storage:
             raise ValidationError(
                 'the requested storage size is not available on the specified server')
@@ -405,40 +501,116 @@ class Container(models.Model):
             raise ValidationError(
                 'the requested memory size is not available on the specified server')
 
+    def loaded_values(self):
+        """
+        the values (by attname) of the fields as stored in the database,
+        they are snapshotted when the object is loaded (see
+        container_post_init_handler) and after each save, so no query is
+        required. Returns None for new containers
+        """
+        if self.pk is None:
+            return None
+        loaded = getattr(self, '_loaded_values', None)
+        # objects built with an explicit pk have not been loaded from the db
+        if loaded is None or self._state.adding:
+            fields = self._meta.concrete_fields
+            try:
+                row = Container.objects.filter(pk=self.pk).values_list(
+                    *[f.name for f in fields])[0]
+            except IndexError:
+                return None
+            loaded = dict(zip([f.attname for f in fields], row))
+            self._loaded_values = loaded
+        return loaded
+
+    def changed_fields(self):
+        """
+        the names of the fields modified since the object has been loaded
+        """
+        loaded = self.loaded_values()
+        fields = self._meta.concrete_fields
+        if loaded is None:
+            return [f.name for f in fields]
+        return [f.name for f in fields if f.attname in loaded and
+                getattr(self, f.attname) != loaded[f.attname]]
+
+    # changing those fields forces a reboot
+    REBOOT_FIELDS = ('name',
+                     'distro',
+                     'server',
+                     'memory',
+                     'storage',
+                     'customer',
+                     'alarm_freq',
+                     'jid',
+                     'jid_secret',
+                     'jid_destinations',
+                     'pushover_user',
+                     'pushover_token',
+                     'pushover_sound',
+                     'pushbullet_token',
+                     'slack_webhook',
+                     'quota_threshold',
+                     'custom_distros_storage',
+                     'custom_distro',
+                     'nofollow',
+                     'dmz')
+
     # force a reboot if required
     def save(self, *args, **kwargs):
-        interesting_fields = ('name',
-                              'distro',
-                              'server',
-                              'memory',
-                              'storage',
-                              'customer',
-                              'alarm_freq',
-                              'jid',
-                              'jid_secret',
-                              'jid_destinations',
-                              'pushover_user',
-                              'pushover_token',
-                              'pushover_sound',
-                              'pushbullet_token',
-                              'slack_webhook',
-                              'quota_threshold',
-                              'custom_distros_storage',
-                              'custom_distro',
-                              'nofollow',
-                              'dmz')
-        if self.pk is not None:
-            orig = Container.objects.get(pk=self.pk)
-            set_reboot = False
-            for field in interesting_fields:
-                if getattr(self, field) != getattr(orig, field):
-                    set_reboot = True
-                    break
-            if set_reboot:
+        orig = self.loaded_values()
+        update_fields = kwargs.get('update_fields')
+        if orig is not None:
+            changed = self.changed_fields()
+            if update_fields is not None:
+                changed = [f for f in changed if f in update_fields]
+            touched = []
+            if set(changed) & set(self.REBOOT_FIELDS):
                 self.last_reboot = datetime.datetime.now()
-            if self.ssh_keys_raw != orig.ssh_keys_raw:
+                touched.append('last_reboot')
+            if 'ssh_keys_raw' in changed:
                 self.ssh_keys_mtime = datetime.datetime.now()
-        super(Container, self).save(*args, **kwargs)
+                touched.append('ssh_keys_mtime')
+            # write only the modified fields (mtime is always updated)
+            if update_fields is None and not args and \
+                    not kwargs.get('force_insert') and not self._state.adding:
+                update_fields = changed
+            if update_fields is not None:
+                update_fields = list(update_fields) + touched + ['mtime']
+                kwargs['update_fields'] = update_fields
+        with transaction.atomic():
+            self.reserve_resources(orig, update_fields)
+            if orig is not None and (orig['memory'], orig['storage'], orig['customer_id']) != \
+                    (self.memory, self.storage, self.customer_id):
+                account_allocation(self.pk, orig['customer_id'], orig['memory'], orig['storage'],
+                                   datetime.datetime.now())
+            super(Container, self).save(*args, **kwargs)
+        if orig is None:
+            invalidate_firewall(self.server_id)
+        elif orig['server_id'] != self.server_id:
+            # the rules of the containers linked to this one change too
+            invalidate_firewall(self.server_id, orig['server_id'], *ContainerLink.objects.filter(
+                to=self).values_list('container__server', flat=True))
+        self._loaded_values = container_snapshot(self, orig, update_fields)
+
+    def reserve_resources(self, orig, update_fields=None):
+        """
+        update the allocation counters of the involved servers, this is the
+        real (race-free) over-allocation check, clean() is only a courtesy
+        """
+        if update_fields is not None and \
+                not set(update_fields) & set(('server', 'memory', 'storage')):
+            return
+        if orig is None or orig['server_id'] != self.server_id:
+            memory, storage = self.memory, self.storage
+        else:
+            memory = self.memory - orig['memory']
+            storage = self.storage - orig['storage']
+        if (memory or storage) and not Server.reserve(self.server_id, memory, storage):
+            raise ValidationError(
+                'the requested resources are not available on the specified server')
+        if orig is not None and orig['server_id'] != self.server_id:
+            Server.release(orig['server_id'], orig['memory'], orig['storage'])
 
     @property
     def combo_alarms(self):
@@ -467,21 +639,11 @@ class Container(models.Model):
 
     @property
     def hostname(self):
-        h = ''
-        allowed = string.ascii_letters + string.digits + '-'
-        for char in self.name:
-            if char in allowed:
-                h += char
-            else:
-                h += '-'
-        return h
+        return container_hostname(self.name)
 
     @property
     def ip(self):
-        # skip the first two addresses (10.0.0.1 for the gateway, 10.0.0.2 for the api)
-        addr = self.pk + 2
-        addr0 = 0x0a000000;
-        return ipaddress.IPv4Address(addr0 | (addr & 0x00ffffff))
+        return container_ip(self.pk)
 
     @property
     def munix(self):
@@ -528,6 +690,47 @@ class Container(models.Model):
         return [l.to.uid for l in self.containerlink_set.all()]
 
 
+def container_snapshot(instance, orig=None, update_fields=None):
+    """
+    the values of the concrete fields of a container, when update_fields
+    is specified only those are taken from the instance
+    """
+    snapshot = dict(orig or {})
+    for f in instance._meta.concrete_fields:
+        if update_fields is not None and f.name not in update_fields:
+            continue
+        # deferred fields are not in __dict__
+        if f.attname in instance.__dict__:
+            snapshot[f.attname] = instance.__dict__[f.attname]
+    return snapshot
+
+
+def container_post_init_handler(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._loaded_values = container_snapshot(instance)
+
+
+post_init.connect(container_post_init_handler, Container)
+
+
+def container_post_delete_handler(sender, instance, **kwargs):
+    Server.release(instance.server_id, instance.memory, instance.storage)
+    invalidate_firewall(instance.server_id)
+
+
+post_delete.connect(container_post_delete_handler, Container)
+
+
+def container_pre_delete_handler(sender, instance, **kwargs):
+    # the accounting state is deleted with the container, flush it
+    account_allocation(instance.pk, instance.customer_id, instance.memory,
+                       instance.storage, datetime.datetime.now(),
+                       counters=True)
+
+
+pre_delete.connect(container_pre_delete_handler, Container)
+
+
 class ContainerLink(models.Model):
     container = models.ForeignKey(Container)
     to = models.ForeignKey(Container, related_name='+')
@@ -543,6 +746,17 @@ class ContainerLink(models.Model):
             raise ValidationError("cannot link with myself")
 
 
+def firewall_post_change_handler(sender, instance, **kwargs):
+    invalidate_firewall(*Container.objects.filter(
+        pk=instance.container_id).values_list('server', flat=True))
+
+
+post_save.connect(firewall_post_change_handler, ContainerLink)
+post_delete.connect(firewall_post_change_handler, ContainerLink)
+post_save.connect(firewall_post_change_handler, Rule)
+post_delete.connect(firewall_post_change_handler, Rule)
+
+
 class Portmap(models.Model):
     proto = models.CharField(max_length=4,
                              choices=(('tcp',) * 2, ('udp',) * 2))
@@ -637,22 +851,175 @@ class Alarm(models.Model):
     _class = models.CharField('class', max_length=255, blank=True, null=True)
     vassal = models.CharField(max_length=255, blank=True, null=True)
 
+    # aggregation (unix is the last time the alarm has been seen)
+    fingerprint = models.CharField(max_length=40, blank=True, null=True,
+                                   db_index=True)
+    count = models.PositiveIntegerField(default=1)
+    first_seen = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def last_seen(self):
+        return self.unix
+
+    def compute_fingerprint(self):
+        parts = [self.level, self._class, self.func, self.filename, self.line,
+                 self.vassal]
+        # alarms without location infos (like the system ones) are
+        # distinguished by their message
+        if not (self._class or self.func or self.filename or self.line):
+            parts.append(self.msg)
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def aggregate(self):
+        """
+        merge the alarm with an already stored one with the same fingerprint
+        seen in the last container.alarm_aggregation seconds.
+        Returns True if the alarm has been merged (no need to store it).
+        Must be called in a transaction holding the container lock (see save)
+        """
+        window = datetime.timedelta(seconds=self.container.alarm_aggregation)
+        try:
+            orig = self.container.alarm_set.select_for_update().filter(
+                fingerprint=self.fingerprint,
+                unix__gte=self.unix - window).order_by('-unix')[0]
+        except IndexError:
+            return False
+        fields = {'count': models.F('count') + 1}
+        # a late alarm (the unix of the request) never moves the alarm
+        # backwards, streams and polls only look for newer ones
+        if self.unix > orig.unix:
+            fields.update(unix=self.unix, msg=self.msg, color=self.color)
+        else:
+            self.unix, self.msg, self.color = orig.unix, orig.msg, orig.color
+        if orig.first_seen and self.first_seen < orig.first_seen:
+            fields['first_seen'] = self.first_seen
+        else:
+            self.first_seen = orig.first_seen
+        Alarm.objects.filter(pk=orig.pk).update(**fields)
+        self.pk = orig.pk
+        self.count = orig.count + 1
+        return True
+
     def save(self, *args, **kwargs):
         if len(self.color) != 7:
             raise ValidationError('invalid color')
         if not self.color.startswith('#'):
             raise ValidationError('invalid color')
-        # how many alarms ?
-        alarms = self.container.alarm_set.count()
-        if alarms + 1 > self.container.max_alarms:
-            oldest = self.container.alarm_set.all().order_by('unix')[0]
-            oldest.delete()
-        super(Alarm, self).save(*args, **kwargs)
+        if self.pk is not None:
+            super(Alarm, self).save(*args, **kwargs)
+            bump_alarms_seq(self.container.customer_id)
+            return
+        self.fingerprint = self.compute_fingerprint()
+        if not self.first_seen:
+            self.first_seen = self.unix
+        with transaction.atomic():
+            # serialize the alarms of the container, otherwise concurrent
+            # raises would not see each other and store duplicates
+            list(Container.objects.select_for_update().filter(
+                pk=self.container_id).values_list('pk'))
+            if not (self.container.alarm_aggregation > 0 and self.aggregate()):
+                # how many alarms ?
+                alarms = self.container.alarm_set.count()
+                if alarms + 1 > self.container.max_alarms:
+                    oldest = self.container.alarm_set.all().order_by('unix')[0]
+                    oldest.delete()
+                super(Alarm, self).save(*args, **kwargs)
+        bump_alarms_seq(self.container.customer_id)
 
     class Meta:
         ordering = ['-unix']
 
 
+def alarms_seq_key(customer_id):
+    return "alarms_seq_%d" % customer_id
+
+
+def alarms_rate_key(uid, alarm_class=None):
+    """
+    the rate of the alarms of a container is limited whatever the api
+    (customer or private) used to raise them. Always pass the uid of a
+    container already checked for ownership
+    """
+    key = 'alarms_rate_%d' % uid
+    if UWSGI_IT_ALARMS_RATE_PER_CLASS and alarm_class:
+        key += '_' + hashlib.md5(alarm_class.encode('utf8')).hexdigest()
+    return key
+
+
+def bump_alarms_seq(customer_id):
+    """
+    each customer has a sequence number in the cache, incremented whenever
+    one of its alarms is stored. Alarms streams only hit the database when it changes
+    """
+    try:
+        cache = get_cache(UWSGI_IT_ALARMS_CACHE)
+        key = alarms_seq_key(customer_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, 86400)
+    except:
+        pass
+
+
+class AlertRule(models.Model):
+    """
+    a condition on a container metric raising an alarm (see alerts.py),
+    the alarm is raised again only after the value goes back over
+    clear_threshold (hysteresis) and cooldown seconds are passed
+    """
+    container = models.ForeignKey(Container)
+    name = models.CharField(max_length=255, blank=True, null=True)
+    metric = models.CharField(max_length=64, choices=[(m, m) for m in (
+        'container.cpu', 'container.mem', 'container.mem.rss',
+        'container.mem.cache', 'container.io.read', 'container.io.write',
+        'container.net.rx', 'container.net.tx', 'container.quota')])
+    # the value or its rate of change (per second)
+    field = models.CharField(max_length=5, default='value',
+                             choices=(('value', 'value'), ('rate', 'rate')))
+    # thresholds are percents of the container memory/storage or of a cpu
+    relative_to = models.CharField(max_length=7, blank=True, default='',
+                                   choices=(('', 'absolute'),
+                                            ('memory', 'memory'),
+                                            ('storage', 'storage'),
+                                            ('cpu', 'cpu')))
+    op = models.CharField(max_length=1, default='>',
+                          choices=(('>', 'above'), ('<', 'below')))
+    threshold = models.FloatField()
+    # defaults to threshold
+    clear_threshold = models.FloatField(null=True, blank=True)
+    # seconds the condition must hold before raising the alarm
+    duration = models.PositiveIntegerField(default=0)
+    cooldown = models.PositiveIntegerField(default=UWSGI_IT_ALERTS_COOLDOWN)
+
+    ctime = models.DateTimeField(auto_now_add=True)
+    mtime = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "%s %s %s %s %s" % (self.container, self.metric, self.field,
+                                   self.op, self.threshold)
+
+    def clean(self):
+        if self.relative_to == 'cpu' and self.field != 'rate':
+            raise ValidationError('cpu percent requires the rate field')
+
+
+def alert_rules_key(container_id):
+    return "alert_rules_%d" % container_id
+
+
+def alertrule_post_change_handler(sender, instance, **kwargs):
+    try:
+        get_cache(UWSGI_IT_ALERTS_CACHE).delete(
+            alert_rules_key(instance.container_id))
+    except:
+        pass
+
+
+post_save.connect(alertrule_post_change_handler, AlertRule)
+post_delete.connect(alertrule_post_change_handler, AlertRule)
+
+
 class Domain(models.Model):
     """
     domains are mapped to customers, each container of the customer
@@ -678,6 +1045,79 @@ class Domain(models.Model):
         return calendar.timegm(self.mtime.utctimetuple())
 
 
+# customer id -> (expiration, {name: domain id})
+customer_domains_local = {}
+
+
+def customer_domains(customer_id, refresh=False):
+    """
+    the name -> id map of the domains of a customer, cached in process
+    memory (for UWSGI_IT_DOMAINS_LOCAL_TTL seconds) and in the shared
+    cache (invalidated by the Domain signals, that only reach the process
+    cache of the process deleting the domain: writers must expect a stale id).
+    refresh=True skips the process cache (for names not found in it)
+    """
+    now = time.time()
+    if not refresh:
+        entry = customer_domains_local.get(customer_id)
+        if entry and entry[0] > now:
+            return entry[1]
+    cache = get_cache(UWSGI_IT_DOMAINS_CACHE)
+    key = 'domains_%d' % customer_id
+    domains = cache.get(key)
+    record_cache(domains is not None)
+    if domains is None:
+        domains = dict(Domain.objects.filter(
+            customer=customer_id).values_list('name', 'pk'))
+        cache.set(key, domains, UWSGI_IT_DOMAINS_CACHE_TIMEOUT)
+    customer_domains_local[customer_id] = (now + UWSGI_IT_DOMAINS_LOCAL_TTL,
+                                           domains)
+    return domains
+
+
+def domain_post_change_handler(sender, instance, **kwargs):
+    customer_domains_local.pop(instance.customer_id, None)
+    try:
+        get_cache(UWSGI_IT_DOMAINS_CACHE).delete(
+            'domains_%d' % instance.customer_id)
+    except:
+        pass
+
+
+post_save.connect(domain_post_change_handler, Domain)
+post_delete.connect(domain_post_change_handler, Domain)
+
+
+class DomainCheck(models.Model):
+    """
+    dns ownership verification of a domain, the domain is created by the
+    check_domains command (running in background) when it succeeds
+    """
+    name = models.CharField(max_length=255)
+    customer = models.ForeignKey(Customer)
+    status = models.CharField(max_length=17, default='pending', choices=(
+        ('pending', 'pending'), ('verified', 'verified'), ('failed', 'failed'),
+        ('conflict', 'conflict')))
+    domain = models.ForeignKey(Domain, null=True, blank=True,
+                               on_delete=models.SET_NULL)
+
+    ctime = models.DateTimeField(auto_now_add=True)
+    mtime = models.DateTimeField(auto_now=True)
+    checked = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.name, self.status)
+
+    @property
+    def checked_munix(self):
+        if self.checked is None:
+            return None
+        return calendar.timegm(self.checked.utctimetuple())
+
+    class Meta:
+        unique_together = ('customer', 'name')
+
+
 class Tag(models.Model):
     name = models.CharField(max_length=255)
     customer = models.ForeignKey(Customer)
@@ -749,6 +1189,246 @@ class ContainerMetric(models.Model):
         unique_together = ('container', 'year', 'month', 'day')
 
 
+class LatestContainerMetric(models.Model):
+    """
+    the last value of each metric of a container (with the rate of change
+    since the previous one), updated by the metrics ingestion so overviews
+    do not need to parse the metrics tables
+    """
+    container = models.ForeignKey(Container)
+    metric = models.CharField(max_length=64)
+    unix = models.PositiveIntegerField()
+    value = models.BigIntegerField()
+    # per second, null for the first value of the day
+    rate = models.FloatField(null=True)
+
+    def __unicode__(self):
+        return "%s %s" % (self.container, self.metric)
+
+    class Meta:
+        unique_together = ('container', 'metric')
+
+    @staticmethod
+    def store(container_id, metric, unix, value, rate):
+        """
+        upsert the latest value (older values are ignored), usually a
+        single UPDATE
+        """
+        if LatestContainerMetric.objects.filter(
+                container=container_id, metric=metric, unix__lte=unix).update(
+                unix=unix, value=value, rate=rate):
+            return
+        try:
+            with transaction.atomic():
+                LatestContainerMetric.objects.create(
+                    container_id=container_id, metric=metric, unix=unix,
+                    value=value, rate=rate)
+        except IntegrityError:
+            # a newer value is already there
+            pass
+
+
+def month_slices(start, end):
+    """
+    split the [start, end) interval at the months boundaries,
+    yields (year, month, hours)
+    """
+    while start < end:
+        if start.month == 12:
+            boundary = datetime.datetime(start.year + 1, 1, 1)
+        else:
+            boundary = datetime.datetime(start.year, start.month + 1, 1)
+        stop = min(boundary, end)
+        yield start.year, start.month, (stop - start).total_seconds() / 3600.0
+        start = stop
+
+
+class UsageLedger(models.Model):
+    """
+    the resources used by a customer in a month, incrementally updated by
+    the account_usage command (and by containers resizes and deletions)
+    """
+    customer = models.ForeignKey(Customer)
+    year = models.PositiveIntegerField()
+    month = models.PositiveIntegerField()
+    # allocated MB * hours
+    memory_hours = models.FloatField(default=0)
+    storage_hours = models.FloatField(default=0)
+    # used (quota metric) MB * hours
+    quota_hours = models.FloatField(default=0)
+    cpu_seconds = models.FloatField(default=0)
+    # bytes
+    net_rx = models.BigIntegerField(default=0)
+    net_tx = models.BigIntegerField(default=0)
+
+    mtime = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "%s %d-%02d" % (self.customer, self.year, self.month)
+
+    class Meta:
+        unique_together = ('customer', 'year', 'month')
+        ordering = ['-year', '-month']
+
+    @staticmethod
+    def add(customer_id, year, month, **amounts):
+        """
+        atomically increment the counters of a month (creating its row)
+        """
+        updates = dict((k, models.F(k) + v) for k, v in amounts.items())
+        updates['mtime'] = datetime.datetime.now()
+        rows = UsageLedger.objects.filter(customer=customer_id, year=year,
+                                          month=month)
+        if rows.update(**updates):
+            return
+        try:
+            with transaction.atomic():
+                UsageLedger.objects.create(customer_id=customer_id, year=year,
+                                           month=month, **amounts)
+        except IntegrityError:
+            rows.update(**updates)
+
+
+class ContainerAccounting(models.Model):
+    """
+    how far the resources of a container have been accounted: allocation
+    and quota up to 'until', counters up to their last seen values
+    """
+    container = models.OneToOneField(Container)
+    until = models.DateTimeField()
+    cpu = models.BigIntegerField(default=0)
+    net_rx = models.BigIntegerField(default=0)
+    net_tx = models.BigIntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s" % self.container
+
+
+def container_accounting_post_save_handler(sender, instance, created,
+                                           **kwargs):
+    # new containers are accounted since their creation
+    if created:
+        ContainerAccounting.objects.create(container=instance,
+                                           until=instance.ctime)
+
+
+post_save.connect(container_accounting_post_save_handler, Container)
+
+
+def allocation_usage(memory, storage, quota, start, end):
+    """
+    the ledger amounts of a container allocation (and used quota bytes)
+    in [start, end), by (year, month)
+    """
+    usage = {}
+    for year, month, hours in month_slices(start, end):
+        amounts = {'memory_hours': memory * hours,
+                   'storage_hours': storage * hours}
+        if quota:
+            amounts['quota_hours'] = quota / (1024 * 1024.0) * hours
+        usage[(year, month)] = amounts
+    return usage
+
+
+# (metric, ContainerAccounting field, UsageLedger field, scale)
+ACCOUNTED_COUNTERS = (
+    ('container.cpu', 'cpu', 'cpu_seconds', 1e-9),
+    ('container.net.rx', 'net_rx', 'net_rx', 1),
+    ('container.net.tx', 'net_tx', 'net_tx', 1),
+)
+
+
+def counters_usage(state, latest):
+    """
+    the ledger amounts of the counters increments since the accounted
+    values, latest maps the metrics to their last value.
+    Returns the new counters values and the amounts
+    """
+    values = {}
+    amounts = {}
+    for metric, attr, field, scale in ACCOUNTED_COUNTERS:
+        value = latest.get(metric)
+        if value is None:
+            continue
+        last = getattr(state, attr)
+        # counters restart from 0 when the container is rebooted
+        if value < last:
+            last = 0
+        if value > last:
+            amounts[field] = (value - last) * scale
+        values[attr] = value
+    return values, amounts
+
+
+def account_allocation(container_id, customer_id, memory, storage, now,
+                       counters=False):
+    """
+    account a container allocation (and the counters too if requested) up
+    to now, called before resizing or destroying it (the account_usage
+    command will only see the new sizes).
+    The state is advanced with a conditional UPDATE on its 'until', so the
+    hours accounted by a concurrent account_usage run are never counted
+    twice
+    """
+    latest = dict(LatestContainerMetric.objects.filter(
+        container=container_id).values_list('metric', 'value'))
+    while True:
+        state = ContainerAccounting.objects.filter(
+            container=container_id).first()
+        # accounting of the container has not started yet
+        if state is None or state.until >= now:
+            return
+        usage = allocation_usage(memory, storage,
+                                 latest.get('container.quota'), state.until,
+                                 now)
+        values = {}
+        if counters:
+            values, amounts = counters_usage(state, latest)
+            current = usage.setdefault((now.year, now.month), {})
+            for field, amount in amounts.items():
+                current[field] = current.get(field, 0) + amount
+        if ContainerAccounting.objects.filter(
+                pk=state.pk, until=state.until).update(until=now, **values):
+            break
+    for (year, month), amounts in usage.items():
+        UsageLedger.add(customer_id, year, month, **amounts)
+
+
+class LatestDomainMetric(models.Model):
+    """
+    the last value of each metric of a domain (as sent by each container),
+    updated by the metrics ingestion
+    """
+    domain = models.ForeignKey(Domain)
+    container = models.ForeignKey(Container)
+    metric = models.CharField(max_length=64)
+    unix = models.PositiveIntegerField()
+    value = models.BigIntegerField()
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.domain, self.container, self.metric)
+
+    class Meta:
+        unique_together = ('domain', 'container', 'metric')
+
+    @staticmethod
+    def store(domain_id, container_id, metric, unix, value):
+        """
+        upsert the latest value (older values are ignored)
+        """
+        if LatestDomainMetric.objects.filter(
+                domain=domain_id, container=container_id, metric=metric,
+                unix__lte=unix).update(unix=unix, value=value):
+            return
+        try:
+            with transaction.atomic():
+                LatestDomainMetric.objects.create(
+                    domain_id=domain_id, container_id=container_id,
+                    metric=metric, unix=unix, value=value)
+        except IntegrityError:
+            pass
+
+
 class DomainMetric(models.Model):
     domain = models.ForeignKey(Domain)
     container = models.ForeignKey(Container)
@@ -772,69 +1452,150 @@ class NetworkRXContainerMetric(ContainerMetric):
     """
     stores values from the tuntap router
     """
-    pass
+    name = 'container.net.rx'
 
 
 class NetworkTXContainerMetric(ContainerMetric):
     """
     stores values from the tuntap router
     """
-    pass
+    name = 'container.net.tx'
 
 
 class CPUContainerMetric(ContainerMetric):
     """
     stores values from the container cgroup
     """
-    pass
+    name = 'container.cpu'
 
 
 # stores values from the container cgroup
 class MemoryContainerMetric(ContainerMetric):
-    pass
+    name = 'container.mem'
 
 
 # stores values from the container cgroup
 class MemoryRSSContainerMetric(ContainerMetric):
-    pass
+    name = 'container.mem.rss'
 
 
 class MemoryCacheContainerMetric(ContainerMetric):
     """
     stores values from the container cgroup
     """
-    pass
+    name = 'container.mem.cache'
 
 
 class IOReadContainerMetric(ContainerMetric):
     """
     stores values from the container cgroup
     """
-    pass
+    name = 'container.io.read'
 
 
 class IOWriteContainerMetric(ContainerMetric):
     """
     stores values from the container cgroup
     """
-    pass
+    name = 'container.io.write'
 
 
 class QuotaContainerMetric(ContainerMetric):
     """
     uses perl Quota package
     """
-    pass
+    name = 'container.quota'
 
 
 class HitsDomainMetric(DomainMetric):
-    pass
+    name = 'domain.hits'
 
 
 class NetworkRXDomainMetric(DomainMetric):
-    pass
+    name = 'domain.net.rx'
 
 
 class NetworkTXDomainMetric(DomainMetric):
-    pass
+    name = 'domain.net.tx'
+
 
+class DomainContainer(models.Model):
+    """
+    containers serving a domain, maintained by the domain metrics ingestion
+    """
+    domain = models.ForeignKey(Domain)
+    container = models.ForeignKey(Container)
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return "%s --> %s" % (self.domain, self.container)
+
+    class Meta:
+        unique_together = ('domain', 'container')
+
+    @staticmethod
+    def seen(domain_id, container_id, when):
+        """
+        record a metric of the domain coming from the container, in the
+        common case (a newer metric, or another one with the same timestamp,
+        as rx, tx and hits are pushed together) it costs a single UPDATE
+        """
+        if DomainContainer.objects.filter(
+                domain=domain_id, container=container_id,
+                last_seen__lte=when).update(last_seen=when):
+            return
+        try:
+            with transaction.atomic():
+                DomainContainer.objects.create(
+                    domain_id=domain_id, container_id=container_id,
+                    first_seen=when, last_seen=when)
+        except IntegrityError:
+            # already known, the metric could be an old one
+            DomainContainer.objects.filter(
+                domain=domain_id, container=container_id,
+                first_seen__gt=when).update(first_seen=when)
+
+
+def firewall_cache_key(server_id):
+    return "firewall_%d" % server_id
+
+
+def invalidate_firewall(*server_ids):
+    """
+    drop the compiled firewall rulesets (see firewall.py) of the servers
+    """
+    try:
+        get_cache(UWSGI_IT_FIREWALL_CACHE).delete_many(
+            [firewall_cache_key(pk) for pk in set(server_ids) if pk])
+    except:
+        pass
+
+
+class RequestProfile(models.Model):
+    """
+    a profiled api request (see profiling.ProfileMiddleware)
+    """
+    view = models.CharField(max_length=255)
+    method = models.CharField(max_length=8)
+    path = models.TextField()
+    status = models.PositiveIntegerField()
+    # 'header' (asked by a privileged client) or 'sample' (1 in N)
+    trigger = models.CharField(max_length=6)
+    mode = models.CharField(max_length=8, choices=(('cprofile', 'cProfile'),
+                                                   ('sampler', 'sampler')))
+    duration = models.FloatField()
+    # pstats text report or collapsed stacks (for flamegraphs)
+    report = models.TextField()
+    # marshalled pstats data (cprofile mode), loadable with pstats.Stats()
+    data = models.BinaryField(null=True)
+    # json list of [sql, seconds]
+    sql = models.TextField()
+
+    ctime = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.method, self.path, self.ctime)
+
+    class Meta:
+        ordering = ['-ctime']
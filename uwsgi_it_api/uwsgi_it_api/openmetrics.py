@@ -0,0 +1,103 @@
+from django.http import HttpResponse
+from django.utils.text import compress_string
+
+from uwsgi_it_api.utils import accepted_encoding
+from uwsgi_it_api.models import Container, LatestContainerMetric, \
+    LatestDomainMetric, container_hostname
+from uwsgi_it_api.config import UWSGI_IT_BASE_UID
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# (metric, family, type, help)
+FAMILIES = (
+    ('container.cpu', 'uwsgi_it_container_cpu_nanoseconds', 'counter',
+     'cpu time used by the container'),
+    ('container.mem', 'uwsgi_it_container_memory_bytes', 'gauge',
+     'memory used by the container'),
+    ('container.mem.rss', 'uwsgi_it_container_memory_rss_bytes', 'gauge',
+     'rss memory used by the container'),
+    ('container.mem.cache', 'uwsgi_it_container_memory_cache_bytes', 'gauge',
+     'cache memory used by the container'),
+    ('container.io.read', 'uwsgi_it_container_io_read_bytes', 'counter',
+     'bytes read by the container'),
+    ('container.io.write', 'uwsgi_it_container_io_write_bytes', 'counter',
+     'bytes written by the container'),
+    ('container.net.rx', 'uwsgi_it_container_network_receive_bytes',
+     'counter', 'bytes received by the container'),
+    ('container.net.tx', 'uwsgi_it_container_network_transmit_bytes',
+     'counter', 'bytes sent by the container'),
+    ('container.quota', 'uwsgi_it_container_quota_bytes', 'gauge',
+     'storage used by the container'),
+    ('domain.hits', 'uwsgi_it_domain_hits', 'gauge',
+     'hits of the domain in the last period'),
+    ('domain.net.rx', 'uwsgi_it_domain_network_receive_bytes', 'gauge',
+     'bytes received by the domain in the last period'),
+    ('domain.net.tx', 'uwsgi_it_domain_network_transmit_bytes', 'gauge',
+     'bytes sent by the domain in the last period'),
+)
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(pairs):
+    return '{%s}' % ','.join(['%s="%s"' % (k, escape(v)) for k, v in pairs])
+
+
+def render_openmetrics(containers):
+    """
+    render the latest value of every metric of the specified containers
+    (a queryset) in the OpenMetrics text format.
+    Only the latest-value tables are read (four queries whatever the
+    number of containers), no metrics blob is parsed
+    """
+    info = {}
+    for pk, name, server in containers.values_list('pk', 'name',
+                                                   'server__name'):
+        info[pk] = [name, server, []]
+    for pk, tag in Container.tags.through.objects.filter(
+            container__in=containers).values_list('container', 'tag__name'):
+        info[pk][2].append(tag)
+    for pk in info:
+        name, server, tags = info[pk]
+        info[pk] = [('uid', str(UWSGI_IT_BASE_UID + pk)),
+                    ('hostname', container_hostname(name)),
+                    ('server', server), ('tags', ','.join(sorted(tags)))]
+
+    series = {}
+    for pk, metric, unix, value in LatestContainerMetric.objects.filter(
+            container__in=containers).values_list('container', 'metric',
+                                                  'unix', 'value'):
+        series.setdefault(metric, []).append((info[pk], unix, value))
+    for domain, pk, metric, unix, value in LatestDomainMetric.objects.filter(
+            container__in=containers).values_list('domain__name', 'container',
+                                                  'metric', 'unix', 'value'):
+        series.setdefault(metric, []).append(
+            ([('domain', domain)] + info[pk], unix, value))
+
+    lines = []
+    for metric, family, kind, description in FAMILIES:
+        if metric not in series:
+            continue
+        lines.append('# TYPE %s %s' % (family, kind))
+        lines.append('# HELP %s %s' % (family, description))
+        sample = family
+        if kind == 'counter':
+            sample += '_total'
+        for pairs, unix, value in sorted(series[metric]):
+            lines.append('%s%s %d %d' % (sample, labels(pairs), value, unix))
+    lines.append('# EOF\n')
+    return '\n'.join(lines)
+
+
+def openmetrics_response(request, containers):
+    body = render_openmetrics(containers).encode('utf-8')
+    if accepted_encoding(request) == 'gzip':
+        response = HttpResponse(compress_string(body),
+                                content_type=CONTENT_TYPE)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(body, content_type=CONTENT_TYPE)
+    response['Vary'] = 'Accept-Encoding'
+    return response
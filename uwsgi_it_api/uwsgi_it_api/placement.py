@@ -0,0 +1,217 @@
+from django.core.exceptions import ValidationError
+from django.db import models
+
+from uwsgi_it_api.models import Server, Container
+from uwsgi_it_api.config import UWSGI_IT_BASE_UID
+
+
+def placement_candidates(memory, storage, owner=None, ssd=None,
+                         datacenter=None, customer=None, anti_affinity=None):
+    """
+    returns the list of servers (pks) that can host a container of the
+    specified size, best ones first.
+
+    Only servers of 'owner' are considered (None for shared ones), capacity
+    is checked in the query itself using the allocation counters.
+    Servers with higher weight are preferred, then the best fit is chosen
+    (the smallest hole able to host the container, so big holes are kept
+    for big containers).
+    anti_affinity is a list of tags: servers already hosting containers of
+    'customer' with one of those tags are skipped.
+    """
+    servers = Server.objects.filter(
+        owner=owner,
+        allocated_memory__lte=models.F('memory') - memory,
+        allocated_storage__lte=models.F('storage') - storage)
+    if ssd is not None:
+        servers = servers.filter(ssd=ssd)
+    if datacenter:
+        servers = servers.filter(datacenter__name=datacenter)
+    if anti_affinity and customer:
+        if not isinstance(anti_affinity, (list, tuple)):
+            anti_affinity = [anti_affinity]
+        servers = servers.exclude(pk__in=Container.objects.filter(
+            customer=customer, tags__name__in=anti_affinity).values('server'))
+
+    def score(server):
+        pk, weight, total_memory, used_memory, total_storage, used_storage = server
+        left = float(total_memory - used_memory - memory) / max(total_memory, 1)
+        left += float(total_storage - used_storage - storage) / max(total_storage, 1)
+        return (-weight, left)
+
+    candidates = servers.values_list('pk', 'weight', 'memory',
+                                     'allocated_memory', 'storage',
+                                     'allocated_storage')
+    return [c[0] for c in sorted(candidates, key=score)]
+
+
+def place_container(container, **constraints):
+    """
+    saves the container on the best available server, if a concurrent
+    request fills it before us the next candidate is tried
+    """
+    if container.customer_id and 'customer' not in constraints:
+        constraints['customer'] = container.customer
+    for pk in placement_candidates(container.memory, container.storage,
+                                   **constraints):
+        container.server_id = pk
+        try:
+            container.save()
+            return container
+        except ValidationError:
+            continue
+    raise ValidationError('no server available for the requested resources')
+
+
+class Fleet(object):
+    """
+    a snapshot of servers and containers allocations as plain arrays
+    (loaded with two queries) for the rebalancing planner
+    """
+
+    def __init__(self, servers):
+        servers = servers.order_by('pk')
+        rows = list(servers.values_list('pk', 'name', 'memory', 'storage'))
+        self.pks = [r[0] for r in rows]
+        self.names = [r[1] for r in rows]
+        self.memory = [r[2] for r in rows]
+        self.storage = [r[3] for r in rows]
+        self.used_memory = [0] * len(rows)
+        self.used_storage = [0] * len(rows)
+        # containers hosted by each server as (uid, memory, storage)
+        self.hosted = [[] for r in rows]
+        index = dict((pk, i) for i, pk in enumerate(self.pks))
+        for pk, server, memory, storage in Container.objects.filter(
+                server__in=servers).values_list('pk', 'server', 'memory',
+                                                'storage'):
+            i = index[server]
+            self.used_memory[i] += memory
+            self.used_storage[i] += storage
+            self.hosted[i].append((UWSGI_IT_BASE_UID + pk, memory, storage))
+
+    def free(self, i):
+        return (self.memory[i] - self.used_memory[i],
+                self.storage[i] - self.used_storage[i])
+
+    def largest_hole(self):
+        return max([self.free(i) for i in range(len(self.pks))] or [(0, 0)])
+
+    def biggest_container(self):
+        return max([(c[1], c[2]) for h in self.hosted for c in h] or [(0, 0)])
+
+    def utilization(self, i):
+        return (100 * self.used_memory[i] / max(self.memory[i], 1),
+                100 * self.used_storage[i] / max(self.storage[i], 1))
+
+
+def plan_evictions(fleet, target, memory, storage):
+    """
+    the containers to move out of 'target' to free memory/storage on it,
+    the biggest (relatively to the server size) first to minimize the moves
+    """
+    need_memory = memory - fleet.free(target)[0]
+    need_storage = storage - fleet.free(target)[1]
+    size = lambda c: (float(c[1]) / max(fleet.memory[target], 1) +
+                      float(c[2]) / max(fleet.storage[target], 1))
+    if need_memory <= 0 and need_storage <= 0:
+        return []
+    # a single move is enough, choose the smallest container doing the job
+    single = [c for c in fleet.hosted[target]
+              if c[1] >= need_memory and c[2] >= need_storage]
+    if single:
+        return [min(single, key=size)]
+    evict = []
+    for c in sorted(fleet.hosted[target], key=size, reverse=True):
+        if need_memory <= 0 and need_storage <= 0:
+            break
+        evict.append(c)
+        need_memory -= c[1]
+        need_storage -= c[2]
+    if need_memory > 0 or need_storage > 0:
+        return None
+    # drop the evictions not needed anymore (the smallest ones first)
+    for c in sorted(evict, key=size):
+        if need_memory + c[1] <= 0 and need_storage + c[2] <= 0:
+            evict.remove(c)
+            need_memory += c[1]
+            need_storage += c[2]
+    return evict
+
+
+def plan_rebalance(fleet, memory, storage):
+    """
+    computes the minimal list of moves required to have a server with at
+    least memory/storage free, evicted containers are placed with best fit
+    decreasing on the other servers.
+    Returns the list of steps (a dict for each move, with the projected
+    utilization of the involved servers and the largest hole after it),
+    an empty list if no move is needed and None if it is not possible
+    """
+    best = None
+    for target in range(len(fleet.pks)):
+        if fleet.memory[target] < memory or fleet.storage[target] < storage:
+            continue
+        evict = plan_evictions(fleet, target, memory, storage)
+        if evict is None:
+            continue
+        if not evict:
+            return []
+        free_memory = [fleet.free(i)[0] for i in range(len(fleet.pks))]
+        free_storage = [fleet.free(i)[1] for i in range(len(fleet.pks))]
+        moves = []
+        for c in sorted(evict, key=lambda c: (c[1], c[2]), reverse=True):
+            candidates = [(free_memory[i] - c[1] + free_storage[i] - c[2], i)
+                          for i in range(len(fleet.pks))
+                          if i != target and free_memory[i] >= c[1] and
+                          free_storage[i] >= c[2]]
+            if not candidates:
+                moves = None
+                break
+            dest = min(candidates)[1]
+            free_memory[dest] -= c[1]
+            free_storage[dest] -= c[2]
+            moves.append((c, target, dest))
+        if moves is None:
+            continue
+        cost = (len(moves), sum([m[0][1] for m in moves]))
+        if best is None or cost < best[0]:
+            best = (cost, moves)
+    if best is None:
+        return None
+    steps = []
+    for c, source, dest in best[1]:
+        uid, c_memory, c_storage = c
+        fleet.hosted[source].remove(c)
+        fleet.hosted[dest].append(c)
+        fleet.used_memory[source] -= c_memory
+        fleet.used_storage[source] -= c_storage
+        fleet.used_memory[dest] += c_memory
+        fleet.used_storage[dest] += c_storage
+        steps.append({'container': uid, 'memory': c_memory,
+                      'storage': c_storage,
+                      'from': fleet.names[source], 'to': fleet.names[dest],
+                      'from_utilization': fleet.utilization(source),
+                      'to_utilization': fleet.utilization(dest),
+                      'largest_hole': fleet.largest_hole()})
+    return steps
+
+
+def describe_plan(steps):
+    if steps is None:
+        return ['no plan available for the requested resources']
+    if not steps:
+        return ['no move required']
+    lines = []
+    for step in steps:
+        lines.append(
+            "move %d (%dMB memory, %dMB storage) from %s to %s | "
+            "%s: %d%% memory %d%% storage | %s: %d%% memory %d%% storage | "
+            "largest hole: %dMB memory %dMB storage" % (
+                step['container'], step['memory'], step['storage'],
+                step['from'], step['to'],
+                step['from'], step['from_utilization'][0],
+                step['from_utilization'][1],
+                step['to'], step['to_utilization'][0],
+                step['to_utilization'][1],
+                step['largest_hole'][0], step['largest_hole'][1]))
+    return lines
@@ -0,0 +1,148 @@
+import cProfile
+import json
+import marshal
+import pstats
+import signal
+import threading
+import time
+
+from StringIO import StringIO
+
+from django.db import connections
+
+from uwsgi_it_api.models import PrivilegedClient, RequestProfile
+from uwsgi_it_api.config import UWSGI_IT_PROFILE_DNS, \
+    UWSGI_IT_PROFILE_SAMPLE, UWSGI_IT_PROFILE_INTERVAL, \
+    UWSGI_IT_PROFILE_LINES, UWSGI_IT_PROFILE_KEEP
+
+# view name -> requests seen by this process (for sampling)
+seen = {}
+
+
+def is_privileged(request):
+    """
+    certificate authenticated requests from a PrivilegedClient address or
+    with one of the UWSGI_IT_PROFILE_DNS
+    """
+    dn = request.META.get('HTTPS_DN')
+    if not dn:
+        return False
+    if dn in UWSGI_IT_PROFILE_DNS:
+        return True
+    return PrivilegedClient.objects.filter(
+        address=request.META.get('REMOTE_ADDR')).exists()
+
+
+class Sampler(object):
+    """
+    statistical profiler, the stack is sampled every interval seconds of
+    cpu time (SIGPROF). Signals are only delivered to the main thread
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = {}
+
+    def handler(self, signum, frame):
+        stack = []
+        while frame:
+            stack.append('%s:%s' % (frame.f_code.co_filename,
+                                    frame.f_code.co_name))
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def runcall(self, func, *args, **kwargs):
+        old = signal.signal(signal.SIGPROF, self.handler)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, old)
+
+    def report(self):
+        """
+        collapsed stacks (the flamegraph.pl input format)
+        """
+        return '\n'.join(['%s %d' % item for item in sorted(
+            self.stacks.items(), key=lambda item: -item[1])])
+
+
+def profile_view(request, view_func, view_args, view_kwargs, mode, trigger):
+    """
+    run the view under the profiler tracing its queries, the profile is
+    stored and its id returned in the X-uWSGI-it-Profile header
+    """
+    if mode == 'sampler' and \
+            not isinstance(threading.current_thread(), threading._MainThread):
+        mode = 'cprofile'
+    if mode == 'sampler':
+        profiler = Sampler(UWSGI_IT_PROFILE_INTERVAL)
+    else:
+        profiler = cProfile.Profile()
+    tracing = []
+    for connection in connections.all():
+        tracing.append((connection, connection.use_debug_cursor,
+                        len(connection.queries)))
+        connection.use_debug_cursor = True
+    start = time.time()
+    try:
+        response = profiler.runcall(view_func, request, *view_args,
+                                    **view_kwargs)
+    finally:
+        duration = time.time() - start
+        sql = []
+        for connection, use_debug_cursor, offset in tracing:
+            connection.use_debug_cursor = use_debug_cursor
+            sql += [[q['sql'], float(q['time'])] for q in
+                    connection.queries[offset:]]
+
+    data = None
+    if mode == 'sampler':
+        report = profiler.report()
+    else:
+        out = StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(UWSGI_IT_PROFILE_LINES)
+        report = out.getvalue()
+        data = marshal.dumps(stats.stats)
+    profile = RequestProfile.objects.create(
+        view=view_func.__name__, method=request.method,
+        path=request.get_full_path(), status=response.status_code,
+        trigger=trigger, mode=mode, duration=duration, report=report,
+        data=data, sql=json.dumps(sql))
+    # keep only the latest profiles
+    RequestProfile.objects.filter(pk__in=list(
+        RequestProfile.objects.order_by('-pk').values_list(
+            'pk', flat=True)[UWSGI_IT_PROFILE_KEEP:])).delete()
+    response['X-uWSGI-it-Profile'] = str(profile.pk)
+    return response
+
+
+class ProfileMiddleware(object):
+    """
+    profile the requests of privileged clients sending the
+    X-uWSGI-it-Profile header ("cprofile", the default, or "sampler") and
+    one in UWSGI_IT_PROFILE_SAMPLE[view] requests of the other views.
+    Put it last in MIDDLEWARE_CLASSES: the view is called by it when
+    profiling. Without the header and sampling the cost is a dict lookup
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        header = request.META.get('HTTP_X_UWSGI_IT_PROFILE')
+        if header is not None:
+            if not is_privileged(request):
+                return None
+            mode = 'cprofile'
+            if header == 'sampler':
+                mode = 'sampler'
+            return profile_view(request, view_func, view_args, view_kwargs,
+                                mode, 'header')
+        n = UWSGI_IT_PROFILE_SAMPLE.get(view_func.__name__)
+        if not n:
+            return None
+        count = seen[view_func.__name__] = seen.get(view_func.__name__, 0) + 1
+        if count % n:
+            return None
+        return profile_view(request, view_func, view_args, view_kwargs,
+                            'cprofile', 'sample')
@@ -0,0 +1,209 @@
+import bisect
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.core.cache import get_cache
+from django.db import connections
+
+from uwsgi_it_api.config import UWSGI_IT_STATS_CACHE, UWSGI_IT_STATS_FLUSH, \
+    UWSGI_IT_STATS_TIMEOUT, UWSGI_IT_STATS_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ('requests', 'errors', 'exceptions', 'queries', 'query_time',
+            'cache_hits', 'cache_misses', 'auth_time', 'bytes', 'time')
+
+# the counters of the request being served by the current thread
+local = threading.local()
+
+# view name -> counters (with the 'latency' histogram) of this process
+views = {}
+lock = threading.Lock()
+last_flush = time.time()
+
+
+def current():
+    return getattr(local, 'current', None)
+
+
+def record_cache(hit):
+    """
+    called by the cache lookups of the hot paths
+    """
+    counters = current()
+    if counters is not None:
+        if hit:
+            counters['cache_hits'] += 1
+        else:
+            counters['cache_misses'] += 1
+
+
+def record_auth(seconds):
+    counters = current()
+    if counters is not None:
+        counters['auth_time'] += seconds
+
+
+def report_exception():
+    """
+    log (with its traceback) and count an exception handled by a view
+    """
+    logger.exception('exception handled by a view')
+    counters = current()
+    if counters is not None:
+        counters['exceptions'] += 1
+
+
+class TimedCursor(object):
+    """
+    accounts the queries (and their time) to the current request
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def timed(self, method, *args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            counters = current()
+            if counters is not None:
+                counters['queries'] += 1
+                counters['query_time'] += time.time() - start
+
+    def execute(self, sql, params=None):
+        return self.timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed(self.cursor.executemany, sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def instrument_connections():
+    """
+    connections are per thread, wrap the cursors of the new ones
+    """
+    for connection in connections.all():
+        if getattr(connection, 'stats_instrumented', False):
+            continue
+        cursor = connection.cursor
+        connection.cursor = lambda cursor=cursor: TimedCursor(cursor())
+        connection.stats_instrumented = True
+
+
+def new_view_stats():
+    stats = dict([(c, 0) for c in COUNTERS])
+    # the last bucket is for the slower requests
+    stats['latency'] = [0] * (len(UWSGI_IT_STATS_BUCKETS) + 1)
+    return stats
+
+
+def stats_key():
+    return 'stats_%s_%d' % (socket.gethostname(), os.getpid())
+
+
+def flush_stats(force=False):
+    """
+    publish the snapshot of the process (at most every UWSGI_IT_STATS_FLUSH
+    seconds), the list of the snapshots keys is in the stats_keys item.
+    Its updates are not atomic, so the membership is checked on every
+    flush: a key lost by a concurrent update (or by the eviction of the
+    list) is added again within UWSGI_IT_STATS_FLUSH seconds
+    """
+    global last_flush
+    now = time.time()
+    if not force and now - last_flush < UWSGI_IT_STATS_FLUSH:
+        return
+    last_flush = now
+    with lock:
+        snapshot = dict([(view, dict(stats, latency=list(stats['latency'])))
+                         for view, stats in views.items()])
+    try:
+        cache = get_cache(UWSGI_IT_STATS_CACHE)
+        key = stats_key()
+        cache.set(key, snapshot, UWSGI_IT_STATS_TIMEOUT)
+        keys = cache.get('stats_keys') or []
+        if key not in keys:
+            cache.set('stats_keys', keys + [key], None)
+    except:
+        logger.exception('unable to publish the stats')
+
+
+def collect_stats():
+    """
+    merge the snapshots of all of the processes
+    """
+    cache = get_cache(UWSGI_IT_STATS_CACHE)
+    keys = cache.get('stats_keys') or []
+    snapshots = cache.get_many(keys)
+    # forget the expired snapshots (of dead processes), a live process
+    # dropped by a concurrent registration will add itself again
+    if len(snapshots) < len(keys):
+        cache.set('stats_keys', [k for k in keys if k in snapshots], None)
+    merged = {}
+    for snapshot in snapshots.values():
+        for view, stats in snapshot.items():
+            total = merged.setdefault(view, new_view_stats())
+            for c in COUNTERS:
+                total[c] += stats.get(c, 0)
+            total['latency'] = [a + b for a, b in zip(total['latency'],
+                                                      stats['latency'])]
+    return {'processes': len(snapshots), 'buckets': UWSGI_IT_STATS_BUCKETS,
+            'views': merged}
+
+
+class StatsMiddleware(object):
+    """
+    per view latency histogram, queries, cache lookups, auth time and
+    response size. Each process aggregates its requests in memory and
+    publishes a snapshot in the cache every UWSGI_IT_STATS_FLUSH seconds
+    (see /private/stats/). Put it first in MIDDLEWARE_CLASSES
+    """
+
+    def process_request(self, request):
+        instrument_connections()
+        local.current = dict([(c, 0) for c in COUNTERS])
+        request.stats_start = time.time()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.stats_view = view_func.__name__
+
+    def process_exception(self, request, exception):
+        counters = current()
+        if counters is not None:
+            counters['exceptions'] += 1
+
+    def process_response(self, request, response):
+        counters = current()
+        local.current = None
+        if counters is None or not hasattr(request, 'stats_start'):
+            return response
+        elapsed = time.time() - request.stats_start
+        # 404 and the requests rejected by the middlewares
+        view = getattr(request, 'stats_view', 'unresolved')
+        counters['requests'] = 1
+        counters['time'] = elapsed
+        if response.status_code >= 500:
+            counters['errors'] = 1
+        if response.has_header('Content-Length'):
+            counters['bytes'] = int(response['Content-Length'])
+        elif not response.streaming:
+            counters['bytes'] = len(response.content)
+        bucket = bisect.bisect_left(UWSGI_IT_STATS_BUCKETS, elapsed)
+        with lock:
+            stats = views.get(view)
+            if stats is None:
+                stats = views[view] = new_view_stats()
+            for c in COUNTERS:
+                stats[c] += counters[c]
+            stats['latency'][bucket] += 1
+        flush_stats()
+        return response
@@ -1,14 +1,46 @@
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.cache import get_cache
 from django.contrib.sessions.backends.base import SessionBase
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection, IntegrityError
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.test import TestCase
 from django.test.client import RequestFactory
 from uwsgi_it_api.views import *
 from uwsgi_it_api.views_metrics import *
 from uwsgi_it_api.views_private import *
+from uwsgi_it_api.utils import rate_limit, RawJSON, dns_check, dns_check_key, \
+    parse_tags_query, tags_query
+from uwsgi_it_api.placement import placement_candidates, Fleet, plan_rebalance
+from uwsgi_it_api.firewall import server_ruleset
+from uwsgi_it_api.alerts import evaluate_alerts
+from uwsgi_it_api.anomaly import numpy, score_matrix, detect_anomalies
+from uwsgi_it_api.accounting import account_usage
+import uwsgi_it_api.stats
+import uwsgi_it_api.accounting
+import uwsgi_it_api.profiling
+from uwsgi_it_api.config import UWSGI_IT_ALARMS_CACHE, UWSGI_IT_AUTH_CACHE, \
+    UWSGI_IT_FIREWALL_CACHE, UWSGI_IT_DNS_CACHE, \
+    UWSGI_IT_METRICS_CACHE, UWSGI_IT_ALERTS_CACHE, UWSGI_IT_STATS_CACHE
+from uwsgi_it_api.decorators import cached_authenticate, make_api_token
+import uwsgi_it_api.decorators
+import uwsgi_it_api.views
+import uwsgi_it_api.views_private
+
+from StringIO import StringIO
+from email.utils import parsedate_tz
 
 import base64
 import datetime
+import gzip
+import ipaddress
+import itertools
 import json
+import marshal
+import time
+import unittest
+import zlib
 
 
 class FakeSession(SessionBase):
@@ -158,6 +190,11 @@ class ViewsTest(TestCase):
             kwargs = {}
         return view(request, **kwargs)
 
+    def response_json(self, response):
+        if response.streaming:
+            return json.loads(''.join(response.streaming_content))
+        return json.loads(response.content)
+
 
 class ApiTest(ViewsTest):
     def test_me(self):
@@ -214,28 +251,40 @@ class ApiTest(ViewsTest):
         self.assertEqual(response.status_code, 200)
 
     def test_containers_per_domain(self):
-        yesterday = today - datetime.timedelta(1)
-        HitsDomainMetric.objects.create(
-            domain=self.domain,
-            container=self.container,
-            year=yesterday.year,
-            month=yesterday.month,
-            day=yesterday.day,
-        )
+        yesterday = datetime.datetime.now() - datetime.timedelta(1, -60)
+        DomainContainer.seen(self.domain.pk, self.container.pk, yesterday)
         response = self.logged_get_response_for_view('domains/1/containers', containers_per_domain, {'id': self.domain.pk})
         self.assertEqual(response.status_code, 200)
+        self.assertEqual([c['uid'] for c in self.response_json(response)],
+                         [self.c_uid])
+        response = self.logged_get_response_for_view(
+            'domains/1/containers', containers_per_domain,
+            {'id': self.domain.pk}, {'since': int(time.time())})
+        self.assertEqual(self.response_json(response), [])
 
     def test_domains_in_container(self):
-        yesterday = today - datetime.timedelta(1)
-        HitsDomainMetric.objects.create(
-            domain=self.domain,
-            container=self.container,
-            year=yesterday.year,
-            month=yesterday.month,
-            day=yesterday.day,
-        )
-        response = self.logged_get_response_for_view('container/1/domains', domains_in_container, {'id': self.container.pk})
+        last_week = datetime.datetime.now() - datetime.timedelta(7)
+        DomainContainer.seen(self.domain.pk, self.container.pk, last_week)
+        response = self.logged_get_response_for_view('container/1/domains', domains_in_container, {'id': self.c_uid})
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.response_json(response), [])
+        response = self.logged_get_response_for_view(
+            'container/1/domains', domains_in_container, {'id': self.c_uid},
+            {'since': int(last_week.strftime('%s')) - 60})
+        self.assertEqual([d['id'] for d in self.response_json(response)],
+                         [self.domain.pk])
+
+    def test_domain_container_seen(self):
+        now = datetime.datetime.now().replace(microsecond=0)
+        DomainContainer.seen(self.domain.pk, self.container.pk, now)
+        DomainContainer.seen(self.domain.pk, self.container.pk,
+                             now - datetime.timedelta(1))
+        DomainContainer.seen(self.domain.pk, self.container.pk,
+                             now + datetime.timedelta(1))
+        dc = DomainContainer.objects.get(domain=self.domain,
+                                         container=self.container)
+        self.assertEqual(dc.first_seen, now - datetime.timedelta(1))
+        self.assertEqual(dc.last_seen, now + datetime.timedelta(1))
 
     def test_loopboxes(self):
         response = self.logged_get_response_for_view('/loopboxes', loopboxes)
@@ -280,7 +329,7 @@ class ApiTest(ViewsTest):
         response = self.logged_get_response_for_view('/alarms/', alarms,
                                                      params={'range': '6'})
         self.assertEqual(response.status_code, 200)
-        a = json.loads(response.content)
+        a = self.response_json(response)
         self.assertEqual(len(a), 6)
         for i in range(0, 6):
             self.assertEqual(a[i]['id'], self.alarms[9 - i].id)
@@ -306,7 +355,7 @@ class ApiTest(ViewsTest):
         response = self.logged_get_response_for_view('/alarms/', alarms,
                                                      params={'range': '3-6'})
         self.assertEqual(response.status_code, 200)
-        a = json.loads(response.content)
+        a = self.response_json(response)
         self.assertEqual(len(a), 3)
         for i in range(0, 3):
             self.assertEqual(a[i]['id'], self.alarms[6 - i].id)
@@ -315,11 +364,233 @@ class ApiTest(ViewsTest):
         response = self.logged_get_response_for_view('/alarms/', alarms,
                                                      params={'range': '6-3'})
         self.assertEqual(response.status_code, 200)
-        a = json.loads(response.content)
+        a = self.response_json(response)
         self.assertEqual(len(a), 3)
         for i in range(0, 3):
             self.assertEqual(a[i]['id'], self.alarms[3 + i].id)
 
+    def test_alarms_aggregation(self):
+        self.container.alarm_aggregation = 60
+        self.container.save()
+        for i in range(0, 3):
+            a = Alarm(container=self.container, msg='crash %d' % i, level=2,
+                      _class='crash', func='main', filename='app.py', line=17,
+                      unix=datetime.datetime.now())
+            a.save()
+        response = self.logged_get_response_for_view('/alarms/', alarms,
+                                                     params={'class': 'crash'})
+        a = self.response_json(response)
+        self.assertEqual(len(a), 1)
+        self.assertEqual(a[0]['count'], 3)
+        self.assertEqual(a[0]['msg'], 'crash 2')
+        self.assertEqual(self.container.alarm_set.count(), 11)
+
+    def test_alarms_aggregation_late_alarm(self):
+        self.container.alarm_aggregation = 60
+        self.container.save()
+        now = datetime.datetime.now().replace(microsecond=0)
+        for i, unix in enumerate((now, now - datetime.timedelta(seconds=10))):
+            a = Alarm(container=self.container, msg='crash %d' % i, level=2,
+                      _class='crash', unix=unix)
+            a.save()
+        a = Alarm.objects.get(pk=a.pk)
+        self.assertEqual(a.count, 2)
+        # the late alarm does not move the aggregated one backwards
+        self.assertEqual(a.unix, now)
+        self.assertEqual(a.msg, 'crash 0')
+        self.assertEqual(a.first_seen, now - datetime.timedelta(seconds=10))
+
+    def test_alarms_without_aggregation(self):
+        for i in range(0, 3):
+            a = Alarm(container=self.container, msg='crash', level=2,
+                      _class='crash', unix=datetime.datetime.now())
+            a.save()
+        response = self.logged_get_response_for_view('/alarms/', alarms,
+                                                     params={'class': 'crash'})
+        a = self.response_json(response)
+        self.assertEqual(len(a), 3)
+        self.assertEqual(a[0]['count'], 1)
+
+    def test_raise_alarm_rate_limit(self):
+        get_cache(UWSGI_IT_ALARMS_CACHE).clear()
+        rate = uwsgi_it_api.views.UWSGI_IT_ALARMS_RATE
+        uwsgi_it_api.views.UWSGI_IT_ALARMS_RATE = 2
+        try:
+            for i in range(0, 3):
+                request = self.factory.post(
+                    '/alarms/raise/{}'.format(self.c_uid), 'alarm',
+                    content_type='text/plain',
+                    HTTP_AUTHORIZATION=self.basic_auth)
+                request.session = FakeSession()
+                response = raise_alarm(request, self.c_uid)
+        finally:
+            uwsgi_it_api.views.UWSGI_IT_ALARMS_RATE = rate
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response['Retry-After']) > 0)
+        self.assertEqual(self.container.alarm_set.count(), 12)
+
+    def test_alarms_rate_limit_shared(self):
+        get_cache(UWSGI_IT_ALARMS_CACHE).clear()
+        rate = uwsgi_it_api.views.UWSGI_IT_ALARMS_RATE
+        uwsgi_it_api.views.UWSGI_IT_ALARMS_RATE = 1
+        uwsgi_it_api.views_private.UWSGI_IT_ALARMS_RATE = 1
+        try:
+            request = self.factory.post(
+                '/private/alarms/{}'.format(self.c_uid), 'alarm',
+                content_type='text/plain', HTTPS_DN='hithere',
+                REMOTE_ADDR=self.server_address)
+            response = private_alarms(request, str(self.c_uid))
+            self.assertEqual(response.status_code, 201)
+            # the private api used the container budget
+            request = self.factory.post(
+                '/alarms/raise/{}'.format(self.c_uid), 'alarm',
+                content_type='text/plain',
+                HTTP_AUTHORIZATION=self.basic_auth)
+            request.session = FakeSession()
+            response = raise_alarm(request, str(self.c_uid))
+        finally:
+            uwsgi_it_api.views.UWSGI_IT_ALARMS_RATE = rate
+            uwsgi_it_api.views_private.UWSGI_IT_ALARMS_RATE = rate
+        self.assertEqual(response.status_code, 429)
+
+    def test_alarms_rate_limit_foreign_container(self):
+        get_cache(UWSGI_IT_ALARMS_CACHE).clear()
+        other = User.objects.create_user(username='other', password='other')
+        Customer.objects.create(user=other)
+        rate = uwsgi_it_api.views.UWSGI_IT_ALARMS_RATE
+        uwsgi_it_api.views.UWSGI_IT_ALARMS_RATE = 1
+        try:
+            # another customer can not drain the budget of the container
+            for uid in (self.c_uid, str(self.c_uid), '0%d' % self.c_uid):
+                request = self.factory.post(
+                    '/alarms/raise/{}'.format(uid), 'alarm',
+                    content_type='text/plain', HTTP_AUTHORIZATION='basic %s' %
+                    base64.b64encode('other:other'))
+                request.session = FakeSession()
+                response = raise_alarm(request, uid)
+                self.assertEqual(response.status_code, 403)
+            request = self.factory.post(
+                '/alarms/raise/{}'.format(self.c_uid), 'alarm',
+                content_type='text/plain',
+                HTTP_AUTHORIZATION=self.basic_auth)
+            request.session = FakeSession()
+            response = raise_alarm(request, str(self.c_uid))
+            self.assertEqual(response.status_code, 201)
+            # the same container spelled differently shares the bucket
+            request = self.factory.post(
+                '/alarms/raise/{}'.format(self.c_uid), 'alarm',
+                content_type='text/plain',
+                HTTP_AUTHORIZATION=self.basic_auth)
+            request.session = FakeSession()
+            response = raise_alarm(request, '0%d' % self.c_uid)
+        finally:
+            uwsgi_it_api.views.UWSGI_IT_ALARMS_RATE = rate
+        self.assertEqual(response.status_code, 429)
+
+    def test_alarms_stream_resumes_from_last_event_id(self):
+        headers = {
+            'HTTP_AUTHORIZATION': self.basic_auth,
+            'HTTP_LAST_EVENT_ID': str(self.alarms[5].id),
+        }
+        request = self.factory.get('/alarms/stream', **headers)
+        request.session = FakeSession()
+        response = alarms_stream(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = list(itertools.islice(response.streaming_content, 5))
+        self.assertTrue(chunks[0].startswith('retry:'))
+        for i, chunk in enumerate(chunks[1:]):
+            self.assertTrue(chunk.startswith('id: %d\n' % self.alarms[6 + i].id))
+
+    def test_alarms_stream_aggregated_update(self):
+        self.container.alarm_aggregation = 60
+        self.container.save()
+        now = datetime.datetime.now()
+        Alarm(container=self.container, msg='crash', level=2, _class='crash',
+              unix=now).save()
+        request = self.factory.get('/alarms/stream',
+                                   HTTP_AUTHORIZATION=self.basic_auth)
+        request.session = FakeSession()
+        response = alarms_stream(request)
+        events = iter(response.streaming_content)
+        self.assertTrue(next(events).startswith('retry:'))
+        Alarm(container=self.container, msg='crash again', level=2,
+              _class='crash', unix=now + datetime.timedelta(seconds=1)).save()
+        chunk = next(events)
+        response.close()
+        self.assertTrue(chunk.startswith('event: update\n'))
+        alarm = json.loads(chunk.split('data: ', 1)[1])
+        self.assertEqual((alarm['msg'], alarm['count']), ('crash again', 2))
+
+    def test_alarms_stream_max(self):
+        get_cache(UWSGI_IT_ALARMS_CACHE).clear()
+        streams_max = uwsgi_it_api.views.UWSGI_IT_ALARMS_STREAM_MAX
+        uwsgi_it_api.views.UWSGI_IT_ALARMS_STREAM_MAX = 1
+        try:
+            first = self.logged_get_response_for_view('/alarms/stream',
+                                                      alarms_stream)
+            self.assertEqual(first.status_code, 200)
+            response = self.logged_get_response_for_view('/alarms/stream',
+                                                         alarms_stream)
+            self.assertEqual(response.status_code, 429)
+            self.assertTrue(int(response['Retry-After']) > 0)
+            # the limit is per customer
+            other = User.objects.create_user(username='other', password='other')
+            Customer.objects.create(user=other)
+            request = self.factory.get('/alarms/stream', HTTP_AUTHORIZATION='Basic %s' %
+                                       base64.b64encode('other:other'))
+            request.session = FakeSession()
+            response = alarms_stream(request)
+            self.assertEqual(response.status_code, 200)
+            response.close()
+            # the slot is released by closing the response
+            first.close()
+            response = self.logged_get_response_for_view('/alarms/stream',
+                                                         alarms_stream)
+            self.assertEqual(response.status_code, 200)
+            response.close()
+        finally:
+            uwsgi_it_api.views.UWSGI_IT_ALARMS_STREAM_MAX = streams_max
+
+    def test_alarms_poll(self):
+        get_cache(UWSGI_IT_ALARMS_CACHE).clear()
+        self.container.alarm_aggregation = 60
+        self.container.save()
+        now = datetime.datetime.now()
+        Alarm(container=self.container, msg='crash', level=2, _class='crash',
+              unix=now).save()
+        j = self.response_json(self.logged_get_response_for_view(
+            '/alarms/poll', alarms_poll))
+        self.assertEqual((j['alarms'], j['updates']), ([], []))
+        last_id = j['last_id']
+        Alarm(container=self.container, msg='crash again', level=2,
+              _class='crash', unix=now + datetime.timedelta(seconds=1)).save()
+        Alarm(container=self.container, msg='new', level=2,
+              unix=now + datetime.timedelta(seconds=1)).save()
+        j = self.response_json(self.logged_get_response_for_view(
+            '/alarms/poll', alarms_poll,
+            params={'last_id': last_id, 'unix': j['unix'], 'seq': j['seq']}))
+        self.assertEqual([a['msg'] for a in j['alarms']], ['new'])
+        self.assertEqual([(a['msg'], a['count']) for a in j['updates']],
+                         [('crash again', 2)])
+        self.assertEqual(j['last_id'], j['alarms'][0]['id'])
+        # nothing changed, the database is not queried
+        request = self.factory.get('/alarms/poll', {
+            'last_id': j['last_id'], 'unix': j['unix'], 'seq': j['seq']},
+            HTTP_AUTHORIZATION=self.basic_auth)
+        request.session = FakeSession()
+        with CaptureQueriesContext(connection) as queries:
+            response = alarms_poll(request)
+        self.assertEqual(self.response_json(response)['alarms'], [])
+        self.assertFalse([q for q in queries.captured_queries
+                          if 'uwsgi_it_api_alarm' in q['sql']])
+
+    def test_alarms_stream_forbidden_container(self):
+        response = self.logged_get_response_for_view('/alarms/stream',
+                                                     alarms_stream,
+                                                     params={'container': '1'})
+        self.assertEqual(response.status_code, 403)
+
     def test_tags(self):
         response = self.logged_get_response_for_view('/tags', tags)
         self.assertEqual(response.status_code, 200)
@@ -370,6 +641,60 @@ class ApiTest(ViewsTest):
             {'id': self.c_uid})
         self.assertEqual(response.status_code, 200)
 
+    def test_metrics_past_day_cache(self):
+        get_cache(UWSGI_IT_METRICS_CACHE).clear()
+        yesterday = datetime.datetime.today() - datetime.timedelta(1)
+        CPUContainerMetric.objects.create(
+            container=self.container, year=yesterday.year,
+            month=yesterday.month, day=yesterday.day,
+            json=json.dumps([[i, i] for i in range(0, 288)]))
+        params = {'year': yesterday.year, 'month': yesterday.month,
+                  'day': yesterday.day}
+        self.factory.defaults['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        response = self.logged_get_response_for_view(
+            '/metrics/container.cpu/1', metrics_container_cpu,
+            {'id': self.c_uid}, params=params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue('immutable' in response['Cache-Control'])
+        body = gzip.GzipFile(fileobj=StringIO(response.content)).read()
+        self.assertEqual(len(json.loads(body)), 288)
+        self.factory.defaults['HTTP_IF_NONE_MATCH'] = response['ETag']
+        response = self.logged_get_response_for_view(
+            '/metrics/container.cpu/1', metrics_container_cpu,
+            {'id': self.c_uid}, params=params)
+        self.assertEqual(response.status_code, 304)
+
+    def test_metrics_today_not_immutable(self):
+        response = self.logged_get_response_for_view(
+            '/metrics/container.cpu/1', metrics_container_cpu,
+            {'id': self.c_uid})
+        self.assertEqual(response['Cache-Control'], 'private, max-age=300')
+
+    def test_metrics_future_day_not_immutable(self):
+        tomorrow = datetime.date.today() + datetime.timedelta(1)
+        response = self.logged_get_response_for_view(
+            '/metrics/container.cpu/1', metrics_container_cpu,
+            {'id': self.c_uid}, params={'year': tomorrow.year,
+                                        'month': tomorrow.month,
+                                        'day': tomorrow.day})
+        self.assertEqual(response['Cache-Control'], 'private, max-age=300')
+
+    def test_metrics_missing_day_cached(self):
+        get_cache(UWSGI_IT_METRICS_CACHE).clear()
+        day = datetime.date.today() - datetime.timedelta(2)
+        params = {'year': day.year, 'month': day.month, 'day': day.day}
+        response = self.logged_get_response_for_view(
+            '/metrics/container.cpu/1', metrics_container_cpu,
+            {'id': self.c_uid}, params=params)
+        self.assertEqual(json.loads(response.content), [])
+        self.assertTrue('immutable' in response['Cache-Control'])
+        # Expires agrees with max-age
+        self.assertTrue(parsedate_tz(response['Expires'])[0] > day.year)
+        entry = get_cache(UWSGI_IT_METRICS_CACHE).get(
+            'cpu_%d_%d_%d_%d' % (self.c_uid, day.year, day.month, day.day))
+        self.assertEqual(entry['json'], '[]')
+
     def test_domain_net_rx(self):
         response = self.logged_get_response_for_view(
             '/metrics/domain.net.txt/1', metrics_domain_net_rx,
@@ -389,6 +714,933 @@ class ApiTest(ViewsTest):
         self.assertEqual(response.status_code, 200)
 
 
+class ServerCountersTest(ViewsTest):
+    def reload_server(self):
+        return Server.objects.get(pk=self.server.pk)
+
+    def test_counters(self):
+        self.assertEqual(self.reload_server().used_memory, 20)
+        self.assertEqual(self.reload_server().used_storage, 20)
+        self.container.memory = 30
+        self.container.save()
+        self.assertEqual(self.reload_server().used_memory, 40)
+        self.container2.delete()
+        self.assertEqual(self.reload_server().used_memory, 30)
+        self.assertEqual(self.reload_server().used_storage, 10)
+
+    def test_move(self):
+        server2 = Server.objects.create(name='server2', address='10.0.0.2',
+                                        hd='hd', memory=100, storage=100)
+        self.container.server = server2
+        self.container.save()
+        self.assertEqual(self.reload_server().used_memory, 10)
+        self.assertEqual(Server.objects.get(pk=server2.pk).used_memory, 10)
+
+    def test_overcommit(self):
+        container = Container(customer=self.customer, server=self.server,
+                              memory=81, storage=10, name='big')
+        self.assertRaises(ValidationError, container.save)
+        self.assertEqual(self.reload_server().used_memory, 20)
+        self.container.storage = 91
+        self.assertRaises(ValidationError, self.container.save)
+        self.assertEqual(self.reload_server().used_storage, 20)
+
+    def test_server_save_keeps_counters(self):
+        server = self.server
+        Container.objects.create(customer=self.customer, server=server,
+                                 memory=5, storage=5, name='other')
+        server.note = 'note'
+        server.save()
+        self.assertEqual(self.reload_server().used_memory, 25)
+
+    def test_reconcile_servers(self):
+        Server.objects.filter(pk=self.server.pk).update(allocated_memory=99)
+        call_command('reconcile_servers', stdout=StringIO())
+        self.assertEqual(self.reload_server().used_memory, 20)
+
+
+class DirtyFieldsTest(ViewsTest):
+    def test_changed_fields(self):
+        container = Container.objects.get(pk=self.container.pk)
+        self.assertEqual(container.changed_fields(), [])
+        container.note = 'note'
+        container.memory = 15
+        self.assertEqual(sorted(container.changed_fields()),
+                         ['memory', 'note'])
+
+    def test_save_without_select(self):
+        container = Container.objects.get(pk=self.container.pk)
+        last_reboot = container.last_reboot
+        container.note = 'note'
+        with CaptureQueriesContext(connection) as queries:
+            container.save()
+        sql = [q['sql'] for q in queries.captured_queries]
+        self.assertFalse([q for q in sql if 'SELECT' in q])
+        self.assertEqual(len([q for q in sql if 'UPDATE "uwsgi_it_api_container"' in q]), 1)
+        self.assertFalse([q for q in sql if '"name"' in q])
+        container = Container.objects.get(pk=self.container.pk)
+        self.assertEqual(container.note, 'note')
+        self.assertEqual(container.last_reboot, last_reboot)
+
+    def test_reboot_and_ssh_keys(self):
+        container = Container.objects.get(pk=self.container.pk)
+        container.ssh_keys_raw = 'ssh-rsa AAAA'
+        container.save()
+        container = Container.objects.get(pk=self.container.pk)
+        self.assertNotEqual(container.ssh_keys_mtime, start_of_epoch())
+        self.assertEqual(container.last_reboot, start_of_epoch())
+        container.memory = 15
+        container.save()
+        self.assertNotEqual(Container.objects.get(pk=self.container.pk).last_reboot,
+                            start_of_epoch())
+        self.assertEqual(Server.objects.get(pk=self.server.pk).used_memory, 25)
+
+    def test_not_loaded(self):
+        container = Container(pk=self.container.pk, name='renamed',
+                              customer=self.customer, server=self.server,
+                              memory=20, storage=10)
+        self.assertEqual(container.loaded_values()['memory'], 10)
+        self.assertIn('name', container.changed_fields())
+        self.assertIn('memory', container.changed_fields())
+        self.assertNotIn('server', container.changed_fields())
+
+
+class ContainersBulkTest(ViewsTest):
+    def bulk(self, j):
+        request = self.factory.post('/containers/bulk', json.dumps(j),
+                                    content_type='application/json',
+                                    HTTP_AUTHORIZATION=self.basic_auth)
+        response = containers_bulk(request)
+        self.assertEqual(response.status_code, 200)
+        return self.response_json(response)['results']
+
+    def test_shared_patch(self):
+        other = User.objects.create_user(username='other', password='other')
+        foreign = Container.objects.create(
+            customer=Customer.objects.create(user=other), server=self.server,
+            memory=10, storage=10, name='foreign')
+        results = self.bulk({'containers': [self.c_uid, self.container2.uid,
+                                            foreign.uid],
+                             'patch': {'note': 'bulk', 'tags': ['tag']}})
+        self.assertEqual([r['status'] for r in results], [200, 200, 403])
+        for c in (self.container, self.container2):
+            c = Container.objects.get(pk=c.pk)
+            self.assertEqual(c.note, 'bulk')
+            self.assertEqual([t.name for t in c.tags.all()], ['tag'])
+            # note is not a reboot field
+            self.assertEqual(c.last_reboot, start_of_epoch())
+        self.assertEqual(Container.objects.get(pk=foreign.pk).note, None)
+
+    def test_per_uid_patch(self):
+        results = self.bulk({'patch': {'reboot': True},
+                             'patches': {
+                                 str(self.c_uid): {'name': 'renamed'},
+                                 str(self.container2.uid): {'alarm_freq': 'x'},
+                             }})
+        self.assertEqual([r['status'] for r in results], [200, 400])
+        container = Container.objects.get(pk=self.container.pk)
+        self.assertEqual(container.name, 'renamed')
+        self.assertNotEqual(container.last_reboot, start_of_epoch())
+        container2 = Container.objects.get(pk=self.container2.pk)
+        self.assertEqual(container2.last_reboot, start_of_epoch())
+
+    def test_invalid_values(self):
+        results = self.bulk({'patches': {
+            str(self.c_uid): {'link': 'x', 'note': 'bulk'},
+            str(self.container2.uid): {'distro': 'unknown'},
+        }})
+        self.assertEqual([(r['uid'], r['status']) for r in results],
+                         [(self.c_uid, 400), (self.container2.uid, 400)])
+        self.assertEqual(results[0]['error'], 'invalid link')
+        self.assertEqual(results[1]['error'], 'unknown distro')
+        self.assertEqual(Container.objects.get(pk=self.container.pk).note, None)
+        results = self.bulk({'containers': [self.c_uid],
+                             'patch': {'unlink': None, 'tags': 'tag'}})
+        self.assertEqual(results[0]['status'], 400)
+        request = self.factory.post('/containers/bulk', json.dumps(
+            {'patches': {str(self.c_uid): 'x'}}),
+            content_type='application/json',
+            HTTP_AUTHORIZATION=self.basic_auth)
+        self.assertEqual(containers_bulk(request).status_code, 400)
+
+    def test_link(self):
+        results = self.bulk({'containers': [self.c_uid],
+                             'patch': {'link': self.container2.uid}})
+        self.assertEqual(results[0]['status'], 200)
+        self.assertEqual(Container.objects.get(pk=self.container.pk).linked_to,
+                         [self.container2.uid])
+        results = self.bulk({'containers': [self.c_uid],
+                             'patch': {'link': self.container2.uid}})
+        self.assertEqual(results[0]['status'], 409)
+        results = self.bulk({'containers': [self.c_uid],
+                             'patch': {'unlink': self.container2.uid}})
+        self.assertEqual(results[0]['status'], 200)
+        self.assertEqual(Container.objects.get(pk=self.container.pk).linked_to, [])
+
+
+class FirewallTest(ViewsTest):
+    def setUp(self):
+        super(FirewallTest, self).setUp()
+        get_cache(UWSGI_IT_FIREWALL_CACHE).clear()
+        self.server2 = Server.objects.create(name='server2', address='10.0.0.2',
+                                             hd='hd', memory=100, storage=100)
+        self.container3 = Container.objects.create(
+            customer=self.customer, server=self.server2, memory=10, storage=10,
+            name='container3')
+
+    def rules(self):
+        return server_ruleset(self.server.pk)['containers'][self.c_uid]
+
+    def test_compile(self):
+        ContainerLink.objects.create(container=self.container, to=self.container2)
+        ContainerLink.objects.create(container=self.container, to=self.container3)
+        for src in ('192.168.0.128/25', '192.168.0.0/25'):
+            Rule.objects.create(container=self.container, direction='in',
+                                src=src, dst='0.0.0.0', action='allow')
+        ip, ip2, ip3 = self.container.ip, self.container2.ip, self.container3.ip
+        # the two adjacent sources are collapsed
+        sources = ipaddress.collapse_addresses([ipaddress.ip_network(ip2),
+                                                ipaddress.ip_network(ip3)])
+        self.assertEqual(self.rules(), [
+            'in %s %s/32 allow' % (n, ip) for n in sources] + [
+            'out %s/32 %s/32 allow' % (ip, ip2),
+            'out %s/32 %s/32 gateway 10.0.0.2:999' % (ip, ip3),
+            'in 10.0.0.0/8 0.0.0.0 deny',
+            'out 0.0.0.0 10.0.0.0/8 deny',
+            'in 192.168.0.0/24 0.0.0.0 allow'])
+
+    def test_invalidation(self):
+        version = server_ruleset(self.server.pk)['version']
+        with self.assertNumQueries(0):
+            self.assertEqual(server_ruleset(self.server.pk)['version'], version)
+        self.container.note = 'note'
+        self.container.save()
+        self.assertEqual(server_ruleset(self.server.pk)['version'], version)
+        link = ContainerLink.objects.create(container=self.container,
+                                            to=self.container3)
+        self.assertNotEqual(server_ruleset(self.server.pk)['version'], version)
+        # moving the linked container turns the gateway rule into an allow one
+        self.container3.server = self.server
+        self.container3.save()
+        self.assertIn('out %s/32 %s/32 allow' % (self.container.ip,
+                                                 self.container3.ip),
+                      self.rules())
+        link.delete()
+        self.assertEqual(len(self.rules()), 2)
+
+    def test_private_firewall(self):
+        response = self.logged_get_response_for_view('/private/firewall/',
+                                                     private_firewall)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.response_json(response)['containers'][str(self.c_uid)],
+                         self.rules())
+        request = self.factory.get('/private/firewall/', HTTPS_DN='hithere',
+                                   REMOTE_ADDR=self.server_address,
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(private_firewall(request).status_code, 304)
+
+    def test_vassal_ini(self):
+        self.container.distro = Distro.objects.create(name='distro', path='distro')
+        self.container.ssh_keys_raw = 'ssh-rsa AAAA'
+        self.container.save()
+        response = self.logged_get_response_for_view(
+            '/private/containers/%d.ini' % self.c_uid, private_container_ini,
+            {'id': self.c_uid})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('tuntap-device-rule = out 0.0.0.0 10.0.0.0/8 deny\n',
+                      response.content)
+        self.assertEqual(response['Content-Type'], 'text/plain')
+
+    def test_generate_ini(self):
+        out = StringIO()
+        call_command('generate_ini', str(self.c_uid), stdout=out)
+        self.assertIn('tuntap-device-rule = in 10.0.0.0/8 0.0.0.0 deny\n',
+                      out.getvalue())
+        self.assertIn('tuntap-device-rule = out 0.0.0.0 10.0.0.0/8 deny\n',
+                      out.getvalue())
+
+    def test_secret_uuids(self):
+        self.container.distro = Distro.objects.create(name='distro', path='distro')
+        self.container.ssh_keys_raw = 'ssh-rsa AAAA'
+        self.container.save()
+        request = self.factory.get('/private/secret_uuids/', HTTPS_DN='hithere',
+                                   REMOTE_ADDR='10.0.0.9')
+        self.assertEqual(private_privileged_secret_uuids(request).status_code,
+                         403)
+        PrivilegedClient.objects.create(name='monitor', address='10.0.0.9')
+        response = private_privileged_secret_uuids(request)
+        self.assertTrue(response.streaming)
+        self.assertEqual(json.loads(''.join(response.streaming_content)), [{
+            'uid': self.c_uid, 'mtime': self.container.munix,
+            'secret_uuid': self.container.secret_uuid,
+            'address': self.server_address}])
+
+
+class StubResolver(object):
+    def __init__(self, records):
+        self.records = records
+        self.nameservers = ['127.0.0.53']
+
+    def query(self, name, rdtype):
+        if (name, rdtype) not in self.records:
+            raise Exception('NXDOMAIN')
+        return self.records[(name, rdtype)]
+
+
+class DomainCheckTest(ViewsTest):
+    def setUp(self):
+        super(DomainCheckTest, self).setUp()
+        get_cache(UWSGI_IT_DNS_CACHE).clear()
+
+    def post_domain(self, name):
+        request = self.factory.post('/domains', json.dumps({'name': name}),
+                                    content_type='application/json',
+                                    HTTP_AUTHORIZATION=self.basic_auth)
+        return domains(request)
+
+    def test_dns_check(self):
+        resolver = StubResolver({
+            ('www.example.com', 'NS'): ['ns1.example.com.', 'ns2.example.com.'],
+            ('ns2.example.com.', 'A'): ['127.0.0.2'],
+            ('example.com', 'TXT'): ['"uwsgi:%s"' % self.customer.uuid],
+        })
+        self.assertTrue(dns_check('www.example.com', self.customer.uuid,
+                                  resolver))
+        self.assertEqual(resolver.nameservers, ['127.0.0.2'])
+        self.assertFalse(dns_check('www.example.com', 'other', resolver))
+        self.assertFalse(dns_check('example.org', self.customer.uuid,
+                                   StubResolver({})))
+
+    def test_background_check(self):
+        response = self.post_domain('example.com')
+        self.assertEqual(response.status_code, 202)
+        check = self.response_json(response)
+        self.assertEqual(check['status'], 'pending')
+        self.assertFalse(Domain.objects.filter(name='example.com'))
+        get_cache(UWSGI_IT_DNS_CACHE).set(
+            dns_check_key('example.com', self.customer.uuid), True)
+        call_command('check_domains', stdout=StringIO())
+        domain = Domain.objects.get(name='example.com')
+        response = self.logged_get_response_for_view(
+            '/domains/checks/%d' % check['id'], domain_checks,
+            {'id': check['id']})
+        check = self.response_json(response)
+        self.assertEqual(check['status'], 'verified')
+        self.assertEqual(check['domain'], domain.pk)
+
+    def test_cached_result(self):
+        cache = get_cache(UWSGI_IT_DNS_CACHE)
+        cache.set(dns_check_key('example.com', self.customer.uuid), False)
+        self.assertEqual(self.post_domain('example.com').status_code, 403)
+        cache.set(dns_check_key('example.com', self.customer.uuid), True)
+        self.assertEqual(self.post_domain('example.com').status_code, 201)
+
+
+class AlertsTest(ViewsTest):
+    def setUp(self):
+        super(AlertsTest, self).setUp()
+        get_cache(UWSGI_IT_ALERTS_CACHE).clear()
+        Alarm.objects.filter(container=self.container).delete()
+
+    def test_memory_rule(self):
+        AlertRule.objects.create(container=self.container,
+                                 metric='container.mem', relative_to='memory',
+                                 threshold=80, clear_threshold=70,
+                                 duration=20, cooldown=100)
+        mb = 1024 * 1024
+        unix = int(time.time())
+        samples = [(0, 9), (10, 9), (20, 9), (30, 9), (40, 7.5), (50, 6),
+                   (60, 9), (80, 9), (100, 9), (120, 9)]
+        fired = [t for t, value in samples if evaluate_alerts(
+            self.container, 'container.mem', unix + t, value * mb, None)]
+        # pending for 20 seconds, no re-arm before the clear threshold and
+        # the cooldown are reached
+        self.assertEqual(fired, [20, 120])
+        self.assertEqual(Alarm.objects.filter(container=self.container,
+                                              _class__startswith='alert.'
+                                              ).count(), 2)
+        # other metrics do not touch the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(evaluate_alerts(self.container, 'container.cpu',
+                                             unix, 1, 1), [])
+
+    def test_quota_ingest(self):
+        QuotaContainerMetric.objects.all().delete()
+        unix = int(time.time())
+        for i, percent in enumerate((95, 96, 80, 95)):
+            request = self.factory.post(
+                '/private/metrics/container.quota/1',
+                json.dumps({'unix': unix + i, 'value':
+                            self.container.quota * percent / 100}),
+                content_type='application/json', HTTPS_DN='hithere',
+                REMOTE_ADDR=self.server_address)
+            response = private_metrics_container_quota(request, self.c_uid)
+            self.assertEqual(response.status_code, 201)
+        # the last one is in the cooldown period
+        self.assertEqual(list(Alarm.objects.filter(
+            container=self.container).values_list('_class', flat=True)),
+            ['alert.quota'])
+
+    def test_alert_rules_api(self):
+        request = self.factory.post(
+            '/alert_rules/%d' % self.c_uid,
+            json.dumps({'metric': 'container.cpu', 'field': 'rate',
+                        'relative_to': 'cpu', 'threshold': 90,
+                        'duration': 300}),
+            content_type='application/json',
+            HTTP_AUTHORIZATION=self.basic_auth)
+        response = alert_rules(request, self.c_uid)
+        self.assertEqual(response.status_code, 201)
+        rule = self.response_json(response)
+        self.assertEqual(rule['container'], self.c_uid)
+        unix = int(time.time())
+        self.assertEqual(evaluate_alerts(self.container, 'container.cpu',
+                                         unix, 0, 0.95 * 1000000000), [])
+        self.assertTrue(evaluate_alerts(self.container, 'container.cpu',
+                                        unix + 300, 0, 0.95 * 1000000000))
+        # cpu percents need the rate
+        request = self.factory.post(
+            '/alert_rules/%d' % self.c_uid,
+            json.dumps({'metric': 'container.cpu', 'relative_to': 'cpu',
+                        'threshold': 90}),
+            content_type='application/json',
+            HTTP_AUTHORIZATION=self.basic_auth)
+        self.assertEqual(alert_rules(request, self.c_uid).status_code, 403)
+        request = self.factory.delete('/alert_rule/%d' % rule['id'],
+                                      HTTP_AUTHORIZATION=self.basic_auth)
+        self.assertEqual(alert_rule(request, rule['id']).status_code, 200)
+        self.assertFalse(AlertRule.objects.filter(pk=rule['id']))
+
+
+class TagsQueryTest(ViewsTest):
+    def setUp(self):
+        super(TagsQueryTest, self).setUp()
+        web, prod, staging = [Tag.objects.create(customer=self.customer, name=n)
+                              for n in ('web', 'prod', 'staging')]
+        self.container.tags.add(web, prod)
+        self.container2.tags.add(web, prod, staging)
+        self.container3 = Container.objects.create(
+            customer=self.customer, server=self.server, memory=10, storage=10,
+            name='container3')
+        self.container3.tags.add(staging)
+
+    def query(self, expr):
+        return sorted(Container.objects.filter(
+            tags_query(Container, self.customer, expr)).values_list(
+            'pk', flat=True))
+
+    def test_parse(self):
+        self.assertEqual(parse_tags_query('web+prod,-staging'),
+                         ([(['web', 'prod'], [])], ['staging']))
+        self.assertEqual(parse_tags_query('web prod -staging,db'),
+                         ([(['web', 'prod'], ['staging']), (['db'], [])], []))
+
+    def test_query(self):
+        c1, c2, c3 = self.container.pk, self.container2.pk, self.container3.pk
+        self.assertEqual(self.query('web,staging'), [c1, c2, c3])
+        self.assertEqual(self.query('web+prod'), [c1, c2])
+        self.assertEqual(self.query('web+prod,-staging'), [c1])
+        self.assertEqual(self.query('-web'), [c3])
+        self.assertEqual(self.query('prod,staging+-web'), [c1, c2, c3])
+        self.assertEqual(self.query('web+unknown'), [])
+        for expr in ('', ',', ' + ', '-'):
+            self.assertEqual(self.query(expr), [])
+        with self.assertNumQueries(1):
+            self.query('web+prod,staging,-tag')
+
+    def test_listing(self):
+        response = self.logged_get_response_for_view(
+            '/containers', containers, params={'tags': 'web prod,-staging'})
+        self.assertEqual([c['uid'] for c in self.response_json(response)],
+                         [self.c_uid])
+        response = self.logged_get_response_for_view(
+            '/loopboxes', loopboxes, params={'tags': 'tag,-tag'})
+        self.assertEqual(self.response_json(response), [])
+        response = self.logged_get_response_for_view(
+            '/containers', containers, params={'tags': ''})
+        self.assertEqual(self.response_json(response), [])
+
+
+@unittest.skipIf(numpy is None, 'numpy is not available')
+class AnomalyTest(ViewsTest):
+    def test_score_matrix(self):
+        matrix = numpy.array([[10.0, 11, 9, 10, 10, 11, 9, 10, 30, 31],
+                              [10.0, 11, 9, 10, 10, 11, 9, 10, 10, 11],
+                              [numpy.nan] * 10])
+        for method in ('mad', 'ewma'):
+            score, baseline, current = score_matrix(matrix, 2, method, 4)
+            self.assertTrue(score[0] > 6)
+            self.assertTrue(abs(score[1]) < 6)
+            self.assertTrue(numpy.isnan(score[2]))
+
+    def test_detect_anomalies(self):
+        step = 300
+        now = int(time.time())
+        now -= now % step
+        start = now - 86400
+        Alarm.objects.filter(container=self.container).delete()
+        MemoryContainerMetric.objects.all().delete()
+        for container, last in ((self.container, 5000),
+                                (self.container2, 1000)):
+            samples = [[t, 1000 + (t // step) % 3]
+                       for t in range(start, now, step)]
+            samples.append([now + 1, last])
+            days = {}
+            for t, value in samples:
+                d = datetime.date.fromtimestamp(t)
+                days.setdefault(d, []).append([t, value])
+            for d, values in days.items():
+                MemoryContainerMetric.objects.create(
+                    container=container, year=d.year, month=d.month, day=d.day,
+                    json=json.dumps(values))
+        anomalies = detect_anomalies(days=1, step=step, window=1,
+                                     processes=1, now=now + 1)
+        self.assertEqual([(a['container'], a['metric']) for a in anomalies],
+                         [(self.container.pk, 'container.mem')])
+        call_command('detect_anomalies', days=1, window=1, processes=2,
+                     alarms=True, stdout=StringIO())
+        self.assertEqual(list(Alarm.objects.filter(
+            container=self.container).values_list('_class', flat=True)),
+            ['anomaly.container.mem'])
+
+
+class AccountingTest(ViewsTest):
+    def ledger(self, field):
+        return sum(UsageLedger.objects.filter(
+            customer=self.customer).values_list(field, flat=True))
+
+    def test_month_slices(self):
+        self.assertEqual(list(month_slices(datetime.datetime(2014, 12, 31, 23),
+                                           datetime.datetime(2015, 1, 1, 2))),
+                         [(2014, 12, 1.0), (2015, 1, 2.0)])
+
+    def test_account_usage(self):
+        now = datetime.datetime.now().replace(microsecond=0)
+        base = now - datetime.timedelta(hours=3)
+        # new containers are accounted since their creation
+        ContainerAccounting.objects.filter(
+            container__customer=self.customer).update(until=base)
+        LatestContainerMetric.store(self.container.pk, 'container.cpu', 1,
+                                    2000000000, None)
+        account_usage(base + datetime.timedelta(hours=1))
+        self.assertEqual(self.ledger('memory_hours'), 20)
+        self.assertEqual(self.ledger('cpu_seconds'), 2)
+        # resizes and deletions account the previous allocation
+        self.container.memory = 20
+        self.container.save()
+        self.assertAlmostEqual(self.ledger('memory_hours'), 40, delta=0.1)
+        self.container2.delete()
+        self.assertAlmostEqual(self.ledger('memory_hours'), 60, delta=0.1)
+        # the cpu counter has been reset by a reboot
+        LatestContainerMetric.store(self.container.pk, 'container.cpu', 2,
+                                    1000000000, None)
+        account_usage()
+        self.assertAlmostEqual(self.ledger('memory_hours'), 60, delta=0.1)
+        self.assertEqual(self.ledger('cpu_seconds'), 3)
+
+        response = self.logged_get_response_for_view('/usage', usage)
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(sum([r['storage_hours'] for r in
+                                    self.response_json(response)]),
+                               60, delta=0.1)
+
+    def test_account_usage_starts_at_first_run(self):
+        now = datetime.datetime.now().replace(microsecond=0)
+        Container.objects.filter(customer=self.customer).update(
+            ctime=now - datetime.timedelta(days=30))
+        # containers created before the accounting was enabled
+        ContainerAccounting.objects.all().delete()
+        LatestContainerMetric.store(self.container.pk, 'container.cpu', 1,
+                                    5000000000, None)
+        self.assertEqual(account_usage(now), 0)
+        self.assertEqual(ContainerAccounting.objects.get(
+            container=self.container).cpu, 5000000000)
+        account_usage(now + datetime.timedelta(hours=1))
+        self.assertEqual(self.ledger('memory_hours'), 20)
+        self.assertEqual(self.ledger('cpu_seconds'), 0)
+
+    def test_delete_flushes_counters(self):
+        base = datetime.datetime.now() - datetime.timedelta(hours=1)
+        ContainerAccounting.objects.filter(container=self.container2).update(
+            until=base, net_rx=1000)
+        LatestContainerMetric.store(self.container2.pk, 'container.net.rx', 1,
+                                    3000, None)
+        self.container2.delete()
+        self.assertEqual(self.ledger('net_rx'), 2000)
+        self.assertAlmostEqual(self.ledger('memory_hours'), 10, delta=0.1)
+
+    def test_stale_state(self):
+        base = datetime.datetime.now() - datetime.timedelta(hours=2)
+        ContainerAccounting.objects.update(until=base)
+        stale = list(ContainerAccounting.objects.all())
+
+        class StaleManager(object):
+            # the states as read by account_usage before the resize
+            def all(self):
+                return stale
+
+            def __getattr__(self, attr):
+                return getattr(ContainerAccounting.objects, attr)
+
+        self.container.memory = 20
+        self.container.save()
+        self.assertAlmostEqual(self.ledger('memory_hours'), 20, delta=0.1)
+        accounting = uwsgi_it_api.accounting.ContainerAccounting
+        uwsgi_it_api.accounting.ContainerAccounting = type(
+            'StaleAccounting', (object,), {'objects': StaleManager()})
+        try:
+            account_usage()
+        finally:
+            uwsgi_it_api.accounting.ContainerAccounting = accounting
+        # only container2 has been accounted again
+        self.assertAlmostEqual(self.ledger('memory_hours'), 40, delta=0.1)
+
+
+@override_settings(MIDDLEWARE_CLASSES=['uwsgi_it_api.stats.StatsMiddleware'])
+class StatsTest(ViewsTest):
+    def setUp(self):
+        super(StatsTest, self).setUp()
+        get_cache(UWSGI_IT_STATS_CACHE).clear()
+        get_cache(UWSGI_IT_AUTH_CACHE).clear()
+        uwsgi_it_api.stats.views.clear()
+
+    def test_stats(self):
+        for i in range(2):
+            response = self.client.get('/me/', HTTP_AUTHORIZATION=self.basic_auth)
+            self.assertEqual(response.status_code, 200)
+        self.client.get('/nowhere/')
+        self.assertEqual(self.client.get('/private/stats/', HTTPS_DN='hithere',
+                                         REMOTE_ADDR='10.0.0.9').status_code, 403)
+        PrivilegedClient.objects.create(name='monitor', address='10.0.0.9')
+        response = self.client.get('/private/stats/', HTTPS_DN='hithere',
+                                   REMOTE_ADDR='10.0.0.9')
+        stats = self.response_json(response)
+        self.assertEqual(stats['processes'], 1)
+        me = stats['views']['me']
+        self.assertEqual(me['requests'], 2)
+        self.assertEqual(sum(me['latency']), 2)
+        self.assertTrue(me['queries'] > 0 and me['bytes'] > 0)
+        self.assertTrue(me['auth_time'] > 0)
+        # the second request found the credentials in the auth cache
+        self.assertEqual((me['cache_hits'], me['cache_misses']), (1, 1))
+        self.assertEqual(stats['views']['unresolved']['requests'], 1)
+        self.assertEqual(stats['views']['private_stats']['requests'], 1)
+
+    def test_registration(self):
+        cache = get_cache(UWSGI_IT_STATS_CACHE)
+        uwsgi_it_api.stats.flush_stats(force=True)
+        # the list has been evicted (or overwritten by another process)
+        cache.delete('stats_keys')
+        self.assertEqual(uwsgi_it_api.stats.collect_stats()['processes'], 0)
+        uwsgi_it_api.stats.flush_stats(force=True)
+        self.assertEqual(uwsgi_it_api.stats.collect_stats()['processes'], 1)
+
+
+@override_settings(MIDDLEWARE_CLASSES=['uwsgi_it_api.profiling.ProfileMiddleware'])
+class ProfileTest(ViewsTest):
+    def get_me(self, **extra):
+        return self.client.get('/me/', HTTP_AUTHORIZATION=self.basic_auth, **extra)
+
+    def test_header(self):
+        response = self.get_me(HTTP_X_UWSGI_IT_PROFILE='cprofile', HTTPS_DN='hithere')
+        self.assertFalse(response.has_header('X-uWSGI-it-Profile'))
+        PrivilegedClient.objects.create(name='monitor', address='127.0.0.1')
+        response = self.get_me(HTTP_X_UWSGI_IT_PROFILE='cprofile', HTTPS_DN='hithere')
+        self.assertEqual(response.status_code, 200)
+        pk = int(response['X-uWSGI-it-Profile'])
+        profile = self.response_json(self.client.get('/private/profiles/%d' % pk,
+                                                     HTTPS_DN='hithere'))
+        self.assertEqual((profile['view'], profile['mode']), ('me', 'cprofile'))
+        self.assertTrue('cumulative' in profile['report'])
+        self.assertTrue([q for q in profile['sql'] if 'uwsgi_it_api_customer' in q[0]])
+        data = self.client.get('/private/profiles/%d.prof' % pk, HTTPS_DN='hithere').content
+        self.assertTrue(marshal.loads(data))
+
+        response = self.get_me(HTTP_X_UWSGI_IT_PROFILE='sampler', HTTPS_DN='hithere')
+        self.assertEqual(RequestProfile.objects.get(
+            pk=response['X-uWSGI-it-Profile']).mode, 'sampler')
+
+    def test_sampling(self):
+        uwsgi_it_api.profiling.seen.clear()
+        sample = uwsgi_it_api.profiling.UWSGI_IT_PROFILE_SAMPLE
+        uwsgi_it_api.profiling.UWSGI_IT_PROFILE_SAMPLE = {'me': 2}
+        try:
+            for i in range(4):
+                self.get_me()
+        finally:
+            uwsgi_it_api.profiling.UWSGI_IT_PROFILE_SAMPLE = sample
+        self.assertEqual(list(RequestProfile.objects.values_list('trigger', flat=True)),
+                         ['sample', 'sample'])
+
+
+class PlacementTest(ViewsTest):
+    def setUp(self):
+        super(PlacementTest, self).setUp()
+        self.small = Server.objects.create(name='small', address='10.0.1.1',
+                                           hd='hd', memory=100, storage=100,
+                                           owner=self.customer)
+        self.big = Server.objects.create(name='big', address='10.0.1.2',
+                                         hd='hd', memory=1000, storage=1000,
+                                         owner=self.customer)
+
+    def post_container(self, j):
+        request = self.factory.post('/containers', json.dumps(j),
+                                    content_type='application/json',
+                                    HTTP_AUTHORIZATION=self.basic_auth)
+        return containers(request)
+
+    def test_best_fit(self):
+        self.assertEqual(placement_candidates(50, 50, owner=self.customer),
+                         [self.small.pk, self.big.pk])
+        self.assertEqual(placement_candidates(500, 50, owner=self.customer),
+                         [self.big.pk])
+        self.assertEqual(placement_candidates(10, 10), [self.server.pk])
+
+    def test_weight(self):
+        Server.objects.filter(pk=self.big.pk).update(weight=10000)
+        self.assertEqual(placement_candidates(50, 50, owner=self.customer),
+                         [self.big.pk, self.small.pk])
+
+    def test_anti_affinity(self):
+        container = Container.objects.create(customer=self.customer,
+                                             server=self.small, memory=10,
+                                             storage=10, name='web1')
+        container.tags.add(self.tag)
+        self.assertEqual(placement_candidates(10, 10, owner=self.customer,
+                                              customer=self.customer,
+                                              anti_affinity='tag'),
+                         [self.big.pk])
+
+    def test_server_auto(self):
+        response = self.post_container({'server': 'auto', 'name': 'auto',
+                                        'memory': 500, 'storage': 10})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.content)['server_address'],
+                         self.big.address)
+        response = self.post_container({'server': 'auto', 'name': 'auto2',
+                                        'memory': 600, 'storage': 10})
+        self.assertEqual(response.status_code, 409)
+
+    def test_plan_rebalance(self):
+        Container.objects.create(customer=self.customer, server=self.big,
+                                 memory=300, storage=10, name='c1')
+        c2 = Container.objects.create(customer=self.customer, server=self.big,
+                                      memory=60, storage=10, name='c2')
+        fleet = Fleet(Server.objects.filter(owner=self.customer))
+        self.assertEqual(fleet.largest_hole(), (640, 980))
+        self.assertEqual(plan_rebalance(fleet, 600, 10), [])
+        steps = plan_rebalance(fleet, 700, 10)
+        self.assertEqual(len(steps), 1)
+        self.assertEqual(steps[0]['container'], c2.uid)
+        self.assertEqual(steps[0]['to'], 'small')
+        self.assertEqual(steps[0]['to_utilization'], (60, 10))
+        self.assertEqual(steps[0]['largest_hole'], (700, 990))
+        self.assertEqual(plan_rebalance(fleet, 2000, 10), None)
+        # the plan is not applied
+        self.assertEqual(Container.objects.get(pk=c2.pk).server, self.big)
+
+
+class ApiTokenTest(ViewsTest):
+    def token_get(self, token, view, kwargs):
+        request = self.factory.get('/', HTTP_AUTHORIZATION='Bearer %s' % token)
+        return view(request, **kwargs)
+
+    def test_tokens_mint(self):
+        request = self.factory.post('/tokens', json.dumps(
+            {'scope': 'metrics', 'container': self.c_uid}),
+            content_type='application/json',
+            HTTP_AUTHORIZATION=self.basic_auth)
+        request.session = FakeSession()
+        response = tokens(request)
+        self.assertEqual(response.status_code, 201)
+        token = self.response_json(response)['token']
+        response = self.token_get(token, metrics_container_cpu,
+                                  {'id': self.c_uid})
+        self.assertEqual(response.status_code, 200)
+
+    def test_token_container_scope(self):
+        token = make_api_token(self.customer, 'metrics', self.container)
+        response = self.token_get(token, metrics_container_cpu,
+                                  {'id': self.container2.uid})
+        self.assertEqual(response.status_code, 403)
+        response = self.token_get(token, containers, {})
+        self.assertEqual(response.status_code, 403)
+
+    def test_token_read_scope(self):
+        token = make_api_token(self.customer, 'read')
+        response = self.token_get(token, containers, {})
+        self.assertEqual(response.status_code, 200)
+        request = self.factory.post('/alarms/raise/{}'.format(self.c_uid),
+                                    'alarm', content_type='text/plain',
+                                    HTTP_AUTHORIZATION='Bearer %s' % token)
+        response = raise_alarm(request, self.c_uid)
+        self.assertEqual(response.status_code, 403)
+
+    def test_token_revocation(self):
+        token = make_api_token(self.customer, 'all')
+        self.assertEqual(self.token_get(token, me, {}).status_code, 200)
+        self.customer.token_version += 1
+        self.customer.save()
+        self.assertEqual(self.token_get(token, me, {}).status_code, 401)
+
+    def test_token_expiration(self):
+        token = make_api_token(self.customer, 'all', expires=-1)
+        self.assertEqual(self.token_get(token, me, {}).status_code, 401)
+        self.assertEqual(self.token_get(token + 'x', me, {}).status_code, 401)
+
+    def test_tokens_bad_expires(self):
+        request = self.factory.post('/tokens', json.dumps(
+            {'scope': 'all', 'expires': 'tomorrow'}),
+            content_type='application/json',
+            HTTP_AUTHORIZATION=self.basic_auth)
+        request.session = FakeSession()
+        self.assertEqual(tokens(request).status_code, 400)
+
+    def test_token_alarm_key(self):
+        key = self.container.alarm_key
+        token = make_api_token(self.customer, 'read')
+        response = self.token_get(token, alarm_key, {'id': self.c_uid})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Container.objects.get(pk=self.container.pk).alarm_key,
+                         key)
+
+    def test_token_user_deactivated(self):
+        get_cache(UWSGI_IT_AUTH_CACHE).clear()
+        token = make_api_token(self.customer, 'all')
+        self.assertEqual(self.token_get(token, me, {}).status_code, 200)
+        request = self.factory.get('/', HTTP_AUTHORIZATION='Bearer %s' % token)
+        # the token version is cached, the user is loaded by pk
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(api_auth(request), self.user)
+        self.assertEqual(len(queries), 1)
+        # bulk updates do not send signals
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.token_get(token, me, {}).status_code, 401)
+
+
+class SessionlessTest(ViewsTest):
+    def count_writes(self):
+        request = self.factory.get('/distros', HTTP_AUTHORIZATION=self.basic_auth)
+        request.session = SessionStore()
+        with CaptureQueriesContext(connection) as ctx:
+            response = distros(request)
+        self.assertEqual(response.status_code, 200)
+        writes = ('INSERT INTO', 'UPDATE "', 'DELETE FROM')
+        return len([q for q in ctx.captured_queries if
+                    any(w in q['sql'] for w in writes)])
+
+    def test_sessionless_auth_does_not_write(self):
+        self.assertEqual(self.count_writes(), 0)
+
+    def test_session_auth_writes(self):
+        uwsgi_it_api.decorators.UWSGI_IT_API_SESSIONS = True
+        try:
+            # session row (and the cleanup of the cycled one) + last_login
+            self.assertEqual(self.count_writes(), 3)
+        finally:
+            uwsgi_it_api.decorators.UWSGI_IT_API_SESSIONS = False
+
+
+class SpitJsonTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_small_body_not_compressed(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        response = spit_json(request, {'message': 'Ok'})
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(json.loads(response.content), {'message': 'Ok'})
+
+    def test_gzip(self):
+        j = [{'id': i, 'msg': 'test'} for i in range(0, 200)]
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='deflate, gzip')
+        response = spit_json(request, j)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        body = gzip.GzipFile(fileobj=StringIO(response.content)).read()
+        self.assertEqual(json.loads(body), j)
+
+    def test_deflate_when_gzip_refused(self):
+        j = [{'id': i, 'msg': 'test'} for i in range(0, 200)]
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+        response = spit_json(request, j)
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(response.content)), j)
+
+    def test_raw_unicode(self):
+        request = self.factory.get('/')
+        response = spit_json(request, u'caf\xe8', raw=True,
+                             content_type='text/plain')
+        self.assertEqual(response.content, 'caf\xc3\xa8')
+        self.assertEqual(response['Content-Length'], '5')
+
+    def test_stream(self):
+        request = self.factory.get('/', HTTP_USER_AGENT='curl/7.0')
+        j = (i for i in [RawJSON('{"raw": true}'), {'id': 1}])
+        response = spit_json(request, j)
+        self.assertTrue(response.streaming)
+        body = ''.join(response.streaming_content)
+        self.assertEqual(body, '[{"raw": true},{"id": 1}]\n')
+
+    def test_stream_gzip(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        response = spit_json(request, iter(range(0, 10000)))
+        body = ''.join(response.streaming_content)
+        body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        self.assertEqual(json.loads(body), range(0, 10000))
+
+
+class RateLimitTest(TestCase):
+    def test_rate_limit(self):
+        cache = get_cache('default')
+        cache.clear()
+        for i in range(0, 5):
+            self.assertEqual(rate_limit(cache, 'test', 5, 60), 0)
+        self.assertTrue(rate_limit(cache, 'test', 5, 60) > 0)
+        # rejected hits do not consume tokens
+        self.assertEqual(cache.get('test_%d' % (int(time.time()) // 60)), 5)
+        self.assertEqual(rate_limit(cache, 'other', 5, 60), 0)
+
+
+class AuthCacheTest(TestCase):
+    def setUp(self):
+        get_cache(UWSGI_IT_AUTH_CACHE).clear()
+        self.user = User.objects.create_user(
+            username='test', email='test@uwsgi.it', password='top_secret')
+        self.authenticate = uwsgi_it_api.decorators.authenticate
+        self.calls = []
+
+        def counting_authenticate(**credentials):
+            self.calls.append(credentials['username'])
+            return self.authenticate(**credentials)
+        uwsgi_it_api.decorators.authenticate = counting_authenticate
+
+    def tearDown(self):
+        uwsgi_it_api.decorators.authenticate = self.authenticate
+
+    def test_cached_authenticate_skips_hasher(self):
+        self.assertEqual(cached_authenticate('test', 'top_secret'), self.user)
+        self.assertEqual(cached_authenticate('test', 'top_secret'), self.user)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(cached_authenticate('test', 'wrong'), None)
+
+    def test_cached_authenticate_password_change(self):
+        cached_authenticate('test', 'top_secret')
+        self.user.set_password('new_secret')
+        self.user.save()
+        self.assertEqual(cached_authenticate('test', 'top_secret'), None)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_cached_authenticate_deactivation(self):
+        cached_authenticate('test', 'top_secret')
+        self.user.is_active = False
+        self.user.save()
+        user = cached_authenticate('test', 'top_secret')
+        self.assertFalse(user and user.is_active)
+        self.assertEqual(len(self.calls), 2)
+
+
 class PrivateViewsTest(ViewsTest):
     def test_containers(self):
         response = self.logged_get_response_for_view('/private/containers/',
@@ -480,3 +1732,186 @@ class PrivateViewsTest(ViewsTest):
             {'id': self.c_uid})
         self.assertEqual(response.status_code, 405)
 
+    def test_container_cpu_ingest_json(self):
+        CPUContainerMetric.objects.all().delete()
+        unix = int(time.time())
+        request = self.factory.post(
+            '/private/metrics/container.cpu/1',
+            json.dumps({'unix': unix, 'value': 100}),
+            content_type='application/json', HTTPS_DN='hithere',
+            REMOTE_ADDR=self.server_address)
+        response = private_metrics_container_cpu(request, self.c_uid)
+        self.assertEqual(response.status_code, 201)
+        m = CPUContainerMetric.objects.get(container=self.container)
+        self.assertEqual(json.loads(m.json), [[unix, 100]])
+        # container metrics do not touch the domains association
+        self.assertFalse(DomainContainer.objects.filter(
+            container=self.container).exists())
+
+    def test_domain_hits_ingest(self):
+        unix = int(time.time())
+        request = self.factory.post(
+            '/private/metrics/domain.hits/1',
+            json.dumps({'unix': unix, 'value': 17, 'domain': 'domain'}),
+            content_type='application/json', HTTPS_DN='hithere',
+            REMOTE_ADDR=self.server_address)
+        response = private_metrics_domain_hits(request, self.c_uid)
+        self.assertEqual(response.status_code, 201)
+        dc = DomainContainer.objects.get(domain=self.domain,
+                                         container=self.container)
+        self.assertEqual(dc.last_seen, datetime.datetime.fromtimestamp(unix))
+
+    def test_domain_ingest_deleted_domain(self):
+        ghost = Domain.objects.create(customer=self.customer, name='ghost')
+        customer_domains(self.customer.pk)
+        # deleted by another process, still in our process cache
+        Domain.objects.filter(pk=ghost.pk).delete()
+        customer_domains_local[self.customer.pk] = (
+            time.time() + 60, {'domain': self.domain.pk, 'ghost': ghost.pk})
+        seen = DomainContainer.seen
+
+        def seen_fk(domain_id, container_id, when):
+            # sqlite does not enforce foreign keys
+            if domain_id == ghost.pk:
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            seen(domain_id, container_id, when)
+        DomainContainer.seen = staticmethod(seen_fk)
+        unix = int(time.time())
+        try:
+            request = self.factory.post(
+                '/private/metrics/domain.net.rx/1',
+                json.dumps([{'unix': unix, 'value': 17, 'domain': 'domain'},
+                            {'unix': unix, 'value': 17, 'domain': 'ghost'}]),
+                content_type='application/json', HTTPS_DN='hithere',
+                REMOTE_ADDR=self.server_address)
+            response = private_metrics_domain_net_rx(request, self.c_uid)
+        finally:
+            DomainContainer.seen = staticmethod(seen)
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('ghost', customer_domains_local[self.customer.pk][1])
+        # the failed attempt has been rolled back
+        m = NetworkRXDomainMetric.objects.get(domain=self.domain,
+                                              container=self.container)
+        self.assertEqual(json.loads(m.json), [[unix, 17]])
+        self.assertFalse(NetworkRXDomainMetric.objects.filter(
+            domain=ghost.pk).exists())
+
+    def test_domain_metrics_same_timestamp(self):
+        unix = int(time.time())
+        for view in (private_metrics_domain_net_rx, private_metrics_domain_net_tx):
+            request = self.factory.post(
+                '/private/metrics/domain/1',
+                json.dumps({'unix': unix, 'value': 17, 'domain': 'domain'}),
+                content_type='application/json', HTTPS_DN='hithere',
+                REMOTE_ADDR=self.server_address)
+            with CaptureQueriesContext(connection) as queries:
+                response = view(request, self.c_uid)
+            self.assertEqual(response.status_code, 201)
+        # the second metric only updates the association, no failing INSERT
+        sql = [q['sql'] for q in queries.captured_queries
+               if '"uwsgi_it_api_domaincontainer"' in q['sql']]
+        self.assertEqual(len(sql), 1)
+        self.assertTrue(sql[0].startswith('QUERY = u\'UPDATE'))
+        dc = DomainContainer.objects.get(domain=self.domain,
+                                         container=self.container)
+        self.assertEqual(dc.last_seen, datetime.datetime.fromtimestamp(unix))
+
+    def test_container_cpu_ingest(self):
+        CPUContainerMetric.objects.all().delete()
+        unix = int(time.time())
+        for i, value in enumerate((100, 400)):
+            request = self.factory.post(
+                '/private/metrics/container.cpu/1',
+                json.dumps({'unix': unix + i * 10, 'value': value}),
+                content_type='application/json', HTTPS_DN='hithere',
+                REMOTE_ADDR=self.server_address)
+            response = private_metrics_container_cpu(request, self.c_uid)
+            self.assertEqual(response.status_code, 201)
+        latest = LatestContainerMetric.objects.get(container=self.container,
+                                                   metric='container.cpu')
+        self.assertEqual((latest.unix, latest.value, latest.rate),
+                         (unix + 10, 400, 30.0))
+        # older values do not replace the latest one
+        LatestContainerMetric.store(self.container.pk, 'container.cpu',
+                                    unix, 1, None)
+        self.assertEqual(LatestContainerMetric.objects.get(
+            pk=latest.pk).value, 400)
+
+        request = self.factory.get('/metrics/latest',
+                                   HTTP_AUTHORIZATION=self.basic_auth)
+        with CaptureQueriesContext(connection) as queries:
+            response = metrics_latest(request)
+        # no query on the metrics tables
+        self.assertFalse([q for q in queries.captured_queries
+                          if 'cpucontainermetric' in q['sql']])
+        self.assertEqual(self.response_json(response), [
+            {'uid': self.c_uid, 'metrics': {'container.cpu': {
+                'unix': unix + 10, 'value': 400, 'rate': 30.0}}}])
+
+    def test_metrics_export(self):
+        LatestContainerMetric.objects.all().delete()
+        self.container.tags.add(Tag.objects.create(customer=self.customer,
+                                                   name='web'))
+        unix = int(time.time())
+        LatestContainerMetric.store(self.container.pk, 'container.cpu', unix,
+                                    400, 30.0)
+        LatestContainerMetric.store(self.container.pk, 'container.mem', unix,
+                                    1024, None)
+        request = self.factory.post(
+            '/private/metrics/domain.hits/1',
+            json.dumps([{'unix': unix, 'value': 3, 'domain': 'domain'}]),
+            content_type='application/json', HTTPS_DN='hithere',
+            REMOTE_ADDR=self.server_address)
+        self.assertEqual(private_metrics_domain_hits(request, self.c_uid).status_code, 201)
+
+        request = self.factory.get('/private/metrics/export', HTTPS_DN='hithere',
+                                   REMOTE_ADDR=self.server_address)
+        # the client lookups and four queries, whatever the number of containers
+        with self.assertNumQueries(6):
+            response = private_metrics_export(request)
+        self.assertTrue(response['Content-Type'].startswith('application/openmetrics-text'))
+        labels = 'uid="%d",hostname="container",server="server",tags="tag,web"' % self.c_uid
+        self.assertEqual(response.content.split('\n'), [
+            '# TYPE uwsgi_it_container_cpu_nanoseconds counter',
+            '# HELP uwsgi_it_container_cpu_nanoseconds cpu time used by the container',
+            'uwsgi_it_container_cpu_nanoseconds_total{%s} 400 %d' % (labels, unix),
+            '# TYPE uwsgi_it_container_memory_bytes gauge',
+            '# HELP uwsgi_it_container_memory_bytes memory used by the container',
+            'uwsgi_it_container_memory_bytes{%s} 1024 %d' % (labels, unix),
+            '# TYPE uwsgi_it_domain_hits gauge',
+            '# HELP uwsgi_it_domain_hits hits of the domain in the last period',
+            'uwsgi_it_domain_hits{domain="domain",%s} 3 %d' % (labels, unix),
+            '# EOF', ''])
+        # customers only see their containers
+        other = User.objects.create_user(username='other', password='other')
+        Customer.objects.create(user=other)
+        request = self.factory.get('/metrics/export', HTTP_AUTHORIZATION='basic %s' % (
+            base64.b64encode('other:other')))
+        self.assertEqual(metrics_export(request).content, '# EOF\n')
+
+    def test_domain_hits_batch(self):
+        domain2 = Domain.objects.create(customer=self.customer, name='domain2')
+        unix = int(time.time())
+        samples = [{'unix': unix, 'value': 1, 'domain': 'domain2'},
+                   {'unix': unix + 1, 'value': 2, 'domain': 'domain2'},
+                   {'unix': unix, 'value': 3, 'domain': 'unknown'}]
+
+        def post():
+            request = self.factory.post(
+                '/private/metrics/domain.hits/1', json.dumps(samples),
+                content_type='application/json', HTTPS_DN='hithere',
+                REMOTE_ADDR=self.server_address)
+            return private_metrics_domain_hits(request, self.c_uid)
+
+        self.assertEqual(post().status_code, 201)
+        m = HitsDomainMetric.objects.get(domain=domain2)
+        self.assertEqual(json.loads(m.json), [[unix, 1], [unix + 1, 2]])
+        # the names are resolved by the caches (even the unknown one)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(post().status_code, 201)
+        self.assertFalse([q for q in queries.captured_queries
+                          if '"uwsgi_it_api_domain"' in q['sql']])
+        domain2.delete()
+        samples.pop()
+        self.assertEqual(post().status_code, 404)
+
@@ -4,6 +4,10 @@ urlpatterns = patterns('uwsgi_it_api.views_private',
     (r'^private/containers/$', 'private_containers'),
     (r'^private/containers/(\d+)\.ini$', 'private_container_ini'),
     (r'^private/ssh_keys/(\d+)$', 'private_container_ssh_keys'),
+    (r'^private/firewall/$', 'private_firewall'),
+    (r'^private/stats/$', 'private_stats'),
+    (r'^private/profiles/$', 'private_profiles'),
+    (r'^private/profiles/(\d+)(?:\.prof)?$', 'private_profiles'),
     (r'^private/legion/nodes/$', 'private_legion_nodes'),
     (r'^private/nodes/$', 'private_nodes'),
     (r'^private/domains/rsa/$', 'private_domains_rsa'),
@@ -23,6 +27,7 @@ urlpatterns = patterns('uwsgi_it_api.views_private',
     (r'^private/metrics/domain.net.rx/(\d+)$', 'private_metrics_domain_net_rx'),
     (r'^private/metrics/domain.net.tx/(\d+)$', 'private_metrics_domain_net_tx'),
     (r'^private/metrics/domain.hits/(\d+)$', 'private_metrics_domain_hits'),
+    (r'^private/metrics/export$', 'private_metrics_export'),
 
     (r'^private/alarms/(\d+)$', 'private_alarms'),
 
@@ -38,6 +43,7 @@ urlpatterns += patterns('uwsgi_it_api.views',
 
     (r'^me/containers/?$', 'containers'),
     (r'^containers/?$', 'containers'),
+    (r'^containers/bulk$', 'containers_bulk'),
     (r'^containers/(\d+)$', 'container'),
     (r'^containers/(\d+)/domains$', 'domains_in_container'),
 
@@ -49,8 +55,12 @@ urlpatterns += patterns('uwsgi_it_api.views',
 
     (r'^custom_distros/(\d+)?$', 'custom_distros'),
     (r'^custom_distro/(\d+)?$', 'custom_distro'),
+    (r'^alert_rules/(\d+)?$', 'alert_rules'),
+    (r'^alert_rule/(\d+)$', 'alert_rule'),
+    (r'^usage/?$', 'usage'),
 
     (r'^domains/?$', 'domains'),
+    (r'^domains/checks/(\d+)?$', 'domain_checks'),
     (r'^domains/(\d+)$', 'domain'),
     (r'^domains/(\d+)/containers$', 'containers_per_domain'),
 
@@ -63,14 +73,20 @@ urlpatterns += patterns('uwsgi_it_api.views',
     (r'^loopboxes/(\d+)$', 'loopbox'),
 
     (r'^alarms/?$', 'alarms'),
+    (r'^alarms/stream$', 'alarms_stream'),
+    (r'^alarms/poll$', 'alarms_poll'),
     (r'^alarms/(\d+)$', 'alarm'),
     (r'^alarms/raise/(\d+)$', 'raise_alarm'),
     (r'^alarms/trigger/(\d+)$', 'raise_alarm'),
 
     (r'^alarm_key/(\d+)$', 'alarm_key'),
+
+    (r'^tokens/?$', 'tokens'),
 )
 
 urlpatterns += patterns('uwsgi_it_api.views_metrics',
+    (r'^metrics/latest$', 'metrics_latest'),
+    (r'^metrics/export$', 'metrics_export'),
     (r'^metrics/container.io.read/(\d+)$', 'metrics_container_io_read'),
     (r'^metrics/container.io.write/(\d+)$', 'metrics_container_io_write'),
     (r'^metrics/container.net.rx/(\d+)$', 'metrics_container_net_rx'),
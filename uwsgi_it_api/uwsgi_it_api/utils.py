@@ -1,59 +1,303 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.http import http_date
+from django.utils.text import compress_string, compress_sequence
+from django.core.cache import get_cache
+from django.db.models import Q
+from uwsgi_it_api.config import UWSGI_IT_JSON_COMPRESS_MIN, UWSGI_IT_JSON_CHUNK, \
+    UWSGI_IT_DNS_CACHE, UWSGI_IT_DNS_CACHE_POSITIVE, UWSGI_IT_DNS_CACHE_NEGATIVE, \
+    UWSGI_IT_DNS_TIMEOUT, UWSGI_IT_DNS_NAMESERVERS, UWSGI_IT_DNS_PORT, \
+    UWSGI_IT_DNS_WORKERS
+from uwsgi_it_api.stats import record_cache
+from multiprocessing.pool import ThreadPool
 import dns.resolver
+import hashlib
 import json
+import math
+import operator
+import re
 import time
+import zlib
 
+try:
+    # faster (and output compatible) encoder, if available
+    import simplejson as json_encoder
+except ImportError:
+    json_encoder = json
 
-def spit_json(request, j, expires=0, raw=False):
-    if raw:
-        body = j
-    else:
-        body = json.dumps(j)
+
+class RawJSON(object):
+    """
+    an already encoded json fragment, sent as-is (it can be the whole
+    body or an item of a streamed list)
+    """
+    def __init__(self, value):
+        self.value = value
+
+
+def encode_json(j):
+    if isinstance(j, RawJSON):
+        if j.value is None:
+            return 'null'
+        return j.value
+    return json_encoder.dumps(j)
+
+
+def accepted_encoding(request):
+    encodings = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = part.strip().split(';')
+        q = 1.0
+        for param in params[1:]:
+            if param.strip().startswith('q='):
+                try:
+                    q = float(param.strip()[2:])
+                except ValueError:
+                    q = 0
+        encodings[params[0].strip().lower()] = q
+    for encoding in ('gzip', 'deflate'):
+        if encodings.get(encoding, 0) > 0:
+            return encoding
+    return None
+
+
+def deflate_sequence(sequence):
+    z = zlib.compressobj()
+    for item in sequence:
+        chunk = z.compress(item)
+        if chunk:
+            yield chunk
+    yield z.flush()
+
+
+def json_stream(iterable, tail):
+    """
+    encodes an iterable as a json list, without materializing it
+    """
+    chunk = ['[']
+    size = 1
+    first = True
+    for item in iterable:
+        if not first:
+            chunk.append(',')
+        value = encode_json(item)
+        chunk.append(value)
+        size += len(value) + 1
+        first = False
+        if size >= UWSGI_IT_JSON_CHUNK:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(']' + tail)
+    yield ''.join(chunk)
+
+
+def spit_json(request, j, expires=0, raw=False, status=200, content_type="application/json"):
+    """
+    lists, dicts and RawJSON (or strings with raw=True) are encoded in a single
+    body, iterators are streamed. Bodies are compressed if the client accepts it.
+    Raw strings can have a different content_type (e.g. text/plain)
+    """
+    tail = ''
     if 'HTTP_USER_AGENT' in request.META:
         if 'curl/' in request.META['HTTP_USER_AGENT']:
-            body += '\n'
-    response = HttpResponse(body, content_type="application/json")
+            tail = '\n'
+    if raw:
+        j = RawJSON(j)
+    encoding = accepted_encoding(request)
+    if hasattr(j, 'next'):
+        body = json_stream(j, tail)
+        if encoding == 'gzip':
+            body = compress_sequence(body)
+        elif encoding == 'deflate':
+            body = deflate_sequence(body)
+        response = StreamingHttpResponse(body, content_type=content_type)
+    else:
+        body = encode_json(j) + tail
+        # raw fragments can come from text fields
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if len(body) < UWSGI_IT_JSON_COMPRESS_MIN:
+            encoding = None
+        elif encoding == 'gzip':
+            body = compress_string(body)
+        elif encoding == 'deflate':
+            body = zlib.compress(body)
+        response = HttpResponse(body, content_type=content_type)
+        response['Content-Length'] = str(len(body))
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Vary'] = 'Accept-Encoding'
+    response.status_code = status
     if expires > 0:
         response['Expires'] = http_date(time.time() + expires)
     return response
 
 
+def rate_limit(cache, key, limit, period):
+    """
+    token bucket (of 'limit' tokens refilled every 'period' seconds) approximated
+    with two sliding windows, as the cache api only gives us atomic increments.
+    Returns 0 if the hit is allowed, otherwise the seconds to wait before retrying
+    """
+    now = time.time()
+    window = int(now // period)
+    current_key = '%s_%d' % (key, window)
+    try:
+        cache.add(current_key, 0, period * 2)
+        current = cache.incr(current_key)
+        previous = cache.get('%s_%d' % (key, window - 1)) or 0
+    except:
+        # never block on cache failures
+        return 0
+    elapsed = (now % period) / period
+    if previous * (1 - elapsed) + current <= limit:
+        return 0
+    # rejected hits do not consume tokens
+    try:
+        cache.decr(current_key)
+    except:
+        pass
+    if current > limit:
+        # wait for the next window, where the hits of the current one will still weigh
+        used = current - 1
+        wait = period - (now % period)
+        if used > 0:
+            wait += period * max(0.0, 1 - float(limit - 1) / used)
+        return int(math.ceil(wait))
+    # the moment the previous window weight leaves room for the hit
+    needed = 1 - float(limit - current) / previous
+    return max(1, int(math.ceil((needed - elapsed) * period)))
+
+
+def too_many_requests(request, retry_after):
+    response = spit_json(request, {'error': 'Too Many Requests'}, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
 def check_body(request):
     if int(request.META['CONTENT_LENGTH']) > 65536:
-        response = HttpResponse(json.dumps({'error': 'Request entity too large'}), content_type="application/json")
-        response.status_code = 413
-        return response
+        return spit_json(request, {'error': 'Request entity too large'}, status=413)
 
 
-def dns_check(name, uuid):
+def dns_resolver():
     resolver = dns.resolver.Resolver()
-    resolver.timeout = 3
+    resolver.timeout = UWSGI_IT_DNS_TIMEOUT
+    resolver.lifetime = UWSGI_IT_DNS_TIMEOUT
+    if UWSGI_IT_DNS_NAMESERVERS:
+        resolver.nameservers = list(UWSGI_IT_DNS_NAMESERVERS)
+    resolver.port = UWSGI_IT_DNS_PORT
+    return resolver
+
+
+def dns_check(name, uuid, resolver=None):
+    """
+    check for the 'uwsgi:<uuid>' TXT record in the domain (or one of its
+    parents) asking to its nameservers. Only the NS query is serial, the A
+    queries of the nameservers and the TXT queries run concurrently
+    """
+    if resolver is None:
+        resolver = dns_resolver()
     # get nameservers list (max 4)
     try:
         ns_list = resolver.query(name, 'NS')
     except:
         ns_list = []
-    if len(ns_list) > 4:
-        ns_list = ns_list[0:4]
-    servers = []
-    for ns in ns_list:
-        ns = str(ns)
-        #print ns
-        servers.append(str(resolver.query(ns, 'A')[0]))
-    if servers:
-        resolver.nameservers = servers
-
-    parts = name.split('.')
+    ns_list = [str(ns) for ns in ns_list][0:4]
 
-    while len(parts) > 1:
+    def query(args):
         try:
-            print '.'.join(parts)
-            txt_list = resolver.query('.'.join(parts), 'TXT')
+            return [str(r) for r in resolver.query(*args)]
+        except:
+            return []
+
+    parts = name.split('.')
+    names = ['.'.join(parts[i:]) for i in range(len(parts) - 1)]
+    pool = ThreadPool(max(1, min(UWSGI_IT_DNS_WORKERS, max(len(ns_list), len(names)))))
+    try:
+        servers = [a[0] for a in pool.map(query, [(ns, 'A') for ns in ns_list]) if a]
+        if servers:
+            resolver.nameservers = servers
+        for txt_list in pool.map(query, [(n, 'TXT') for n in names]):
             for txt in txt_list:
-                if 'uwsgi:%s' % uuid in str(txt):
+                if 'uwsgi:%s' % uuid in txt:
                     return True
-        except:
-            pass
-        parts = parts[1:]
+    finally:
+        pool.terminate()
     return False
+
+
+def dns_check_cached(name, uuid, resolver=None):
+    """
+    dns_check() with results cached for UWSGI_IT_DNS_CACHE_POSITIVE (or
+    UWSGI_IT_DNS_CACHE_NEGATIVE) seconds
+    """
+    cache = get_cache(UWSGI_IT_DNS_CACHE)
+    key = dns_check_key(name, uuid)
+    result = cache.get(key)
+    record_cache(result is not None)
+    if result is None:
+        result = dns_check(name, uuid, resolver)
+        if result:
+            cache.set(key, True, UWSGI_IT_DNS_CACHE_POSITIVE)
+        else:
+            cache.set(key, False, UWSGI_IT_DNS_CACHE_NEGATIVE)
+    return result
+
+
+def dns_check_key(name, uuid):
+    return 'dns_check_' + hashlib.sha1(('%s\0%s' % (name, uuid)).encode('utf8')).hexdigest()
+
+
+def parse_tags_query(expr):
+    """
+    parse a tags expression: ',' separates alternatives (OR), '+' (or a
+    space, as '+' in a query string is decoded to it) separates tags that
+    must all be present (AND), a '-' prefix negates a tag.
+    Alternatives made only of negated tags exclude the resources from the
+    whole result, so 'web+prod,-staging' is (web AND prod) AND NOT staging.
+    Returns the list of (tags, negated tags) alternatives and the list of
+    excluded tags
+    """
+    groups = []
+    exclude = []
+    for term in expr.split(','):
+        names = [n for n in re.split('[+ ]', term) if n]
+        include = [n for n in names if not n.startswith('-')]
+        negated = [n[1:] for n in names if n.startswith('-') and len(n) > 1]
+        if include:
+            groups.append((include, negated))
+        else:
+            exclude += negated
+    return groups, exclude
+
+
+def tags_query(model, customer, expr):
+    """
+    a Q object selecting the objects of model (with a 'tags' field) matching
+    the tags expression (see parse_tags_query) of the customer.
+    Each tag is a subquery on the m2m table, so the result is a single
+    query without duplicates. An empty expression matches nothing
+    """
+    through = model.tags.through
+    column = model._meta.model_name
+
+    def tagged(name):
+        return Q(pk__in=through.objects.filter(
+            tag__customer=customer, tag__name=name).values(column))
+
+    groups, exclude = parse_tags_query(expr)
+    if not groups and not exclude:
+        return Q(pk__in=[])
+    q = Q()
+    if groups:
+        alternatives = []
+        for include, negated in groups:
+            alternative = reduce(operator.and_, [tagged(n) for n in include])
+            for name in negated:
+                alternative &= ~tagged(name)
+            alternatives.append(alternative)
+        q = reduce(operator.or_, alternatives)
+    for name in exclude:
+        q &= ~tagged(name)
+    return q
@@ -1,11 +1,21 @@
-from django.http import HttpResponse, HttpResponseForbidden, \
-    HttpResponseNotFound
+from django.http import StreamingHttpResponse
+from django.core.cache import get_cache
+from django.db import connection, transaction
+from django.db.models import Q
 from django.views.decorators.csrf import csrf_exempt
 
-from uwsgi_it_api.decorators import need_basicauth, api_auth
-from uwsgi_it_api.utils import spit_json, check_body, dns_check
+from uwsgi_it_api.decorators import need_basicauth, api_auth, \
+    make_api_token, API_TOKEN_SCOPES
+from uwsgi_it_api.utils import spit_json, check_body, dns_check_key, \
+    rate_limit, too_many_requests, tags_query
 from uwsgi_it_api.models import *
-from uwsgi_it_api.config import UWSGI_IT_BASE_UID
+from uwsgi_it_api.placement import place_container
+from uwsgi_it_api.stats import report_exception
+from uwsgi_it_api.config import UWSGI_IT_BASE_UID, UWSGI_IT_ALARMS_CACHE, \
+    UWSGI_IT_ALARMS_STREAM_POLL, UWSGI_IT_ALARMS_STREAM_HEARTBEAT, \
+    UWSGI_IT_ALARMS_STREAM_TIMEOUT, UWSGI_IT_ALARMS_STREAM_MAX, \
+    UWSGI_IT_ALARMS_RATE, UWSGI_IT_ALARMS_RATE_PERIOD, \
+    UWSGI_IT_DNS_CACHE, UWSGI_IT_DOMAINS_SEEN_WINDOW
 
 import json
 import datetime
@@ -20,16 +30,14 @@ def portmappings(request, ip):
     try:
         server = Server.objects.get(address=ip, owner=customer)
     except:
-        return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                     content_type="application/json")
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     if request.method == 'POST':
         response = check_body(request)
         if response:
             return response
         j = json.loads(request.read())
         if not j:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
         pm = Portmap()
         try:
             pm.proto = j['proto']
@@ -41,31 +49,22 @@ def portmappings(request, ip):
             pm.full_clean()
             pm.save()
         except:
-            import sys
-
-            print sys.exc_info()
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
-        response = HttpResponse(json.dumps({'message': 'Created'}),
-                                content_type="application/json")
-        response.status_code = 201
-        return response
+            report_exception()
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
+        return spit_json(request, {'message': 'Created'}, status=201)
     elif request.method == 'DELETE':
         response = check_body(request)
         if response:
             return response
         j = json.loads(request.read())
         if not j:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
         try:
             pm = Portmap.objects.get(pk=j['id'], container__server=server)
             pm.delete()
         except:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
-        return HttpResponse(json.dumps({'message': 'Ok'}),
-                            content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
+        return spit_json(request, {'message': 'Ok'})
     mappings = []
     for portmap in Portmap.objects.filter(container__server=server):
         mappings.append({'id': portmap.pk,
@@ -86,8 +85,7 @@ def container(request, id):
         container = customer.container_set.get(
             pk=(int(id) - UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                     content_type="application/json")
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     if request.method == 'POST':
         response = check_body(request)
         if response:
@@ -96,14 +94,13 @@ def container(request, id):
             'name', 'note', 'quota_threshold', 'jid', 'jid_secret',
             'jid_destinations', 'nofollow', 'pushover_user',
             'pushover_token', 'pushover_sound', 'alarm_freq',
-            'pushbullet_token', 'slack_webhook',
+            'alarm_aggregation', 'pushbullet_token', 'slack_webhook',
             'custom_distros_storage',
         )
 
         j = json.loads(request.read())
         if not j:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
         for key in j:
             if key in allowed_keys:
                 setattr(container, key, j[key])
@@ -144,10 +141,7 @@ def container(request, id):
                 link.save()
                 container.last_reboot = datetime.datetime.now()
             except:
-                response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                        content_type="application/json")
-                response.status_code = 409
-                return response
+                return spit_json(request, {'error': 'Conflict'}, status=409)
         if 'unlink' in j:
             try:
                 link = container.containerlink_set.get(
@@ -155,10 +149,7 @@ def container(request, id):
                 link.delete()
                 container.last_reboot = datetime.datetime.now()
             except:
-                response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                        content_type="application/json")
-                response.status_code = 409
-                return response
+                return spit_json(request, {'error': 'Conflict'}, status=409)
         if 'reboot' in j:
             container.last_reboot = datetime.datetime.now()
         container.full_clean()
@@ -183,6 +174,7 @@ def container(request, id):
         'pushbullet_token': container.pushbullet_token,
         'slack_webhook': container.slack_webhook,
         'alarm_freq': container.alarm_freq,
+        'alarm_aggregation': container.alarm_aggregation,
         'quota_threshold': container.quota_threshold,
         'nofollow': container.nofollow,
         'note': container.note,
@@ -204,6 +196,189 @@ def container(request, id):
     return spit_json(request, c)
 
 
+CONTAINERS_BULK_KEYS = (
+    'name', 'note', 'quota_threshold', 'jid', 'jid_secret',
+    'jid_destinations', 'nofollow', 'pushover_user', 'pushover_token',
+    'pushover_sound', 'alarm_freq', 'alarm_aggregation', 'pushbullet_token',
+    'slack_webhook', 'custom_distros_storage',
+)
+
+
+def bulk_int(value):
+    """
+    the integer value of a patch item, None if it is not valid
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def bulk_strings(value):
+    """
+    the strings of a list patch item, None if it is not a list of strings
+    """
+    if not isinstance(value, list) or \
+            not all(isinstance(item, basestring) for item in value):
+        return None
+    return value
+
+
+def containers_bulk_apply(container, patch, distros):
+    """
+    apply a bulk patch to a container (in memory only), returns the list
+    of modified fields (as for Container.changed_fields()).
+    Invalid values raise ValidationError
+    """
+    for key in ('link', 'unlink'):
+        if key in patch and bulk_int(patch[key]) is None:
+            raise ValidationError('invalid %s' % key)
+    for key in ('ssh_keys', 'tags'):
+        if key in patch and bulk_strings(patch[key]) is None:
+            raise ValidationError('invalid %s' % key)
+    for key in patch:
+        if key in CONTAINERS_BULK_KEYS:
+            setattr(container, key, patch[key])
+    if 'ssh_keys' in patch:
+        container.ssh_keys_raw = '\n'.join(patch['ssh_keys'])
+    if 'distro' in patch:
+        distro = bulk_int(patch['distro'])
+        if distro not in distros:
+            raise ValidationError('unknown distro')
+        container.distro_id = distro
+    changed = container.changed_fields()
+    container.clean_fields(
+        exclude=[f.name for f in container._meta.fields if f.name not in changed])
+    container.clean()
+    # clean() could fix some value
+    return container.changed_fields()
+
+
+@need_basicauth
+@csrf_exempt
+def containers_bulk(request):
+    """
+    apply a patch to a list of containers in a single transaction:
+
+    {"containers": [uid, ...], "patch": {...}, "patches": {"uid": {...}}}
+
+    per-uid patches are merged over the shared one. Containers are updated
+    with one UPDATE for each group of identical changes.
+    """
+    if request.method != 'POST':
+        return spit_json(request, {'error': 'Method not allowed'}, status=405)
+    response = check_body(request)
+    if response:
+        return response
+    customer = request.user.customer
+    try:
+        j = json.loads(request.read())
+        shared = j.get('patch', {})
+        patches = dict([(int(uid), p) for uid, p in j.get('patches', {}).items()])
+        uids = [int(uid) for uid in j.get('containers', [])]
+        uids += [uid for uid in sorted(patches) if uid not in uids]
+        if not isinstance(shared, dict) or \
+                not all(isinstance(p, dict) for p in patches.values()):
+            raise ValueError('invalid patch')
+    except:
+        return spit_json(request, {'error': 'Bad Request'}, status=400)
+
+    containers = customer.container_set.select_related('server').in_bulk(
+        [uid - UWSGI_IT_BASE_UID for uid in uids])
+    wanted = {}
+    for uid in uids:
+        patch = dict(shared)
+        patch.update(patches.get(uid, {}))
+        wanted[uid] = patch
+    # invalid values are skipped here, containers_bulk_apply reports them for each uid
+    distros = set(Distro.objects.filter(
+        pk__in=[bulk_int(p['distro']) for p in wanted.values()
+                if bulk_int(p.get('distro')) is not None]
+    ).values_list('pk', flat=True))
+    tag_names = set()
+    link_uids = set()
+    for p in wanted.values():
+        tag_names.update(bulk_strings(p.get('tags')) or [])
+        for key in ('link', 'unlink'):
+            if bulk_int(p.get(key)) is not None:
+                link_uids.add(bulk_int(p[key]) - UWSGI_IT_BASE_UID)
+    tags = dict(Tag.objects.filter(customer=customer, name__in=tag_names)
+                .values_list('name', 'pk'))
+    links = set(ContainerLink.objects.filter(
+        container__in=containers.keys()).values_list('container', 'to'))
+    targets = set(Container.objects.filter(pk__in=link_uids)
+                  .values_list('pk', flat=True))
+
+    now = datetime.datetime.now()
+    results = []
+    groups = {}
+    new_tags = {}
+    new_links = []
+    old_links = []
+    for uid in uids:
+        container = containers.get(uid - UWSGI_IT_BASE_UID)
+        if not container:
+            results.append({'uid': uid, 'status': 403, 'error': 'Forbidden'})
+            continue
+        patch = wanted[uid]
+        try:
+            changed = containers_bulk_apply(container, patch, distros)
+        except ValidationError, e:
+            results.append({'uid': uid, 'status': 400,
+                            'error': '; '.join(e.messages)})
+            continue
+        reboot = 'reboot' in patch
+        # linking and unlinking requires reboot
+        link = unlink = None
+        if 'link' in patch:
+            link = (container.pk, bulk_int(patch['link']) - UWSGI_IT_BASE_UID)
+            if link[1] == container.pk or link[1] not in targets or link in links:
+                results.append({'uid': uid, 'status': 409, 'error': 'Conflict'})
+                continue
+        if 'unlink' in patch:
+            unlink = (container.pk, bulk_int(patch['unlink']) - UWSGI_IT_BASE_UID)
+            if unlink not in links:
+                results.append({'uid': uid, 'status': 409, 'error': 'Conflict'})
+                continue
+        if link:
+            new_links.append(link)
+            reboot = True
+        if unlink:
+            old_links.append(unlink)
+            reboot = True
+        if 'tags' in patch:
+            new_tags[container.pk] = [tags[t] for t in patch['tags'] if t in tags]
+        values = [(f, getattr(container, container._meta.get_field(f).attname))
+                  for f in changed]
+        if set(changed) & set(Container.REBOOT_FIELDS):
+            reboot = True
+        if reboot:
+            values.append(('last_reboot', now))
+        if 'ssh_keys_raw' in changed:
+            values.append(('ssh_keys_mtime', now))
+        groups.setdefault(tuple(sorted(values)), []).append(container.pk)
+        results.append({'uid': uid, 'status': 200})
+
+    with transaction.atomic():
+        for values, pks in groups.items():
+            Container.objects.filter(pk__in=pks).update(mtime=now, **dict(values))
+        if new_tags:
+            through = Container.tags.through
+            through.objects.filter(container__in=new_tags.keys()).delete()
+            through.objects.bulk_create(
+                [through(container_id=pk, tag_id=tag)
+                 for pk in new_tags for tag in set(new_tags[pk])])
+        if new_links:
+            ContainerLink.objects.bulk_create(
+                [ContainerLink(container_id=c, to_id=to) for c, to in new_links])
+        for c, to in old_links:
+            ContainerLink.objects.filter(container=c, to=to).delete()
+        if new_links:
+            # bulk_create() does not send post_save
+            invalidate_firewall(*[containers[c].server_id for c, to in new_links])
+    return spit_json(request, {'results': results})
+
+
 @need_basicauth
 @csrf_exempt
 def container_regenerate_secret_uuid(request, container_id):
@@ -212,11 +387,9 @@ def container_regenerate_secret_uuid(request, container_id):
         container = customer.container_set.get(
             pk=(int(id) - UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                     content_type="application/json")
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     container.regenerate_secret_uuid()
-    return HttpResponse(json.dumps({'message': 'Ok'}),
-                        content_type="application/json")
+    return spit_json(request, {'message': 'Ok'})
 
 
 def news(request):
@@ -275,46 +448,55 @@ def containers(request):
         needed_keys = ('server', 'name', 'memory', 'storage')
         for k in needed_keys:
             if not k in j.keys():
-                return HttpResponseForbidden(
-                    json.dumps({'error': 'Forbidden'}),
-                    content_type="application/json")
+                return spit_json(request, {'error': 'Forbidden'}, status=403)
+        if int(j['memory']) <= 0:
+            return spit_json(request, {'error': 'Conflict',
+                                       'reason': 'not enough memory'})
+        if int(j['storage']) <= 0:
+            return spit_json(request, {'error': 'Conflict',
+                                       'reason': 'not enough storage'})
+        container = Container(customer=request.user.customer)
+        container.name = j['name']
+        container.memory = int(j['memory'])
+        container.storage = int(j['storage'])
+        # let the scheduler choose between the customer's servers
+        if j['server'] == 'auto':
+            try:
+                place_container(container, owner=request.user.customer,
+                                ssd=j.get('ssd'),
+                                datacenter=j.get('datacenter'),
+                                anti_affinity=j.get('anti_affinity'))
+            except ValidationError:
+                return spit_json(request, {'error': 'Conflict',
+                                           'reason': 'no server available'},
+                                 status=409)
+            return spit_json(request, {'message': 'Created',
+                                       'uid': container.uid,
+                                       'server_address':
+                                           container.server.address},
+                             status=201)
         try:
             server = Server.objects.get(address=j['server'])
             if server.owner != request.user.customer:
-                return HttpResponseForbidden(
-                    json.dumps({'error': 'Forbidden'}),
-                    content_type="application/json")
+                return spit_json(request, {'error': 'Forbidden'}, status=403)
         except:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
-        if int(j['memory']) > server.free_memory or int(j['memory']) <= 0:
-            return HttpResponse(json.dumps(
-                {'error': 'Conflict', 'reason': 'not enough memory'}),
-                                content_type="application/json")
-        if int(j['storage']) > server.free_storage or int(j['storage']) <= 0:
-            return HttpResponse(json.dumps(
-                {'error': 'Conflict', 'reason': 'not enough storage'}),
-                                content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
+        if int(j['memory']) > server.free_memory:
+            return spit_json(request, {'error': 'Conflict',
+                                       'reason': 'not enough memory'})
+        if int(j['storage']) > server.free_storage:
+            return spit_json(request, {'error': 'Conflict',
+                                       'reason': 'not enough storage'})
         try:
-            container = Container(customer=request.user.customer,
-                                  server=server)
-            container.name = j['name']
-            container.memory = int(j['memory'])
-            container.storage = int(j['storage'])
+            container.server = server
             container.save()
-            response = HttpResponse(json.dumps({'message': 'Created'}),
-                                    content_type="application/json")
-            response.status_code = 201
-            return response
+            return spit_json(request, {'message': 'Created'}, status=201)
         except:
-            response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                    content_type="application/json")
-            response.status_code = 409
-            return response
+            return spit_json(request, {'error': 'Conflict'}, status=409)
     elif (request.method == 'GET' and
                   'tags' in request.GET):
         containers = request.user.customer.container_set.filter(
-            tags__name__in=request.GET['tags'].split(','))
+            tags_query(Container, request.user.customer, request.GET['tags']))
     else:
         containers = request.user.customer.container_set.all()
 
@@ -358,15 +540,12 @@ def loopboxes(request):
         needed_keys = ('container', 'filename', 'mountpoint')
         for k in needed_keys:
             if not k in j.keys():
-                return HttpResponseForbidden(
-                    json.dumps({'error': 'Forbidden'}),
-                    content_type="application/json")
+                return spit_json(request, {'error': 'Forbidden'}, status=403)
         try:
             container = request.user.customer.container_set.get(
                 pk=(int(j['container']) - UWSGI_IT_BASE_UID))
         except:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
         try:
             loopbox = Loopbox(container=container)
             loopbox.filename = j['filename']
@@ -374,30 +553,23 @@ def loopboxes(request):
             if 'ro' in j:
                 loopbox.ro = j['ro']
             loopbox.save()
-            response = HttpResponse(json.dumps({'message': 'Created'}),
-                                    content_type="application/json")
-            response.status_code = 201
-            return response
+            return spit_json(request, {'message': 'Created'}, status=201)
         except:
-            response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                    content_type="application/json")
-            response.status_code = 409
-            return response
+            return spit_json(request, {'error': 'Conflict'}, status=409)
     elif request.method == 'GET':
         query = {}
+        tags = Q()
         if 'tags' in request.GET:
-            query['tags__name__in'] = request.GET['tags'].split(',')
+            tags = tags_query(Loopbox, request.user.customer, request.GET['tags'])
         if 'container' in request.GET:
             try:
                 query['container'] = request.user.customer.container_set.get(
                     pk=(int(request.GET['container']) - UWSGI_IT_BASE_UID))
             except:
-                return HttpResponseForbidden(
-                    json.dumps({'error': 'Forbidden'}),
-                    content_type="application/json")
+                return spit_json(request, {'error': 'Forbidden'}, status=403)
         else:
             query['container__in'] = request.user.customer.container_set.all()
-        loopboxes = Loopbox.objects.filter(**query)
+        loopboxes = Loopbox.objects.filter(tags, **query)
     else:
         loopboxes = Loopbox.objects.filter(
             container__in=request.user.customer.container_set.all())
@@ -416,17 +588,18 @@ def loopboxes(request):
     return spit_json(request, l)
 
 
-@need_basicauth
-@csrf_exempt
-def alarms(request):
+def alarms_query(request):
+    """
+    builds the alarms filters from the query string (shared by /alarms/ and /alarms/stream),
+    returns None if the requested container does not belong to the customer
+    """
     query = {}
     if 'container' in request.GET:
         try:
             query['container'] = request.user.customer.container_set.get(
                 pk=(int(request.GET['container']) - UWSGI_IT_BASE_UID))
         except:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
+            return None
     else:
         query['container__in'] = request.user.customer.container_set.all()
 
@@ -451,14 +624,39 @@ def alarms(request):
     if 'func' in request.GET:
         query['func'] = request.GET['func']
 
-    alarms = Alarm.objects.filter(**query)
+    return query
 
-    a = []
+
+def alarm_to_dict(alarm):
+    return {
+        'id': alarm.pk,
+        'container': alarm.container.uid,
+        'level': alarm.level,
+        'color': alarm.color,
+        'class': alarm._class,
+        'vassal': alarm.vassal,
+        'line': alarm.line,
+        'filename': alarm.filename,
+        'func': alarm.func,
+        'unix': int(alarm.unix.strftime('%s')),
+        'msg': alarm.msg,
+        'count': alarm.count,
+        'first_seen': int((alarm.first_seen or alarm.unix).strftime('%s')),
+        'last_seen': int(alarm.last_seen.strftime('%s')),
+    }
+
+
+@need_basicauth
+@csrf_exempt
+def alarms(request):
+    query = alarms_query(request)
+    if query is None:
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+
+    alarms = Alarm.objects.filter(**query).select_related('container')
 
     if 'with_total' in request.GET:
-        response = {'total': alarms.count(), 'alarms': a}
-    else:
-        response = a
+        total = alarms.count()
 
     if 'range' in request.GET:
         to = request.GET['range']
@@ -470,31 +668,177 @@ def alarms(request):
             alarms = alarms[int(min(_from, to)):int(max(_from, to))]
 
         except:
-            response = HttpResponse(
-                json.dumps({'error': 'Requested Range Not Satisfiable'}),
-                content_type="application/json")
-            response.status_code = 416
-            return response
+            return spit_json(request,
+                             {'error': 'Requested Range Not Satisfiable'},
+                             status=416)
         if _from > to:
             alarms = alarms.reverse()
 
-    for alarm in alarms:
-        aa = {
-            'id': alarm.pk,
-            'container': alarm.container.uid,
-            'level': alarm.level,
-            'color': alarm.color,
-            'class': alarm._class,
-            'vassal': alarm.vassal,
-            'line': alarm.line,
-            'filename': alarm.filename,
-            'func': alarm.func,
-            'unix': int(alarm.unix.strftime('%s')),
-            'msg': alarm.msg
-        }
-        a.append(aa)
+    # alarms lists can be big, stream them
+    a = (alarm_to_dict(alarm) for alarm in alarms.iterator())
+
+    if 'with_total' in request.GET:
+        return spit_json(request, {'total': total, 'alarms': list(a)})
+
+    return spit_json(request, a)
+
+
+def alarms_changes(query, last_id, last_unix):
+    """
+    the alarms newer than last_id and the aggregated ones (they keep their id) updated since last_unix
+    """
+    updated = Q(pk__lte=last_id, count__gt=1, unix__gte=last_unix)
+    return list(Alarm.objects.filter(Q(pk__gt=last_id) | updated, **query).select_related('container').order_by('pk'))
+
+
+def alarms_last_id(request, query, header=None):
+    """
+    the last_id sent by the client, the most recent alarm if not specified
+    """
+    last_id = request.GET.get('last_id')
+    if header:
+        last_id = request.META.get(header, last_id)
+    try:
+        return int(last_id)
+    except:
+        return Alarm.objects.filter(**query).aggregate(models.Max('pk'))['pk__max'] or 0
+
+
+def alarms_seq(cache, seq_key):
+    seq = cache.get(seq_key)
+    if seq is None:
+        cache.add(seq_key, 0, 86400)
+    return seq
+
+
+def alarms_stream_events(query, last_id, seq_key):
+    """
+    the database is queried only when the customer alarms sequence (in the cache) changes,
+    so an idle stream costs a cache get every UWSGI_IT_ALARMS_STREAM_POLL seconds, but it keeps
+    a worker busy (sleeping) for the whole stream.
+    The db connection is released after each query to not hold it for the whole stream.
+    Aggregated alarms keep their id, so their updates (newer unix) are sent as 'update' events.
+    """
+    cache = get_cache(UWSGI_IT_ALARMS_CACHE)
+    yield 'retry: %d\n\n' % (UWSGI_IT_ALARMS_STREAM_POLL * 1000)
+    seq = None
+    last_unix = datetime.datetime.now()
+    # alarm id -> count of the updates already sent with unix == last_unix
+    sent = {}
+    started = last_event = time.time()
+    while time.time() - started < UWSGI_IT_ALARMS_STREAM_TIMEOUT:
+        current = alarms_seq(cache, seq_key)
+        if current is None or current != seq:
+            seq = current
+            changed = alarms_changes(query, last_id, last_unix)
+            if not connection.in_atomic_block:
+                connection.close()
+            for alarm in changed:
+                if alarm.pk > last_id:
+                    last_id = alarm.pk
+                    event = 'id: %d\nevent: alarm\n' % alarm.pk
+                elif sent.get(alarm.pk) == alarm.count:
+                    continue
+                else:
+                    # no id, Last-Event-ID must keep pointing to the newest alarm
+                    event = 'event: update\n'
+                if alarm.unix > last_unix:
+                    last_unix = alarm.unix
+                    sent = {}
+                if alarm.unix == last_unix:
+                    sent[alarm.pk] = alarm.count
+                last_event = time.time()
+                yield '%sdata: %s\n\n' % (event, json.dumps(alarm_to_dict(alarm)))
+        if time.time() - last_event >= UWSGI_IT_ALARMS_STREAM_HEARTBEAT:
+            last_event = time.time()
+            yield ': keepalive\n\n'
+        time.sleep(UWSGI_IT_ALARMS_STREAM_POLL)
+
+
+class AlarmsStreamSlot(object):
+    """
+    releases the stream slot when the response is closed (even if it has never been iterated)
+    """
+
+    def __init__(self, events, cache, key):
+        self.events = events
+        self.cache = cache
+        self.key = key
+        self.released = False
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        if self.released:
+            return
+        self.released = True
+        self.events.close()
+        try:
+            self.cache.decr(self.key)
+        except ValueError:
+            pass
+
 
-    return spit_json(request, response)
+@need_basicauth
+def alarms_stream(request):
+    """
+    Server-Sent Events stream of new alarms, accepts the same filters of /alarms/.
+    A stream keeps a worker busy for up to UWSGI_IT_ALARMS_STREAM_TIMEOUT seconds, so each customer
+    can open at most UWSGI_IT_ALARMS_STREAM_MAX of them (use /alarms/poll for more tails)
+    """
+    query = alarms_query(request)
+    if query is None:
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+    last_id = alarms_last_id(request, query, 'HTTP_LAST_EVENT_ID')
+    customer = request.user.customer
+    events = alarms_stream_events(query, last_id, alarms_seq_key(customer.pk))
+    if UWSGI_IT_ALARMS_STREAM_MAX:
+        cache = get_cache(UWSGI_IT_ALARMS_CACHE)
+        key = 'alarms_streams_%d' % customer.pk
+        # slots leaked by killed workers are forgotten when the counter expires
+        cache.add(key, 0, 86400)
+        if cache.incr(key) > UWSGI_IT_ALARMS_STREAM_MAX:
+            cache.decr(key)
+            response = spit_json(request, {'error': 'Too Many Requests'}, status=429)
+            response['Retry-After'] = str(UWSGI_IT_ALARMS_STREAM_POLL * 5)
+            return response
+        events = AlarmsStreamSlot(events, cache, key)
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@need_basicauth
+def alarms_poll(request):
+    """
+    the non-blocking variant of /alarms/stream: returns right away the alarms since last_id (and the
+    aggregated ones updated since unix), with the last_id, unix and seq to pass to the next call.
+    While the customer alarms sequence does not change, a poll costs a cache get (no db query)
+    """
+    query = alarms_query(request)
+    if query is None:
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+    customer = request.user.customer
+    seq = alarms_seq(get_cache(UWSGI_IT_ALARMS_CACHE), alarms_seq_key(customer.pk))
+    try:
+        last_unix = datetime.datetime.fromtimestamp(int(request.GET['unix']))
+    except:
+        last_unix = datetime.datetime.now().replace(microsecond=0)
+    j = {'seq': seq, 'unix': int(last_unix.strftime('%s')), 'alarms': [], 'updates': []}
+    if 'last_id' in request.GET and seq is not None and request.GET.get('seq') == str(seq):
+        j['last_id'] = alarms_last_id(request, query)
+        return spit_json(request, j)
+    last_id = alarms_last_id(request, query)
+    for alarm in alarms_changes(query, last_id, last_unix):
+        if alarm.pk > last_id:
+            j['alarms'].append(alarm_to_dict(alarm))
+        else:
+            j['updates'].append(alarm_to_dict(alarm))
+        j['unix'] = max(j['unix'], int(alarm.unix.strftime('%s')))
+    j['last_id'] = max([last_id] + [a['id'] for a in j['alarms']])
+    return spit_json(request, j)
 
 
 @need_basicauth
@@ -505,16 +849,14 @@ def loopbox(request, id):
         loopbox = Loopbox.objects.get(pk=id,
                                       container__in=customer.container_set.all())
     except:
-        return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                     content_type="application/json")
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     if request.method == 'POST':
         response = check_body(request)
         if response:
             return response
         j = json.loads(request.read())
         if not j:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
         if 'tags' in j:
             new_tags = []
             for tag in j['tags']:
@@ -527,8 +869,7 @@ def loopbox(request, id):
         loopbox.save()
     elif request.method == 'DELETE':
         loopbox.delete()
-        return HttpResponse(json.dumps({'message': 'Ok'}),
-                            content_type="application/json")
+        return spit_json(request, {'message': 'Ok'})
     l = {
         'id': loopbox.pk,
         'container': loopbox.container.uid,
@@ -548,25 +889,11 @@ def alarm(request, id):
         alarm = Alarm.objects.get(pk=id,
                                   container__in=customer.container_set.all())
     except:
-        return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                     content_type="application/json")
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     if request.method == 'DELETE':
         alarm.delete()
-        return HttpResponse(json.dumps({'message': 'Ok'}),
-                            content_type="application/json")
-    a = {
-        'id': alarm.pk,
-        'container': alarm.container.uid,
-        'level': alarm.level,
-        'color': alarm.color,
-        'class': alarm._class,
-        'line': alarm.line,
-        'filename': alarm.filename,
-        'func': alarm.func,
-        'vassal': alarm.vassal,
-        'unix': int(alarm.unix.strftime('%s')),
-        'msg': alarm.msg
-    }
+        return spit_json(request, {'message': 'Ok'})
+    a = alarm_to_dict(alarm)
     return spit_json(request, a)
 
 
@@ -577,12 +904,10 @@ def custom_distro(request, id):
     try:
         distro = CustomDistro.objects.get(pk=id, container__customer=customer)
     except:
-        return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                     content_type="application/json")
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     if request.method == 'DELETE':
         distro.delete()
-        return HttpResponse(json.dumps({'message': 'Ok'}),
-                            content_type="application/json")
+        return spit_json(request, {'message': 'Ok'})
     if request.method == 'POST':
         response = check_body(request)
         if response:
@@ -609,17 +934,55 @@ def custom_distro(request, id):
 @csrf_exempt
 def alarm_key(request, id):
     customer = request.user.customer
+    # the key is a credential (and GET rotates it), tokens cannot generate it
+    if getattr(request, 'api_token', None):
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     try:
         container = customer.container_set.get(
             pk=(int(id) - UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                     content_type="application/json")
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     container.alarm_key = str(uuid.uuid4())
     container.save()
-    return HttpResponse(
-        json.dumps({'message': 'Ok', 'alarm_key': container.alarm_key}),
-        content_type="application/json")
+    return spit_json(request,
+                     {'message': 'Ok', 'alarm_key': container.alarm_key})
+
+
+@need_basicauth
+@csrf_exempt
+def tokens(request):
+    customer = request.user.customer
+    # tokens cannot be used to generate other tokens
+    if getattr(request, 'api_token', None):
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+    if request.method == 'POST':
+        response = check_body(request)
+        if response:
+            return response
+        j = json.loads(request.read())
+        if not j or j.get('scope') not in API_TOKEN_SCOPES:
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
+        container = None
+        if 'container' in j:
+            try:
+                container = customer.container_set.get(
+                    pk=(int(j['container']) - UWSGI_IT_BASE_UID))
+            except:
+                return spit_json(request, {'error': 'Forbidden'}, status=403)
+        try:
+            expires = int(j.get('expires', 0))
+        except (TypeError, ValueError):
+            return spit_json(request, {'error': 'Bad Request'}, status=400)
+        token = make_api_token(customer, j['scope'], container, expires)
+        response = spit_json(request, {'token': token, 'scope': j['scope']})
+        response.status_code = 201
+        return response
+    elif request.method == 'DELETE':
+        # revoke all of the tokens
+        customer.token_version += 1
+        customer.save()
+        return spit_json(request, {'message': 'Ok'})
+    return spit_json(request, {'error': 'Method not allowed'}, status=405)
 
 
 def alarm_key_auth(request, id):
@@ -639,7 +1002,8 @@ def alarm_key_auth(request, id):
     return None
 
 
-@need_basicauth(fallback=alarm_key_auth)
+@need_basicauth(fallback=alarm_key_auth, token_scope='alarms',
+                token_container=True)
 @csrf_exempt
 def raise_alarm(request, id):
     customer = request.user.customer
@@ -647,8 +1011,14 @@ def raise_alarm(request, id):
         container = customer.container_set.get(
             pk=(int(id) - UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                     content_type="application/json")
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+    # only the owner can consume the budget of the container
+    if UWSGI_IT_ALARMS_RATE and request.method == 'POST':
+        retry_after = rate_limit(get_cache(UWSGI_IT_ALARMS_CACHE),
+                                 alarms_rate_key(container.uid, request.GET.get('class')),
+                                 UWSGI_IT_ALARMS_RATE, UWSGI_IT_ALARMS_RATE_PERIOD)
+        if retry_after:
+            return too_many_requests(request, retry_after)
     if request.method == 'POST':
         response = check_body(request)
         if response:
@@ -669,9 +1039,7 @@ def raise_alarm(request, id):
         if 'level' in request.GET:
             alarm.level = int(request.GET['level'])
             if alarm.level < 1:
-                return HttpResponseForbidden(
-                    json.dumps({'error': 'Forbidden'}),
-                    content_type="application/json")
+                return spit_json(request, {'error': 'Forbidden'}, status=403)
         if 'unix' in request.GET:
             alarm.unix = datetime.datetime.fromtimestamp(
                 int(request.GET['unix']))
@@ -680,19 +1048,10 @@ def raise_alarm(request, id):
         alarm.msg = request.read()
         try:
             alarm.save()
-            response = HttpResponse(json.dumps({'message': 'Created'}),
-                                    content_type="application/json")
-            response.status_code = 201
-            return response
+            return spit_json(request, {'message': 'Created'}, status=201)
         except:
-            response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                    content_type="application/json")
-            response.status_code = 409
-            return response
-    response = HttpResponse(json.dumps({'error': 'Method not allowed'}),
-                            content_type="application/json")
-    response.status_code = 405
-    return response
+            return spit_json(request, {'error': 'Conflict'}, status=409)
+    return spit_json(request, {'error': 'Method not allowed'}, status=405)
 
 
 @need_basicauth
@@ -706,19 +1065,21 @@ def distros(request):
 def custom_distros(request, id=None):
     customer = request.user.customer
     if not id:
+        distros = CustomDistro.objects.filter(container__customer=customer)
+        if 'tags' in request.GET:
+            distros = distros.filter(
+                tags_query(CustomDistro, customer, request.GET['tags']))
         j = [{'id': d.pk, 'name': d.name, 'container': d.container.uid} for d
-             in CustomDistro.objects.filter(container__customer=customer)]
+             in distros]
         return spit_json(request, j)
     try:
         container = customer.container_set.get(
             pk=(int(id) - UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                     content_type="application/json")
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     if request.method == 'POST':
         if not container.custom_distros_storage:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
         response = check_body(request)
         if response:
             return response
@@ -732,12 +1093,8 @@ def custom_distros(request, id=None):
             distro.full_clean()
             distro.save()
         except:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
-        response = HttpResponse(json.dumps({'message': 'Created'}),
-                                content_type="application/json")
-        response.status_code = 201
-        return response
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
+        return spit_json(request, {'message': 'Created'}, status=201)
     j = [{'id': d.pk, 'name': d.name} for d in
          CustomDistro.objects.filter(container__server=container.server,
                                      container__customer=customer).exclude(
@@ -745,6 +1102,104 @@ def custom_distros(request, id=None):
     return spit_json(request, j)
 
 
+ALERT_RULE_FIELDS = ('name', 'metric', 'field', 'relative_to', 'op',
+                     'threshold', 'clear_threshold', 'duration', 'cooldown')
+
+
+def alert_rule_to_dict(rule):
+    d = {'id': rule.pk, 'container': rule.container.uid}
+    for field in ALERT_RULE_FIELDS:
+        d[field] = getattr(rule, field)
+    return d
+
+
+@need_basicauth
+@csrf_exempt
+def alert_rules(request, id=None):
+    customer = request.user.customer
+    if not id:
+        return spit_json(request, [alert_rule_to_dict(r) for r in
+                                   AlertRule.objects.filter(
+                                       container__customer=customer)])
+    try:
+        container = customer.container_set.get(
+            pk=(int(id) - UWSGI_IT_BASE_UID))
+    except:
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+    if request.method == 'POST':
+        response = check_body(request)
+        if response:
+            return response
+        j = json.loads(request.read())
+        rule = AlertRule(container=container)
+        for field in ALERT_RULE_FIELDS:
+            if field in j:
+                setattr(rule, field, j[field])
+        try:
+            rule.full_clean()
+            rule.save()
+        except:
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
+        return spit_json(request, alert_rule_to_dict(rule), status=201)
+    return spit_json(request, [alert_rule_to_dict(r) for r in
+                               container.alertrule_set.all()])
+
+
+@need_basicauth
+@csrf_exempt
+def alert_rule(request, id):
+    customer = request.user.customer
+    try:
+        rule = AlertRule.objects.get(pk=id, container__customer=customer)
+    except:
+        return spit_json(request, {'error': 'Not found'}, status=404)
+    if request.method == 'DELETE':
+        rule.delete()
+        return spit_json(request, {'message': 'Ok'})
+    return spit_json(request, alert_rule_to_dict(rule))
+
+
+@need_basicauth
+def usage(request):
+    """
+    the monthly ledgers of the customer (optionally filtered by year/month)
+    """
+    customer = request.user.customer
+    rows = customer.usageledger_set.all()
+    try:
+        if 'year' in request.GET:
+            rows = rows.filter(year=int(request.GET['year']))
+        if 'month' in request.GET:
+            rows = rows.filter(month=int(request.GET['month']))
+    except ValueError:
+        return spit_json(request, {'error': 'Bad Request'}, status=400)
+    j = [{'year': r.year, 'month': r.month,
+          'memory_hours': r.memory_hours, 'storage_hours': r.storage_hours,
+          'quota_hours': r.quota_hours, 'cpu_seconds': r.cpu_seconds,
+          'net_rx': r.net_rx, 'net_tx': r.net_tx,
+          'mtime': int(r.mtime.strftime('%s'))}
+         for r in rows]
+    return spit_json(request, j)
+
+
+def domain_check_to_dict(check):
+    return {'id': check.pk, 'name': check.name, 'status': check.status,
+            'checked': check.checked_munix, 'domain': check.domain_id}
+
+
+@need_basicauth
+def domain_checks(request, id=None):
+    customer = request.user.customer
+    if id:
+        try:
+            check = customer.domaincheck_set.get(pk=id)
+        except:
+            return spit_json(request, {'error': 'Not found'}, status=404)
+        return spit_json(request, domain_check_to_dict(check))
+    return spit_json(request, [domain_check_to_dict(c) for c in
+                               customer.domaincheck_set.all()])
+
+
 @need_basicauth
 @csrf_exempt
 def domains(request):
@@ -756,28 +1211,33 @@ def domains(request):
             return response
         j = json.loads(request.read())
         if Domain.objects.filter(name=j['name']):
-            response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                    content_type="application/json")
-            response.status_code = 409
-            return response
-        if dns_check(j['name'], customer.uuid):
+            return spit_json(request, {'error': 'Conflict'}, status=409)
+        # the dns check runs in background (check_domains command), unless
+        # its result is already known
+        checked = get_cache(UWSGI_IT_DNS_CACHE).get(
+            dns_check_key(j['name'], customer.uuid))
+        if checked is None:
+            check, created = DomainCheck.objects.get_or_create(
+                customer=customer, name=j['name'])
+            if check.status != 'pending':
+                check.status = 'pending'
+                check.save()
+            return spit_json(request, domain_check_to_dict(check), status=202)
+        if checked:
             try:
                 domain = customer.domain_set.create(name=j['name'])
-                response = HttpResponse(json.dumps({
+                response = spit_json(request, {
                     'message': 'Created',
                     'id': domain.pk, 'name': domain.name, 'uuid': domain.uuid,
                     'tags': [t.name for t in domain.tags.all()],
                     'note': domain.note
-                }), content_type="application/json")
-                response.status_code = 201
+                }, status=201)
             except:
-                response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                        content_type="application/json")
-                response.status_code = 409
+                response = spit_json(request, {'error': 'Conflict'},
+                                     status=409)
             return response
         else:
-            return HttpResponseForbidden(json.dumps({'error': 'Forbidden'}),
-                                         content_type="application/json")
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
 
     elif request.method == 'DELETE':
         response = check_body(request)
@@ -787,27 +1247,22 @@ def domains(request):
         try:
             customer.domain_set.get(name=j['name']).delete()
         except Domain.DoesNotExist:
-            return HttpResponseNotFound(json.dumps({'error': 'Not found'}),
-                                        content_type="application/json")
-        return HttpResponse(json.dumps({'message': 'Ok'}),
-                            content_type="application/json")
+            return spit_json(request, {'error': 'Not found'}, status=404)
+        return spit_json(request, {'message': 'Ok'})
 
     elif request.method == 'GET':
         if 'tags' in request.GET:
             j = [{'id': d.pk, 'name': d.name, 'uuid': d.uuid,
                   'tags': [t.name for t in d.tags.all()]} for d in
                  customer.domain_set.filter(
-                     tags__name__in=request.GET['tags'].split(','))]
+                     tags_query(Domain, customer, request.GET['tags']))]
         else:
             j = [{'id': d.pk, 'name': d.name, 'uuid': d.uuid,
                   'tags': [t.name for t in d.tags.all()]} for d in
                  customer.domain_set.all()]
         return spit_json(request, j)
 
-    response = HttpResponse(json.dumps({'error': 'Method not allowed'}),
-                            content_type="application/json")
-    response.status_code = 405
-    return response
+    return spit_json(request, {'error': 'Method not allowed'}, status=405)
 
 
 @need_basicauth
@@ -831,19 +1286,14 @@ def tags(request):
             response.status_code = 201
             response.reason_phrase = 'Created'
         except:
-            response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                    content_type="application/json")
-            response.status_code = 409
+            response = spit_json(request, {'error': 'Conflict'}, status=409)
         return response
 
     elif request.method == 'GET':
         j = [{'id': t.pk, 'name': t.name} for t in
              Tag.objects.filter(customer=customer)]
         return spit_json(request, j)
-    response = HttpResponse(json.dumps({'error': 'Method not allowed'}),
-                            content_type="application/json")
-    response.status_code = 405
-    return response
+    return spit_json(request, {'error': 'Method not allowed'}, status=405)
 
 
 @need_basicauth
@@ -853,8 +1303,7 @@ def tag(request, id):
     try:
         t = Tag.objects.get(customer=customer, pk=id)
     except:
-        return HttpResponseNotFound(json.dumps({'error': 'Not found'}),
-                                    content_type="application/json")
+        return spit_json(request, {'error': 'Not found'}, status=404)
 
     allowed_keys = ('name', 'note')
     if request.method == 'POST':
@@ -870,22 +1319,16 @@ def tag(request, id):
             j = {'id': t.pk, 'name': t.name, 'note': t.note}
             return spit_json(request, j)
         except:
-            response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                    content_type="application/json")
-            response.status_code = 409
+            response = spit_json(request, {'error': 'Conflict'}, status=409)
         return response
     elif request.method == 'GET':
         j = {'id': t.pk, 'name': t.name, 'note': t.note}
         return spit_json(request, j)
     elif request.method == 'DELETE':
         t.delete()
-        return HttpResponse(json.dumps({'message': 'Ok'}),
-                            content_type="application/json")
+        return spit_json(request, {'message': 'Ok'})
     allowed_keys = ('name', 'note')
-    response = HttpResponse(json.dumps({'error': 'Method not allowed'}),
-                            content_type="application/json")
-    response.status_code = 405
-    return response
+    return spit_json(request, {'error': 'Method not allowed'}, status=405)
 
 
 @need_basicauth
@@ -895,8 +1338,7 @@ def domain(request, id):
     try:
         domain = customer.domain_set.get(pk=id)
     except:
-        return HttpResponseNotFound(json.dumps({'error': 'Not found'}),
-                                    content_type="application/json")
+        return spit_json(request, {'error': 'Not found'}, status=404)
     allowed_keys = ('note',)
     if request.method == 'POST':
         response = check_body(request)
@@ -922,14 +1364,11 @@ def domain(request, id):
                  'note': domain.note}
             return spit_json(request, j)
         except:
-            response = HttpResponse(json.dumps({'error': 'Conflict'}),
-                                    content_type="application/json")
-            response.status_code = 409
+            response = spit_json(request, {'error': 'Conflict'}, status=409)
         return response
     elif request.method == 'DELETE':
         domain.delete()
-        return HttpResponse(json.dumps({'message': 'Ok'}),
-                            content_type="application/json")
+        return spit_json(request, {'message': 'Ok'})
 
     elif request.method == 'GET':
         j = {'id': domain.pk, 'name': domain.name, 'uuid': domain.uuid,
@@ -937,10 +1376,24 @@ def domain(request, id):
              'note': domain.note}
         return spit_json(request, j)
 
-    response = HttpResponse(json.dumps({'error': 'Method not allowed'}),
-                            content_type="application/json")
-    response.status_code = 405
-    return response
+    return spit_json(request, {'error': 'Method not allowed'}, status=405)
+
+
+def seen_window(request):
+    """
+    filter for the domains<->containers associations seen in the
+    ?since=&until= (unix) window, by default the last
+    UWSGI_IT_DOMAINS_SEEN_WINDOW seconds
+    """
+    query = {'last_seen__gte': datetime.datetime.now() -
+             datetime.timedelta(seconds=UWSGI_IT_DOMAINS_SEEN_WINDOW)}
+    if 'since' in request.GET:
+        query['last_seen__gte'] = datetime.datetime.fromtimestamp(
+            int(request.GET['since']))
+    if 'until' in request.GET:
+        query['first_seen__lte'] = datetime.datetime.fromtimestamp(
+            int(request.GET['until']))
+    return query
 
 
 @need_basicauth
@@ -951,25 +1404,21 @@ def containers_per_domain(request, id):
         try:
             domain = customer.domain_set.get(pk=id)
         except:
-            return HttpResponseNotFound(json.dumps({'error': 'Not found'}),
-                                        content_type="application/json")
-
-        today = datetime.datetime.today()
-        container_list = [{'id': c.pk, 'uuid': c.uuid, 'name': c.name, 'uid': c.uid} for c in Container.objects.filter(
-            pk__in=HitsDomainMetric.objects.values_list(
-                'container', flat=True).filter(
-                domain=domain,
-                year=today.year,
-                month=today.month,
-                day=today.day
-            ).order_by('-year', '-month', '-day')
-        )]
+            return spit_json(request, {'error': 'Not found'}, status=404)
+        try:
+            query = seen_window(request)
+        except ValueError:
+            return spit_json(request, {'error': 'Bad Request'}, status=400)
+
+        container_list = [{'id': dc.container.pk, 'uuid': dc.container.uuid,
+                           'name': dc.container.name, 'uid': dc.container.uid,
+                           'first_seen': int(dc.first_seen.strftime('%s')),
+                           'last_seen': int(dc.last_seen.strftime('%s'))}
+                          for dc in domain.domaincontainer_set.filter(
+                              **query).select_related('container')]
         return spit_json(request, container_list)
 
-    response = HttpResponse(json.dumps({'error': 'Method not allowed'}),
-                            content_type="application/json")
-    response.status_code = 405
-    return response
+    return spit_json(request, {'error': 'Method not allowed'}, status=405)
 
 
 @need_basicauth
@@ -980,23 +1429,20 @@ def domains_in_container(request, id):
         try:
             container_obj = customer.container_set.get(pk=(int(id) - UWSGI_IT_BASE_UID))
         except:
-            return HttpResponseNotFound(json.dumps({'error': 'Not found'}),
-                                        content_type="application/json")
-
-        today = datetime.datetime.today()
-        domain_list = [{'id': d.pk, 'uuid': d.uuid, 'name': d.name} for d in Domain.objects.filter(
-            pk__in=HitsDomainMetric.objects.values_list(
-                'domain', flat=True).filter(
-                container=container_obj,
-                year=today.year,
-                month=today.month,
-                day=today.day
-            ).order_by('-year', '-month', '-day')
-        )]
+            return spit_json(request, {'error': 'Not found'}, status=404)
+        try:
+            query = seen_window(request)
+        except ValueError:
+            return spit_json(request, {'error': 'Bad Request'}, status=400)
+
+        domain_list = [{'id': dc.domain.pk, 'uuid': dc.domain.uuid,
+                        'name': dc.domain.name,
+                        'first_seen': int(dc.first_seen.strftime('%s')),
+                        'last_seen': int(dc.last_seen.strftime('%s'))}
+                       for dc in container_obj.domaincontainer_set.filter(
+                           **query).select_related('domain')]
 
         return spit_json(request, domain_list)
 
-    response = HttpResponse(json.dumps({'error': 'Method not allowed'}),
-                            content_type="application/json")
-    response.status_code = 405
-    return response
\ No newline at end of file
+    response = spit_json(request, {'error': 'Method not allowed'}, status=405)
+    return response
@@ -1,184 +1,246 @@
-from django.http import HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseNotModified
 from django.core.cache import get_cache
+from django.utils.http import http_date
+from django.utils.text import compress_string
 
-from uwsgi_it_api.config import UWSGI_IT_BASE_UID, UWSGI_IT_METRICS_CACHE
+from uwsgi_it_api.config import UWSGI_IT_BASE_UID, UWSGI_IT_METRICS_CACHE, UWSGI_IT_METRICS_CACHE_CONTROL, UWSGI_IT_METRICS_MAX_AGE
 from uwsgi_it_api.decorators import need_basicauth
-from uwsgi_it_api.utils import spit_json
+from uwsgi_it_api.utils import spit_json, accepted_encoding
+from uwsgi_it_api.models import LatestContainerMetric
+from uwsgi_it_api.openmetrics import openmetrics_response
+from uwsgi_it_api.stats import record_cache, report_exception
 
 import datetime
+import hashlib
+import time
 
-def metrics_container_do(request, container, qs, prefix):
+def metrics_day(request):
     """
-    you can ask metrics for a single day of the year (288 metrics is the worst/general case)
-    if the day is today, the response is cached for 5 minutes, otherwise it is cached indefinitely
+    returns the requested day, the seconds it can be cached and if it is a past (immutable) day.
+    Today and the future days can still receive metrics
     """
-    today = datetime.datetime.today()
+    today = datetime.date.today()
     year = today.year
     month = today.month
     day = today.day
     if 'year' in request.GET:year = int(request.GET['year'])
     if 'month' in request.GET: month = int(request.GET['month'])
     if 'day' in request.GET: day = int(request.GET['day'])
-    expires = 86400
-    if day != today.day or month != today.month or year != today.year: expires = 300
+    try:
+        past = datetime.date(year, month, day) < today
+    except ValueError:
+        past = False
+    if past:
+        return year, month, day, 86400, True
+    return year, month, day, 300, False
+
+def metrics_entry(j):
+    """
+    the cached form of a metrics response: the json, its gzip-encoded variant and its ETag
+    """
+    return {'json': j, 'gzip': compress_string(j), 'etag': '"%s"' % hashlib.md5(j).hexdigest()}
+
+def metrics_cached(key, expires, build):
     try:
         # this will trigger the db query
         if not UWSGI_IT_METRICS_CACHE: raise
         cache = get_cache(UWSGI_IT_METRICS_CACHE)
-        j = cache.get("%s_%d_%d_%d_%d" % (prefix, container.uid, year, month, day))
-        if not j:
-            j = qs.get(year=year,month=month,day=day).json
-            cache.set("%s_%d_%d_%d_%d" % (prefix, container.uid, year, month, day ), j, expires)
-    except: 
-        import sys
-        print sys.exc_info()
+        entry = cache.get(key)
+        record_cache(entry is not None)
+        if not entry:
+            entry = metrics_entry(build())
+            cache.set(key, entry, expires)
+        return entry
+    except:
+        report_exception()
         try:
-            j = qs.get(year=year,month=month,day=day).json
+            j = build()
         except:
             j = "[]"
-    return spit_json(request, j, expires, True)
+        return metrics_entry(j)
+
+def metrics_response(request, entry, expires, past):
+    if request.META.get('HTTP_IF_NONE_MATCH') == entry['etag']:
+        response = HttpResponseNotModified()
+    elif accepted_encoding(request) == 'gzip':
+        # already compressed, no need to do it again
+        response = HttpResponse(entry['gzip'], content_type="application/json")
+        response['Content-Encoding'] = 'gzip'
+        response['Content-Length'] = str(len(entry['gzip']))
+    else:
+        response = spit_json(request, entry['json'], raw=True)
+    response['ETag'] = entry['etag']
+    response['Vary'] = 'Accept-Encoding'
+    if past:
+        # the server side cache is shorter, clients can keep the day for max-age
+        response['Expires'] = http_date(time.time() + UWSGI_IT_METRICS_MAX_AGE)
+        response['Cache-Control'] = '%s, max-age=%d, immutable' % (UWSGI_IT_METRICS_CACHE_CONTROL, UWSGI_IT_METRICS_MAX_AGE)
+    else:
+        response['Expires'] = http_date(time.time() + expires)
+        response['Cache-Control'] = 'private, max-age=%d' % expires
+    return response
+
+@need_basicauth(token_scope='metrics')
+def metrics_latest(request):
+    """
+    the latest value (and its rate) of each metric of all the customer
+    containers (or of the one specified with ?container=) in one query
+    """
+    query = {'container__customer': request.user.customer}
+    if 'container' in request.GET:
+        try:
+            query['container'] = int(request.GET['container']) - UWSGI_IT_BASE_UID
+        except:
+            return spit_json(request, {'error': 'Bad Request'}, status=400)
+    containers = {}
+    for container, metric, unix, value, rate in LatestContainerMetric.objects.filter(**query).values_list(
+            'container', 'metric', 'unix', 'value', 'rate'):
+        containers.setdefault(container, {})[metric] = {'unix': unix, 'value': value, 'rate': rate}
+    return spit_json(request, [{'uid': UWSGI_IT_BASE_UID + pk, 'metrics': containers[pk]} for pk in sorted(containers)])
+
+@need_basicauth(token_scope='metrics')
+def metrics_export(request):
+    """
+    the latest value of the metrics of all the customer containers (and
+    of their domains) in the OpenMetrics format, for Prometheus scrapers
+    """
+    return openmetrics_response(request, request.user.customer.container_set.all())
 
-@need_basicauth
+def metrics_container_do(request, container, qs, prefix):
+    """
+    you can ask metrics for a single day of the year (288 metrics is the worst/general case)
+    if the day is today (or in the future), the response is cached for 5 minutes, otherwise it is
+    cached for a day (and clients are allowed to keep it forever)
+    """
+    year, month, day, expires, past = metrics_day(request)
+    def build():
+        try:
+            return qs.get(year=year,month=month,day=day).json or '[]'
+        except qs.model.DoesNotExist:
+            # no metrics for the day (yet), it is cached like the other results
+            return '[]'
+    entry = metrics_cached("%s_%d_%d_%d_%d" % (prefix, container.uid, year, month, day), expires, build)
+    return metrics_response(request, entry, expires, past)
+
+@need_basicauth(token_scope='metrics', token_container=True)
 def metrics_container_cpu(request, id):
     customer = request.user.customer
     try:
         container = customer.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_container_do(request, container, container.cpucontainermetric_set, 'cpu')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics', token_container=True)
 def metrics_container_net_tx(request, id):
     customer = request.user.customer
     try:
         container = customer.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_container_do(request, container, container.networktxcontainermetric_set, 'net.tx')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics', token_container=True)
 def metrics_container_net_rx(request, id):
     customer = request.user.customer
     try:
         container = customer.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_container_do(request, container, container.networkrxcontainermetric_set, 'net.rx')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics', token_container=True)
 def metrics_container_io_read(request, id):
     customer = request.user.customer
     try:
         container = customer.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_container_do(request, container, container.ioreadcontainermetric_set, 'io.read')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics', token_container=True)
 def metrics_container_io_write(request, id):
     customer = request.user.customer
     try:
         container = customer.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_container_do(request, container, container.ioreadcontainermetric_set, 'io.write')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics', token_container=True)
 def metrics_container_mem(request, id):
     customer = request.user.customer
     try:
         container = customer.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_container_do(request, container, container.memorycontainermetric_set, 'mem')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics', token_container=True)
 def metrics_container_mem_rss(request, id):
     customer = request.user.customer
     try:
         container = customer.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_container_do(request, container, container.memoryrsscontainermetric_set, 'mem.rss')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics', token_container=True)
 def metrics_container_mem_cache(request, id):
     customer = request.user.customer
     try:
         container = customer.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_container_do(request, container, container.memorycachecontainermetric_set, 'mem.cache')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics', token_container=True)
 def metrics_container_quota(request, id):
     customer = request.user.customer
     try:
         container = customer.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_container_do(request, container, container.quotacontainermetric_set, 'quota')
 
 def metrics_domain_do(request, domain, qs, prefix):
     """
     you can ask metrics for a single day of the year (288 metrics is the worst/general case)
-    if the day is today, the response is cached for 5 minutes, otherwise it is cached indefinitely
+    if the day is today (or in the future), the response is cached for 5 minutes, otherwise it is
+    cached for a day (and clients are allowed to keep it forever)
     """
-    today = datetime.datetime.today()
-    year = today.year
-    month = today.month
-    day = today.day
-    if 'year' in request.GET:year = int(request.GET['year'])
-    if 'month' in request.GET: month = int(request.GET['month'])
-    if 'day' in request.GET: day = int(request.GET['day'])
-    expires = 86400
-    if day != today.day or month != today.month or year != today.year: expires = 300
-    try:
-        # this will trigger the db query
-        if not UWSGI_IT_METRICS_CACHE: raise
-        cache = get_cache(UWSGI_IT_METRICS_CACHE)
-        j = cache.get("%s_%d_%d_%d_%d" % (prefix, domain.id, year, month, day))
-        if not j:
-            j_list = []
-            for m in qs.filter(year=year,month=month,day=day):
-                j_list.append('{ "container": %d, "metrics": %s }' % (m.container.uid, m.json))
-            j = '[' + ','.join(j_list) + ']'
-            cache.set("%s_%d_%d_%d_%d" % (prefix, domain.id, year, month, day ), j, expires)
-    except:
-        import sys
-        print sys.exc_info()
-        try:
-            j_list = []
-            for m in qs.filter(year=year,month=month,day=day):
-                j_list.append('{ "container": %d, "metrics": %s }' % (m.container.uid, m.json))
-            j = '[' + ','.join(j_list) + ']'
-        except:
-            j = "[]"
-    return spit_json(request, j, expires, True)
-
-@need_basicauth
+    year, month, day, expires, past = metrics_day(request)
+    def build():
+        j_list = []
+        for m in qs.filter(year=year,month=month,day=day):
+            j_list.append('{ "container": %d, "metrics": %s }' % (m.container.uid, m.json or '[]'))
+        return '[' + ','.join(j_list) + ']'
+    entry = metrics_cached("%s_%d_%d_%d_%d" % (prefix, domain.id, year, month, day), expires, build)
+    return metrics_response(request, entry, expires, past)
+
+@need_basicauth(token_scope='metrics')
 def metrics_domain_net_rx(request, id):
     customer = request.user.customer
     try:
         domain = customer.domain_set.get(pk=id)
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_domain_do(request, domain, domain.networkrxdomainmetric_set, 'domain.net.rx')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics')
 def metrics_domain_net_tx(request, id):
     customer = request.user.customer
     try:
         domain = customer.domain_set.get(pk=id)
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_domain_do(request, domain, domain.networktxdomainmetric_set, 'domain.net.tx')
 
-@need_basicauth
+@need_basicauth(token_scope='metrics')
 def metrics_domain_hits(request, id):
     customer = request.user.customer
     try:
         domain = customer.domain_set.get(pk=id)
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     return metrics_domain_do(request, domain, domain.hitsdomainmetric_set, 'domain.hits')
@@ -1,14 +1,22 @@
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import HttpResponse
 from django.template.loader import render_to_string
 from django.views.decorators.csrf import csrf_exempt
+from django.core.cache import get_cache
+from django.db import transaction, IntegrityError
 
-from uwsgi_it_api.utils import spit_json, check_body
+from uwsgi_it_api.utils import spit_json, check_body, rate_limit, too_many_requests
 from uwsgi_it_api.decorators import need_certificate
 from uwsgi_it_api.models import *
-from uwsgi_it_api.config import UWSGI_IT_BASE_UID
+from uwsgi_it_api.firewall import server_ruleset
+from uwsgi_it_api.alerts import evaluate_alerts
+from uwsgi_it_api.openmetrics import openmetrics_response
+from uwsgi_it_api.stats import report_exception, flush_stats, collect_stats
+from uwsgi_it_api.profiling import is_privileged
+from uwsgi_it_api.config import UWSGI_IT_BASE_UID, UWSGI_IT_ALARMS_CACHE, UWSGI_IT_ALARMS_RATE, UWSGI_IT_ALARMS_RATE_PERIOD
 
 import json
 import datetime
+import calendar
 
 @need_certificate
 @csrf_exempt
@@ -23,17 +31,15 @@ def private_server_file_metadata(request):
             sm, created = ServerMetadata.objects.get_or_create(server=server, metadata=metadata)
             sm.value = j['value']
             sm.save()
-            response = HttpResponse('Created\n')
-            response.status_code = 201
+            response = spit_json(request, {'message': 'Created'}, status=201)
             return response
         files = []
         for _file in ServerFileMetadata.objects.all():
             files.append(_file.filename)
         return spit_json(request, files)
     except:
-        import sys
-        print sys.exc_info()
-        return HttpResponseForbidden('Forbidden\n')
+        report_exception()
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
 
 @need_certificate
 def private_custom_services(request):
@@ -42,7 +48,7 @@ def private_custom_services(request):
         j = [{'customer':service.customer.pk, 'config': service.config, 'mtime': service.munix, 'id': service.pk } for service in server.customservice_set.all()]
         return spit_json(request, j)
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
 
 @need_certificate
 def private_containers(request):
@@ -51,7 +57,7 @@ def private_containers(request):
         j = [{'uid':container.uid, 'mtime': container.munix, 'ssh_keys_mtime': container.ssh_keys_munix } for container in server.container_set.exclude(distro__isnull=True).exclude(ssh_keys_raw__exact='').exclude(ssh_keys_raw__isnull=True)]
         return spit_json(request, j)
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
 
 @need_certificate
 def private_loopboxes(request):
@@ -60,7 +66,7 @@ def private_loopboxes(request):
         j = [{'id': loopbox.pk, 'uid':loopbox.container.uid, 'filename': loopbox.filename, 'mountpoint': loopbox.mountpoint, 'ro': loopbox.ro } for loopbox in Loopbox.objects.filter(container__server=server)]
         return spit_json(request, j)
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
 
 @need_certificate
 def private_portmappings(request):
@@ -81,7 +87,7 @@ def private_portmappings(request):
         j = {'unix': unix, 'mappings':pmappings}
         return spit_json(request, j)
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
 
 @need_certificate
 def private_container_ini(request, id):
@@ -89,12 +95,27 @@ def private_container_ini(request, id):
         server = Server.objects.get(address=request.META['REMOTE_ADDR'])
         container = server.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
         if not container.distro or not container.ssh_keys_raw: raise Exception("invalid container")
-        j = render_to_string('vassal.ini', {'container': container})
-        return HttpResponse(j, content_type="text/plain")
+        firewall = server_ruleset(server.pk)['containers'].get(container.uid, [])
+        j = render_to_string('vassal.ini', {'container': container, 'firewall': firewall})
+        return spit_json(request, j, raw=True, content_type="text/plain")
     except:
-        import sys
-        print sys.exc_info()
-        return HttpResponseForbidden('Forbidden\n')    
+        report_exception()
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+
+@need_certificate
+def private_firewall(request):
+    try:
+        server = Server.objects.get(address=request.META['REMOTE_ADDR'])
+    except:
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+    ruleset = server_ruleset(server.pk)
+    etag = '"%s"' % ruleset['version']
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponse(status=304)
+    else:
+        response = spit_json(request, ruleset)
+    response['ETag'] = etag
+    return response
 
 @need_certificate
 def private_container_ssh_keys(request, id):
@@ -102,9 +123,9 @@ def private_container_ssh_keys(request, id):
         server = Server.objects.get(address=request.META['REMOTE_ADDR'])
         container = server.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
         if not container.distro or not container.ssh_keys_raw: raise Exception("invalid container")
-        return HttpResponse(container.ssh_keys_raw, content_type="text/plain")
+        return spit_json(request, container.ssh_keys_raw, raw=True, content_type="text/plain")
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
 
 @need_certificate
 def private_legion_nodes(request):
@@ -117,9 +138,9 @@ def private_legion_nodes(request):
                 if node.address != server.address:
                     if node.munix > unix: unix = node.munix
                     nodes.append(node.address)
-        return HttpResponse(json.dumps({'unix': unix, 'nodes':nodes}), content_type="text/plain")
+        return spit_json(request, {'unix': unix, 'nodes':nodes})
     except:
-        return HttpResponseForbidden('Forbidden\n')    
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
 
 @need_certificate
 def private_nodes(request):
@@ -131,9 +152,9 @@ def private_nodes(request):
             if node.address != server.address:
                 if node.munix > unix: unix = node.munix
                 nodes.append(node.address)
-        return HttpResponse(json.dumps({'unix': unix, 'nodes':nodes}), content_type="text/plain")
+        return spit_json(request, {'unix': unix, 'nodes':nodes})
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
     
 
 @need_certificate
@@ -156,21 +177,51 @@ def private_metrics_domain_do(request, id, metric):
         response = check_body(request)
         if response: return response
         j = json.loads(request.read())
-        d = datetime.datetime.fromtimestamp(int(j['unix']))
-        domain = Domain.objects.get(name=j['domain'],customer=container.customer)
-        try:
-            m = metric.objects.get(domain=domain,container=container,year=d.year,month=d.month,day=d.day)
-        except:
-            m = metric(domain=domain,container=container,year=d.year,month=d.month,day=d.day,json='[]')
-        m_json = json.loads(m.json)
-        m_json.append( [int(j['unix']), long(j['value'])])
-        m.json = json.dumps(m_json)
-        m.save()
-        response = HttpResponse('Created\n')
-        response.status_code = 201
+        # a single sample or a list of them (for different domains too)
+        if isinstance(j, dict): j = [j]
+        for refreshed in (False, True):
+            domains = customer_domains(container.customer_id, refresh=refreshed)
+            samples = {}
+            seen = {}
+            latest = {}
+            for sample in j:
+                if sample['domain'] not in domains and not refreshed:
+                    domains = customer_domains(container.customer_id, refresh=True)
+                    refreshed = True
+                # unknown (or just deleted) domain
+                if sample['domain'] not in domains: continue
+                domain_id = domains[sample['domain']]
+                d = datetime.datetime.fromtimestamp(int(sample['unix']))
+                samples.setdefault((domain_id, d.year, d.month, d.day), []).append([int(sample['unix']), long(sample['value'])])
+                seen[domain_id] = max(seen.get(domain_id, d), d)
+                latest[domain_id] = max(latest.get(domain_id, (0, 0)), (int(sample['unix']), long(sample['value'])))
+            if not samples:
+                return spit_json(request, {'error': 'Not found'}, status=404)
+            try:
+                with transaction.atomic():
+                    for (domain_id, year, month, day), values in samples.items():
+                        try:
+                            m = metric.objects.get(domain=domain_id,container=container,year=year,month=month,day=day)
+                        except:
+                            m = metric(domain_id=domain_id,container=container,year=year,month=month,day=day,json='[]')
+                        m_json = json.loads(m.json or '[]')
+                        m_json += values
+                        m.json = json.dumps(m_json)
+                        m.save()
+                    for domain_id, d in seen.items():
+                        DomainContainer.seen(domain_id, container.pk, d)
+                    for domain_id, (unix, value) in latest.items():
+                        LatestDomainMetric.store(domain_id, container.pk, metric.name, unix, value)
+                break
+            except IntegrityError:
+                # a domain deleted by another process is still in our
+                # process cache, drop it and retry with the shared one
+                customer_domains_local.pop(container.customer_id, None)
+                if refreshed:
+                    return spit_json(request, {'error': 'Conflict'}, status=409)
+        response = spit_json(request, {'message': 'Created'}, status=201)
     else:
-        response = HttpResponse('Method not allowed\n')
-        response.status_code = 405
+        response = spit_json(request, {'error': 'Method not allowed'}, status=405)
     return response
 
 @csrf_exempt
@@ -201,15 +252,23 @@ def private_metrics_container_do(request, id, metric):
             m = metric.objects.get(container=container,year=d.year,month=d.month,day=d.day)
         except:
             m = metric(container=container,year=d.year,month=d.month,day=d.day,json='[]')
-        m_json = json.loads(m.json)
-        m_json.append( [int(j['unix']), long(j['value'])])
+        m_json = json.loads(m.json or '[]')
+        unix, value = int(j['unix']), long(j['value'])
+        # rate of change from the previous value of the day
+        rate = None
+        if m_json and unix > m_json[-1][0]:
+            rate = float(value - m_json[-1][1]) / (unix - m_json[-1][0])
+        m_json.append([unix, value])
         m.json = json.dumps(m_json)
         m.save()
-        response = HttpResponse('Created\n')
-        response.status_code = 201
+        LatestContainerMetric.store(container.pk, metric.name, unix, value, rate)
+        try:
+            evaluate_alerts(container, metric.name, unix, value, rate)
+        except:
+            report_exception()
+        response = spit_json(request, {'message': 'Created'}, status=201)
     else:
-        response = HttpResponse('Method not allowed\n')
-        response.status_code = 405
+        response = spit_json(request, {'error': 'Method not allowed'}, status=405)
     return response
 
 @csrf_exempt
@@ -262,9 +321,14 @@ def private_metrics_container_quota(request, id):
 def private_alarms(request, id):
     server = Server.objects.get(address=request.META['REMOTE_ADDR'])
     container = server.container_set.get(pk=(int(id)-UWSGI_IT_BASE_UID))
+    if UWSGI_IT_ALARMS_RATE and request.method == 'POST':
+        retry_after = rate_limit(get_cache(UWSGI_IT_ALARMS_CACHE),
+                                 alarms_rate_key(container.uid),
+                                 UWSGI_IT_ALARMS_RATE, UWSGI_IT_ALARMS_RATE_PERIOD)
+        if retry_after:
+            return too_many_requests(request, retry_after)
     if request.method != 'POST':
-        response = HttpResponse('Method not allowed\n')
-        response.status_code = 405
+        response = spit_json(request, {'error': 'Method not allowed'}, status=405)
         return response
     response = check_body(request)
     if response: return response
@@ -278,16 +342,74 @@ def private_alarms(request, id):
     alarm.level = 0
     alarm.msg = msg
     alarm.save()
-    response = HttpResponse('Created\n')
-    response.status_code = 201
+    response = spit_json(request, {'message': 'Created'}, status=201)
     return response
 
 
+@need_certificate
+def private_metrics_export(request):
+    """
+    the latest metrics (OpenMetrics format) of the whole fleet for privileged
+    clients, of the containers of the asking server otherwise
+    """
+    address = request.META['REMOTE_ADDR']
+    if PrivilegedClient.objects.filter(address=address).exists():
+        containers = Container.objects.all()
+    else:
+        try:
+            containers = Server.objects.get(address=address).container_set.all()
+        except:
+            return spit_json(request, {'error': 'Forbidden'}, status=403)
+    return openmetrics_response(request, containers)
+
+
+@need_certificate
+def private_stats(request):
+    """
+    the request stats of all of the api processes (privileged clients only)
+    """
+    if not PrivilegedClient.objects.filter(address=request.META['REMOTE_ADDR']).exists():
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+    flush_stats(force=True)
+    return spit_json(request, collect_stats())
+
+
+@need_certificate
+def private_profiles(request, id=None):
+    """
+    the stored request profiles (see profiling.py), the details of one of
+    them with its id (the raw pstats data at <id>.prof)
+    """
+    if not is_privileged(request):
+        return spit_json(request, {'error': 'Forbidden'}, status=403)
+    if not id:
+        return spit_json(request, [{'id': p.pk, 'view': p.view, 'method': p.method, 'path': p.path,
+                                    'status': p.status, 'trigger': p.trigger, 'mode': p.mode,
+                                    'duration': p.duration, 'unix': int(p.ctime.strftime('%s'))}
+                                   for p in RequestProfile.objects.defer('report', 'data', 'sql')])
+    try:
+        profile = RequestProfile.objects.get(pk=id)
+    except:
+        return spit_json(request, {'error': 'Not found'}, status=404)
+    if request.path.endswith('.prof'):
+        if profile.data is None:
+            return spit_json(request, {'error': 'Not found'}, status=404)
+        response = HttpResponse(str(profile.data), content_type='application/octet-stream')
+        response['Content-Disposition'] = 'attachment; filename="%d.prof"' % profile.pk
+        return response
+    return spit_json(request, {'id': profile.pk, 'view': profile.view, 'method': profile.method,
+                               'path': profile.path, 'status': profile.status, 'mode': profile.mode,
+                               'duration': profile.duration, 'report': profile.report,
+                               'sql': json.loads(profile.sql)})
+
+
 @need_certificate
 def private_privileged_secret_uuids(request):
     try:
         privileged_client = PrivilegedClient.objects.get(address=request.META['REMOTE_ADDR'])
-        j = [{'uid':container.uid, 'mtime': container.munix, 'secret_uuid': container.secret_uuid, 'address': container.server.address } for container in Container.objects.all().exclude(distro__isnull=True).exclude(ssh_keys_raw__exact='').exclude(ssh_keys_raw__isnull=True)]
+        # the whole fleet: the (small) rows are read here, where db errors are handled, the json is streamed
+        rows = list(Container.objects.exclude(distro__isnull=True).exclude(ssh_keys_raw__exact='').exclude(ssh_keys_raw__isnull=True).values_list('pk', 'last_reboot', 'secret_uuid', 'server__address'))
+        j = ({'uid': UWSGI_IT_BASE_UID + pk, 'mtime': calendar.timegm(last_reboot.utctimetuple()), 'secret_uuid': secret_uuid, 'address': address } for pk, last_reboot, secret_uuid, address in rows)
         return spit_json(request, j)
     except:
-        return HttpResponseForbidden('Forbidden\n')
+        return spit_json(request, {'error': 'Forbidden'}, status=403)